@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+import bisect
+
+# Physical address space index.
+#
+# Ranges (BARs, bridge windows, /proc/iomem entries) nest inside each other,
+# so rather than walking a tree on every lookup the ranges are flattened once
+# into a sorted list of elementary segments.  Each segment records every range
+# covering it (outermost first), so "who owns address X" is a single bisect.
+
+
+class AddressIndex:
+    """
+    >>> idx = AddressIndex()
+    >>> idx.add(0x0000, 0xffff, 'PCI Bus 0000:00')
+    >>> idx.add(0x1000, 0x1fff, 'bridge window')
+    >>> idx.add(0x1000, 0x10ff, 'BAR0')
+    >>> idx.add(0x8000, 0x8fff, 'BAR2')
+    >>> [o for s, e, o in idx.whois(0x1080)]
+    ['PCI Bus 0000:00', 'bridge window', 'BAR0']
+    >>> [o for s, e, o in idx.whois(0x1100)]
+    ['PCI Bus 0000:00', 'bridge window']
+    >>> s, e, o = idx.owner(0x8000)
+    >>> hex(s), hex(e), o
+    ('0x8000', '0x8fff', 'BAR2')
+    >>> idx.whois(0x10000)
+    []
+    >>> idx.owner(0x10000) is None
+    True
+
+    Overlapping (rather than nested) ranges are all reported.
+
+    >>> idx.add(0x8800, 0x97ff, 'conflict')
+    >>> [o for s, e, o in idx.whois(0x8900)]
+    ['PCI Bus 0000:00', 'BAR2', 'conflict']
+    >>> len(idx)
+    5
+    """
+
+    def __init__(self, ranges=()):
+        self._ranges = []
+        self._starts = None
+        self._owners = None
+        for start, end, owner in ranges:
+            self.add(start, end, owner)
+
+    def __len__(self):
+        return len(self._ranges)
+
+    def add(self, start, end, owner):
+        assert end >= start, (hex(start), hex(end), owner)
+        self._ranges.append((start, end, owner))
+        self._starts = None
+
+    def build(self):
+        opens = {}
+        closes = {}
+        for r in sorted(self._ranges, key=lambda r: (r[0], -r[1])):
+            opens.setdefault(r[0], []).append(r)
+            closes.setdefault(r[1]+1, []).append(r)
+
+        starts = []
+        owners = []
+        active = []
+        for point in sorted(opens.keys() | closes.keys()):
+            for r in closes.get(point, ()):
+                active.remove(r)
+            active.extend(opens.get(point, ()))
+
+            covering = tuple(active)
+            if owners and owners[-1] == covering:
+                continue
+            starts.append(point)
+            owners.append(covering)
+
+        self._starts = starts
+        self._owners = owners
+
+    def whois(self, addr):
+        """All the ranges containing `addr`, outermost first."""
+        if self._starts is None:
+            self.build()
+        i = bisect.bisect_right(self._starts, addr) - 1
+        if i < 0:
+            return []
+        return list(self._owners[i])
+
+    def owner(self, addr):
+        """The innermost range containing `addr`, or None."""
+        if self._starts is None:
+            self.build()
+        i = bisect.bisect_right(self._starts, addr) - 1
+        if i < 0 or not self._owners[i]:
+            return None
+        return self._owners[i][-1]
+
+
+def iter_iomem(data):
+    """
+    Yields `(depth, start, end, name)` for each line of /proc/iomem (or
+    /proc/ioports) output.
+
+    >>> list(iter_iomem('''\\
+    ... 00000000-00000fff : Reserved
+    ... 000a0000-000fffff : Reserved
+    ...   000a0000-000bffff : PCI Bus 0000:00
+    ... '''))
+    [(0, 0, 4095, 'Reserved'), (0, 655360, 1048575, 'Reserved'), (1, 655360, 786431, 'PCI Bus 0000:00')]
+    """
+    for line in data.splitlines():
+        line = line.rstrip()
+        if not line:
+            continue
+
+        addr, name = line.split(' : ', 1)
+        stripped = addr.lstrip(' ')
+        depth = (len(addr) - len(stripped)) // 2
+
+        start, end = stripped.split('-')
+        yield depth, int(start, 16), int(end, 16), name
+
+
+class IomemNode:
+    __slots__ = ('start', 'end', 'entries', 'children')
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        # `(depth, name)` of each line for the range.
+        self.entries = []
+        self.children = []
+
+    @property
+    def size(self):
+        return self.end - self.start + 1
+
+    @property
+    def names(self):
+        return [name for depth, name in self.entries]
+
+    def __repr__(self):
+        return 'IomemNode({:#x}, {:#x}, {!r})'.format(self.start, self.end, self.names)
+
+
+class IomemTree:
+    """
+    The nesting of /proc/iomem (or ioports), built in one pass with a stack
+    of the open ranges.  Lines for the same range are merged into one node.
+
+    The indentation isn't always right (some kernels list a device's BARs at
+    the depth of the bus above it), so each range goes below the innermost
+    open range containing it.  For well formed input that is the same as
+    using the depth.
+
+    >>> t = IomemTree(iter_iomem('''\\
+    ... 00000000-00000fff : Reserved
+    ... 000a0000-000fffff : PCI Bus 0000:00
+    ...   000a0000-000bffff : Video RAM area
+    ...   000c0000-000fffff : PCI Bus 0000:01
+    ...     000c0000-000fffff : 0000:01:00.0
+    ...     000c0000-000c7fff : Video ROM
+    ... 00100000-3fffffff : System RAM
+    ... 00100000-3fffffff : System RAM
+    ... '''))
+    >>> t.roots
+    [IomemNode(0x0, 0xfff, ['Reserved']), IomemNode(0xa0000, 0xfffff, ['PCI Bus 0000:00']), IomemNode(0x100000, 0x3fffffff, ['System RAM', 'System RAM'])]
+    >>> for depth, node in t:
+    ...     print('  ' * depth, node)
+     IomemNode(0x0, 0xfff, ['Reserved'])
+     IomemNode(0xa0000, 0xfffff, ['PCI Bus 0000:00'])
+       IomemNode(0xa0000, 0xbffff, ['Video RAM area'])
+       IomemNode(0xc0000, 0xfffff, ['PCI Bus 0000:01', '0000:01:00.0'])
+         IomemNode(0xc0000, 0xc7fff, ['Video ROM'])
+     IomemNode(0x100000, 0x3fffffff, ['System RAM', 'System RAM'])
+    >>> len(t), t.roots[1].children[1].entries
+    (6, [(1, 'PCI Bus 0000:01'), (2, '0000:01:00.0')])
+    """
+
+    def __init__(self, entries=()):
+        self.roots = []
+        self._stack = []
+        self._count = 0
+        for depth, start, end, name in entries:
+            self.add(depth, start, end, name)
+
+    def add(self, depth, start, end, name):
+        """Adds the `(depth, start, end, name)` entries of iter_iomem in order."""
+        assert end >= start, (hex(start), hex(end), name)
+        stack = self._stack
+        while stack and not (stack[-1].start <= start and end <= stack[-1].end):
+            stack.pop()
+
+        if stack and (stack[-1].start, stack[-1].end) == (start, end):
+            node = stack[-1]
+        else:
+            node = IomemNode(start, end)
+            (stack[-1].children if stack else self.roots).append(node)
+            stack.append(node)
+            self._count += 1
+        node.entries.append((depth, name))
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        """Yields `(depth, node)` depth first."""
+        stack = [(0, n) for n in reversed(self.roots)]
+        while stack:
+            depth, node = stack.pop()
+            yield depth, node
+            stack.extend((depth + 1, c) for c in reversed(node.children))
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+
+import argparse
+import re
+import sys
+
+from dataclasses import dataclass
+from typing import Optional
+
+import lspci
+import topology
+
+# End to end PCIe bandwidth of every endpoint.
+#
+# Walking from an endpoint through the bridges above it (switch ports, then
+# the root port) visits every link between it and the CPU.  Each physical link
+# is between an endpoint or switch upstream port and the root or downstream
+# port above it, and can only train as well as the weaker of the two.  The
+# slowest link bounds the throughput of the endpoint, e.g. a V100 behind a
+# PEX 9765 port which has trained at x8 only gets half its expected host to
+# device bandwidth.
+
+RE_SPEED = re.compile(r'([\d.]+)\s*GT/s')
+RE_WIDTH = re.compile(r'x(\d+)')
+
+
+def parse_speed(s):
+    """
+    >>> parse_speed('8GT/s (ok)'), parse_speed('2.5GT/s (downgraded)'), parse_speed('unknown')
+    (8.0, 2.5, None)
+    """
+    m = RE_SPEED.search(s or '')
+    return float(m.group(1)) if m else None
+
+
+def parse_width(s):
+    """
+    >>> parse_width('x16 (ok)'), parse_width('x8'), parse_width(None)
+    (16, 8, None)
+    """
+    m = RE_WIDTH.search(s or '')
+    return int(m.group(1)) if m else None
+
+
+def encoding(speed):
+    """Fraction of the raw bit rate left after line encoding."""
+    if speed < 8:
+        return 8/10         # Gen1/Gen2 8b/10b
+    if speed < 64:
+        return 128/130      # Gen3-Gen5 128b/130b
+    return 242/256          # Gen6 FLIT mode
+
+
+def bandwidth(speed, width):
+    """
+    Usable bandwidth of one direction of a link in GB/s.
+
+    >>> round(bandwidth(8, 16), 2), round(bandwidth(2.5, 8), 2), round(bandwidth(16, 4), 2)
+    (15.75, 2.0, 7.88)
+    """
+    if not speed or not width:
+        return 0.0
+    return speed * width * encoding(speed) / 8
+
+
+# Ports whose LnkSta describes the link below them rather than above.
+DOWNSTREAM_PORTS = ('Root Port', 'Downstream Port')
+
+
+@dataclass
+class Port:
+    device: str
+    kind: str
+    cap_speed: Optional[float]
+    cap_width: Optional[int]
+    speed: Optional[float]
+    width: Optional[int]
+
+    @property
+    def slot(self):
+        return self.device.split(' ', 1)[0]
+
+    @property
+    def downstream(self):
+        return self.kind in DOWNSTREAM_PORTS
+
+
+def device_port(name, details):
+    """The Port described by the Express capability of a device, or None."""
+    for cap in details.get('Capabilities', []):
+        cap_reg = cap.properties.get('LnkCap', None)
+        sta_reg = cap.properties.get('LnkSta', None)
+        if not isinstance(cap_reg, dict) or not isinstance(sta_reg, dict):
+            continue
+        kind = ''
+        for t in cap.types or ():
+            if t.startswith('Express '):
+                kind = t.split(') ', 1)[-1].split(' (')[0]
+        return Port(
+            name, kind,
+            parse_speed(cap_reg.get('Speed')), parse_width(cap_reg.get('Width')),
+            parse_speed(sta_reg.get('Speed')), parse_width(sta_reg.get('Width')))
+    return None
+
+
+def _min(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+@dataclass
+class Link:
+    """
+    A physical link between a device (endpoint or switch upstream port) and
+    the root or downstream port above it.  It can only train as fast and as
+    wide as the less capable of the two ends.
+    """
+    device: Port
+    port: Optional[Port]
+
+    @property
+    def slot(self):
+        return self.device.slot
+
+    @property
+    def speed(self):
+        return self.device.speed
+
+    @property
+    def width(self):
+        return self.device.width
+
+    @property
+    def cap_speed(self):
+        return _min(self.device.cap_speed, self.port and self.port.cap_speed)
+
+    @property
+    def cap_width(self):
+        return _min(self.device.cap_width, self.port and self.port.cap_width)
+
+    @property
+    def bandwidth(self):
+        return bandwidth(self.speed, self.width)
+
+    @property
+    def capable(self):
+        return bandwidth(self.cap_speed, self.cap_width)
+
+    @property
+    def downgraded(self):
+        """True when the link trained below what both ends support."""
+        if None in (self.speed, self.width, self.cap_speed, self.cap_width):
+            return False
+        return self.speed < self.cap_speed or self.width < self.cap_width
+
+    def __str__(self):
+        s = '{}GT/s x{}'.format(_num(self.speed), self.width)
+        if self.downgraded:
+            s += ' (capable {}GT/s x{})'.format(_num(self.cap_speed), self.cap_width)
+        return s
+
+
+def _num(f):
+    return '?' if f is None else '{:g}'.format(f)
+
+
+@dataclass
+class Path:
+    endpoint: str
+    # From the endpoint up to the root port.
+    links: list
+
+    @property
+    def bottleneck(self):
+        """The slowest Link on the path (the one nearest the endpoint on ties)."""
+        links = [l for l in self.links if l.width]
+        if not links:
+            return None
+        return min(links, key=lambda l: l.bandwidth)
+
+    @property
+    def expected(self):
+        """The bandwidth the path would have if every link trained fully."""
+        return min((l.capable for l in self.links if l.cap_width), default=0.0)
+
+    @property
+    def downgraded(self):
+        return [l for l in self.links if l.downgraded]
+
+
+def paths(devices):
+    """
+    Yields a Path for every endpoint (non-bridge device with a link) in the
+    parsed `devices`.
+
+    >>> devices = lspci.parse_lspci_output(
+    ...     "00:02.0 PCI bridge: Intel Corporation Root Port 2\\n"
+    ...     "\\tBus: primary=00, secondary=02, subordinate=04, sec-latency=0\\n"
+    ...     "\\tCapabilities: [90] Express (v2) Root Port (Slot-), MSI 00\\n"
+    ...     "\\t\\tLnkCap:\\tPort #3, Speed 8GT/s, Width x16, ASPM not supported\\n"
+    ...     "\\t\\tLnkSta:\\tSpeed 8GT/s (ok), Width x16 (ok)\\n"
+    ...     "\\n"
+    ...     "02:00.0 PCI bridge: PLX Technology, Inc. PEX 9765 Upstream Port\\n"
+    ...     "\\tBus: primary=02, secondary=03, subordinate=04, sec-latency=0\\n"
+    ...     "\\tCapabilities: [68] Express (v2) Upstream Port, MSI 00\\n"
+    ...     "\\t\\tLnkCap:\\tPort #0, Speed 8GT/s, Width x16, ASPM L1\\n"
+    ...     "\\t\\tLnkSta:\\tSpeed 8GT/s (ok), Width x16 (ok)\\n"
+    ...     "\\n"
+    ...     "03:08.0 PCI bridge: PLX Technology, Inc. PEX 9765 Downstream Port\\n"
+    ...     "\\tBus: primary=03, secondary=04, subordinate=04, sec-latency=0\\n"
+    ...     "\\tCapabilities: [68] Express (v2) Downstream Port (Slot+), MSI 00\\n"
+    ...     "\\t\\tLnkCap:\\tPort #8, Speed 8GT/s, Width x16, ASPM L1\\n"
+    ...     "\\t\\tLnkSta:\\tSpeed 8GT/s (ok), Width x8 (downgraded)\\n"
+    ...     "\\n"
+    ...     "04:00.0 3D controller: NVIDIA Corporation GV100GL [Tesla V100 SXM2 16GB]\\n"
+    ...     "\\tCapabilities: [68] Express (v2) Endpoint, MSI 00\\n"
+    ...     "\\t\\tLnkCap:\\tPort #0, Speed 8GT/s, Width x16, ASPM L0s L1\\n"
+    ...     "\\t\\tLnkSta:\\tSpeed 8GT/s (ok), Width x8 (downgraded)\\n"
+    ...     "\\n")
+    >>> for path in paths(devices):
+    ...     print(path.endpoint)
+    ...     for link in path.links:
+    ...         print('   ', link.slot, '->', link.port.slot, link, '{:.2f} GB/s'.format(link.bandwidth))
+    ...     print('    bottleneck', path.bottleneck.slot, '{:.2f} of {:.2f} GB/s'.format(path.bottleneck.bandwidth, path.expected))
+    04:00.0 3D controller: NVIDIA Corporation GV100GL [Tesla V100 SXM2 16GB]
+        04:00.0 -> 03:08.0 8GT/s x8 (capable 8GT/s x16) 7.88 GB/s
+        02:00.0 -> 00:02.0 8GT/s x16 15.75 GB/s
+        bottleneck 04:00.0 7.88 of 15.75 GB/s
+    """
+    t = topology.from_lspci(devices)
+    for name, details in devices:
+        dev = t[lspci.parse_bdf(name)]
+        if isinstance(dev, topology.Bridge):
+            continue
+        port = device_port(name, details)
+        if port is None:
+            continue
+
+        # Walk up through the bridges, pairing each device which has a link
+        # above it with the next root/downstream port.
+        links = []
+        below = port
+        for bridge in reversed(dev.ancestors):
+            bport = device_port(*bridge.data)
+            if bport is not None:
+                if below is not None and (bport.downstream or not bport.kind):
+                    links.append(Link(below, bport))
+                    below = None
+                elif not bport.downstream:
+                    below = bport
+        if below is not None:
+            links.append(Link(below, None))
+
+        yield Path(name, links)
+
+
+def report(devices, all_paths=False):
+    """
+    Prints each endpoint whose path has a downgraded link (or every endpoint
+    with `all_paths`), returning the number of downgraded paths.
+    """
+    problems = 0
+    for path in paths(devices):
+        bottleneck = path.bottleneck
+        if bottleneck is None:
+            continue
+        if path.downgraded:
+            problems += 1
+        elif not all_paths:
+            continue
+
+        print(path.endpoint)
+        print('    {:.2f} GB/s of {:.2f} GB/s, limited by {} {}'.format(
+            bottleneck.bandwidth, path.expected, bottleneck.slot, bottleneck))
+        rows = [(l.slot, l.port.slot if l.port else '-') for l in path.links]
+        width = [max(len(r[i]) for r in rows) for i in (0, 1)]
+        for link, (slot, port) in zip(path.links, rows):
+            print('      {} -> {} {:>10s} {:6.2f} GB/s{}'.format(
+                slot.ljust(width[0]), port.ljust(width[1]),
+                '{}GT/s x{}'.format(_num(link.speed), link.width), link.bandwidth,
+                '  DOWNGRADED from {}GT/s x{}'.format(_num(link.cap_speed), link.cap_width) if link.downgraded else ''))
+        print()
+    return problems
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Report the PCIe bandwidth bottleneck between every endpoint and its root port.')
+    parser.add_argument('snapshots', nargs='*', metavar='LSPCI_VVV', help='lspci -vvv output (default: ./lspci.vvv or the running system)')
+    parser.add_argument('--all', action='store_true', help='show every endpoint, not just the ones with a downgraded link')
+    opts = parser.parse_args(args[1:])
+
+    if not opts.snapshots:
+        devices = list(lspci.lspci_devices())
+        print('{} endpoints with a downgraded link'.format(report(devices, opts.all)))
+        return 0
+
+    for path in opts.snapshots:
+        with open(path, 'rb') as f:
+            devices = lspci.cached_parse(f.read())
+        print('==>', path, '<==')
+        print('{} endpoints with a downgraded link'.format(report(devices, opts.all)))
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    import doctest
+    if doctest.testmod().failed > 0:
+        sys.exit(1)
+    sys.exit(main(sys.argv))
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import timeit
+
+import addrmap
+import lspci
+import render
+import topology
+
+# Times each stage of the parsers on the checked-in snapshots.
+#
+# Every stage is timed on its own, fed the output of the stages before it
+# (worked out once, outside the timing), so a change to one stage shows up in
+# that stage's numbers only.  Each result is the best of `repeat` runs of
+# enough calls to take at least 0.1s, per call.
+#
+# Runs can be saved, tagged with the git commit, to a JSON lines file
+# (bench.jsonl in the parse cache directory), and compared against an
+# earlier saved run to find regressions:
+#
+#   ./bench.py --save                 # on the commit before a change
+#   ./bench.py --compare              # after it, against the last saved run
+#   ./bench.py --compare 1a2b3c4      # against the last run saved at 1a2b3c4
+
+TOP = os.path.dirname(os.path.abspath(__file__))
+RESULTS = os.path.join(lspci.CACHE_DIR, 'bench.jsonl')
+
+# A stage is slower if it takes this much longer than in the compared run.
+THRESHOLD = 0.10
+
+
+def corpora():
+    """
+    `{kind: [path]}` of the snapshots in the repository: `lspci -vvv` output,
+    `lspci -PP` device lists (which only topology.from_paths reads) and
+    /proc/iomem.  Each kind only goes through the stages which read it, so
+    a parser failing on a snapshot is an error, not a skipped corpus.
+    """
+    def find(*patterns):
+        paths = []
+        for pattern in patterns:
+            paths.extend(glob.glob(os.path.join(TOP, pattern)))
+        return sorted(paths)
+    return {
+        'vvv': find('*/lspci.vvv', '*/lspci.full'),
+        'paths': find('*/lspci', '*/pcie/*.lspci'),
+        'iomem': find('*/iomem'),
+    }
+
+
+def _read(path):
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def _blocks(fixed):
+    """The `[name, [line...]]` of each device, before undo_multiline()."""
+    blocks = []
+    current = None
+    for line in fixed.splitlines():
+        if not line.strip():
+            if current:
+                blocks.append(current)
+            current = None
+        elif not current:
+            current = [line, []]
+        else:
+            current[1].append(line[1:])
+    return blocks
+
+
+def _enabled(devices):
+    """The enabled regions lspci.main() builds its parents() tree from, in order."""
+    enabled = []
+    for name, details in devices:
+        for r in details.get('Regions', []) + details.get('BridgeRegions', []):
+            if not r.disabled:
+                enabled.append((r, name))
+    enabled.sort(key=lambda x: (x[0].start, lspci.F-x[0].end, x[1]))
+    return enabled
+
+
+def _parents(enabled):
+    tree = {}
+    for r, n in enabled:
+        lspci.parents(r.start, r.end, tree).setdefault((0, 0), []).append(n)
+    return tree
+
+
+def _pmem(tree):
+    out = render.Renderer(width=200)
+    lspci.pmem(tree, out=out)
+    return out.getvalue()
+
+
+def _parse_flags(inputs):
+    # Cold, so it is the decoding that is timed rather than the cache.
+    lspci._decode_flags.cache_clear()
+    for l in inputs:
+        lspci.parse_flags(l)
+
+
+def stages_vvv(path):
+    """Yields `(stage, fn)` for an `lspci -vvv` snapshot."""
+    text = _read(path)
+    fixed = lspci._fixup(text)
+    lines = fixed.splitlines()
+    blocks = _blocks(fixed)
+    grouped = lspci.group_device_lines(lines)
+    caps = [l[0] for _, details in grouped for l in details
+            if isinstance(l, list) and l[0].startswith('Capabilities: ')]
+    flags = lspci._flag_inputs([path])
+    devices = lspci.parse_lspci_output(text)
+    enabled = _enabled(devices)
+    tree = _parents(enabled)
+
+    yield '_fixup', lambda: lspci._fixup(text)
+    yield 'group_device_lines', lambda: lspci.group_device_lines(lines)
+    yield 'undo_multiline', lambda: [lspci.undo_multiline(b[1]) for b in blocks]
+    yield 'parse_caps', lambda: [lspci.parse_caps(c) for c in caps]
+    yield 'parse_flags', lambda: _parse_flags(flags)
+    yield 'parse_device', lambda: [lspci.parse_device(d, l) for d, l in grouped]
+    yield 'parse_lspci_output', lambda: lspci.parse_lspci_output(text)
+    yield 'parse_lspci_output(lazy)', lambda: lspci.parse_lspci_output(text, lazy=True)
+    yield 'parents', lambda: _parents(enabled)
+    yield 'pmem', lambda: _pmem(tree)
+
+
+def stages_paths(path):
+    text = _read(path)
+    yield 'from_paths', lambda: topology.from_paths(text)
+
+
+def stages_iomem(path):
+    text = _read(path)
+    entries = list(addrmap.iter_iomem(text))
+    yield 'iter_iomem', lambda: list(addrmap.iter_iomem(text))
+    yield 'IomemTree', lambda: addrmap.IomemTree(entries)
+
+
+STAGES = {
+    'vvv': stages_vvv,
+    'paths': stages_paths,
+    'iomem': stages_iomem,
+}
+
+
+def measure(fn, repeat=5, min_time=0.1):
+    """Seconds per call of `fn`, the best of `repeat` runs."""
+    timer = timeit.Timer(fn)
+    number = 1
+    while True:
+        t = timer.timeit(number)
+        if t >= min_time:
+            break
+        number *= 2 if t * 4 > min_time else 10
+    return min([t] + timer.repeat(repeat - 1, number)) / number
+
+
+def run(stage_filter=None, corpus_filter=None, repeat=5, min_time=0.1):
+    """Yields `(stage, corpus, seconds)`."""
+    for kind, paths in corpora().items():
+        for path in paths:
+            corpus = os.path.relpath(path, TOP)
+            if corpus_filter and corpus_filter not in corpus:
+                continue
+            for stage, fn in STAGES[kind](path):
+                if stage_filter and stage_filter not in stage:
+                    continue
+                yield stage, corpus, measure(fn, repeat, min_time)
+
+
+def git_commit():
+    """`(commit, dirty)` of the checkout, or `(None, None)`."""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=TOP,
+            capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=TOP,
+            capture_output=True, text=True, check=True).stdout.strip() != ''
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def load(path=RESULTS):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return [json.loads(l) for l in f if l.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def save(record, path=RESULTS):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def compare(results, base, threshold=THRESHOLD):
+    """
+    Returns `(stage, corpus, before, after, ratio, regressed)` for each result
+    in both of the `{"stage corpus": seconds}` dicts, where `regressed` is
+    whether the ratio is over 1 + `threshold`.
+
+    >>> rows = compare({'pmem a': 0.012, 'parents a': 0.010, 'new a': 1.0},
+    ...                {'pmem a': 0.010, 'parents a': 0.010})
+    >>> [(s, c, round(r, 2), bad) for s, c, b, a, r, bad in rows]
+    [('pmem', 'a', 1.2, True), ('parents', 'a', 1.0, False)]
+    """
+    rows = []
+    for key, after in results.items():
+        before = base.get(key, None)
+        if not before:
+            continue
+        stage, corpus = key.split(' ', 1)
+        ratio = after / before
+        rows.append((stage, corpus, before, after, ratio, ratio > 1 + threshold))
+    return rows
+
+
+def _ms(s):
+    return '{:10.3f}ms'.format(s * 1e3)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Time each parser stage on the checked-in snapshots.')
+    parser.add_argument('--stage', help='only the stages whose name contains STAGE')
+    parser.add_argument('--corpus', help='only the snapshots whose path contains CORPUS')
+    parser.add_argument('--repeat', type=int, default=5, help='runs to take the best of')
+    parser.add_argument('--min-time', type=float, default=0.1, help='seconds each run should take at least')
+    parser.add_argument('--save', action='store_true', help='append the results to --results, tagged with the git commit')
+    parser.add_argument('--compare', nargs='?', const='', metavar='COMMIT',
+                        help='compare with the last saved run (at COMMIT), exiting 1 on a regression')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='slowdown counted as a regression (0.1 = 10%%)')
+    parser.add_argument('--results', default=RESULTS, help='the saved runs (default: %(default)s)')
+    parser.add_argument('--history', action='store_true', help='list the saved runs and exit')
+    opts = parser.parse_args(args[1:])
+
+    if opts.history:
+        for r in load(opts.results):
+            print(r['time'], r['commit'], '(dirty)' if r['dirty'] else '', len(r['results']), 'results')
+        return 0
+
+    base = None
+    if opts.compare is not None:
+        # Runs saved outside a git checkout have no commit to match.
+        runs = [r for r in load(opts.results)
+                if not opts.compare or r['commit'] is not None and r['commit'].startswith(opts.compare)]
+        if not runs:
+            print('No saved run to compare with in', opts.results, file=sys.stderr)
+            return 2
+        base = runs[-1]
+
+    results = {}
+    for stage, corpus, seconds in run(opts.stage, opts.corpus, opts.repeat, opts.min_time):
+        results[stage + ' ' + corpus] = seconds
+        print('{:26s} {:40s} {}'.format(stage, corpus, _ms(seconds)))
+        sys.stdout.flush()
+
+    commit, dirty = git_commit()
+    if opts.save:
+        save({
+            'commit': commit,
+            'dirty': dirty,
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'results': results,
+        }, opts.results)
+
+    if base is None:
+        return 0
+
+    print()
+    print('Compared with {} ({}{})'.format(base['commit'], base['time'], ', dirty' if base['dirty'] else ''))
+    regressions = 0
+    for stage, corpus, before, after, ratio, bad in compare(results, base['results'], opts.threshold):
+        if bad:
+            regressions += 1
+        print('{:26s} {:40s} {} {} {:6.2f}x{}'.format(
+            stage, corpus, _ms(before), _ms(after), ratio, '  REGRESSION' if bad else ''))
+    print('{} regressions'.format(regressions))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    import doctest
+    if doctest.testmod().failed > 0:
+        sys.exit(1)
+    sys.exit(main(sys.argv))
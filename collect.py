@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+
+# Gathers the data the tools work from by running all the commands at once.
+#
+# `lspci -vvv` alone takes seconds on a big box, so rather than waiting for
+# each command in turn they are all started together under asyncio and each
+# one's output is handed to its parser a line at a time while the others are
+# still running.  A snapshot file of the same name in the directory (as
+# written by main) is used instead of running the command.
+
+TIMEOUT = 60
+
+
+class Text:
+    """Keeps the output as a string."""
+
+    def __init__(self):
+        self.lines = []
+
+    def feed(self, line):
+        self.lines.append(line)
+
+    def load(self, path):
+        with open(path, encoding='utf-8') as f:
+            self.lines = [f.read()]
+
+    def result(self):
+        return ''.join(self.lines)
+
+
+# name (and snapshot file): (command, parser)
+SOURCES = {
+    'iomem': (('sudo', 'cat', '/proc/iomem'), Text),
+    'lspci': (('lspci', '-PPP'), Text),
+    # Not collected by the tools, but snapshotted by main for lspci.py.
+    'lspci.vvv': (('lspci', '-vvv'), Text),
+}
+
+
+async def run(cmd, parser, timeout=TIMEOUT):
+    """
+    Runs `cmd`, feeding each line of its output to `parser`.  The command is
+    killed if it hasn't finished after `timeout` seconds.
+
+    >>> t = Text()
+    >>> asyncio.run(run(['printf', 'a\\\\nb\\\\n'], t))
+    >>> t.result()
+    'a\\nb\\n'
+    >>> asyncio.run(run(['sleep', '10'], Text(), timeout=0.1))
+    Traceback (most recent call last):
+        ...
+    TimeoutError: sleep 10 took longer than 0.1s
+    """
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE, limit=1 << 20)
+    try:
+        async def read():
+            async for line in proc.stdout:
+                parser.feed(line.decode('utf-8', 'replace'))
+            return await proc.wait()
+
+        try:
+            returncode = await asyncio.wait_for(read(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError('{} took longer than {}s'.format(' '.join(cmd), timeout)) from None
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+
+
+async def collect_async(names, directory='.', timeout=TIMEOUT, sources=SOURCES):
+    parsers = {}
+    pending = []
+    for name in names:
+        cmd, cls = sources[name]
+        parser = parsers[name] = cls()
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            parser.load(path)
+        else:
+            pending.append(run(cmd, parser, timeout))
+    # The first failure cancels (and so kills) the rest.
+    tasks = [asyncio.ensure_future(p) for p in pending]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return {name: p.result() for name, p in parsers.items()}
+
+
+def collect(names, directory='.', timeout=TIMEOUT, sources=SOURCES):
+    """
+    Returns `{name: result}` for each of the SOURCES `names`, from the
+    snapshot files in `directory` or else running all the commands at once.
+    """
+    return asyncio.run(collect_async(names, directory, timeout, sources))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Snapshot the output of every data source into a directory, running them all at once.')
+    parser.add_argument('directory', help='where to write the snapshot files (existing ones are kept)')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT, help='seconds to give each command')
+    opts = parser.parse_args(args[1:])
+
+    os.makedirs(opts.directory, exist_ok=True)
+    data = collect(list(SOURCES), opts.directory, opts.timeout)
+    for name, text in data.items():
+        path = os.path.join(opts.directory, name)
+        if not os.path.exists(path):
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            print(path)
+    return 0
+
+
+if __name__ == "__main__":
+    import doctest
+    if doctest.testmod().failed > 0:
+        sys.exit(1)
+    sys.exit(main(sys.argv))
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+import lspci
+import topology
+
+# Vectorized sanity checks over every enabled BAR and bridge window.
+#
+# All the regions are loaded into flat NumPy arrays once, so the checks are a
+# handful of sorts and array comparisons rather than Python loops over
+# thousands of regions (per host, for a whole fleet).
+
+MEMORY = 0
+IO = 1
+
+# Bridge window kinds, used as the column of RegionTable.windows.
+W_IO = 0
+W_MEM = 1
+W_PREF = 2
+
+
+class RegionTable:
+    """
+    The enabled regions of `devices` as parallel arrays, one row per BAR or
+    bridge window.
+
+      start, end - inclusive address range.
+      space      - MEMORY or IO.
+      kind       - W_IO, W_MEM or W_PREF; for a BAR the kind of bridge window
+                   it should be allocated from.
+      window     - True for bridge windows, False for BARs.
+      owner      - index into `devices` of the device the region belongs to.
+      parent     - index into `devices` of the bridge above the owner, or -1.
+      bus        - (domain << 8 | bus) of the owner.
+
+    `windows[d, kind]` is the row of the `kind` window of bridge `d`, or -1.
+    """
+
+    def __init__(self, devices):
+        self.devices = devices
+
+        t = topology.from_lspci(devices)
+        nodes = [t[lspci.parse_bdf(name)] for name, _ in devices]
+        position = {d.bdf: i for i, d in enumerate(nodes)}
+
+        rows = []
+        for i, (name, details) in enumerate(devices):
+            d = nodes[i]
+            parent = position[d.parent.bdf] if d.parent is not None else -1
+            busid = d.domain << 8 | d.bus
+
+            regions = [(r, 'BAR') for r in details.get('Regions', [])]
+            for cap in details.get('Capabilities', []):
+                regions.extend((r, 'VF BAR') for r in cap.regions)
+            for r, what in regions:
+                if r.disabled or r.size is None or r.address < 0:
+                    continue
+                if r.rtype == 'I/O ports':
+                    space, kind = IO, W_IO
+                elif r.prefetchable and r.bits == 64:
+                    space, kind = MEMORY, W_PREF
+                else:
+                    space, kind = MEMORY, W_MEM
+                index = 'ROM' if r.region is None else r.region
+                rows.append((r.start, r.end, space, kind, False, i, parent, busid, '{} {}'.format(what, index)))
+
+            for r in details.get('BridgeRegions', []):
+                if r.disabled:
+                    continue
+                if r.type == 'i/o':
+                    space, kind = IO, W_IO
+                elif not r.prefetchable:
+                    # BridgeRegion.prefetchable is True for the non-prefetchable window.
+                    space, kind = MEMORY, W_PREF
+                else:
+                    space, kind = MEMORY, W_MEM
+                what = {W_IO: 'I/O window', W_MEM: 'memory window', W_PREF: 'prefetchable window'}[kind]
+                rows.append((r.start, r.end, space, kind, True, i, parent, busid, what))
+
+        columns = list(zip(*rows)) or [()] * 9
+        self.start = np.array(columns[0], dtype=np.uint64)
+        self.end = np.array(columns[1], dtype=np.uint64)
+        self.space = np.array(columns[2], dtype=np.int8)
+        self.kind = np.array(columns[3], dtype=np.int8)
+        self.window = np.array(columns[4], dtype=bool)
+        self.owner = np.array(columns[5], dtype=np.int32)
+        self.parent = np.array(columns[6], dtype=np.int32)
+        self.bus = np.array(columns[7], dtype=np.int32)
+        self.what = columns[8]
+
+        self.windows = np.full((max(len(devices), 1), 3), -1, dtype=np.int64)
+        w = np.flatnonzero(self.window)
+        self.windows[self.owner[w], self.kind[w]] = w
+
+    def __len__(self):
+        return len(self.start)
+
+    @property
+    def size(self):
+        return self.end - self.start + np.uint64(1)
+
+    def label(self, row):
+        return '{} {} [{:x}-{:x}]'.format(
+            self.devices[self.owner[row]][0].split(' ', 1)[0],
+            self.what[row], int(self.start[row]), int(self.end[row]))
+
+
+def overlapping(group, start, end):
+    """
+    Returns index arrays `(i, j)` such that interval `i` overlaps the earlier
+    interval `j` of the same `group`.
+
+    >>> i, j = overlapping(
+    ...     np.array([0, 0, 0, 1]),
+    ...     np.array([0, 50, 200, 60], dtype=np.uint64),
+    ...     np.array([99, 149, 299, 70], dtype=np.uint64))
+    >>> list(zip(i.tolist(), j.tolist()))
+    [(1, 0)]
+    """
+    n = len(start)
+    if not n:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    order = np.lexsort((start, group))
+    _, g = np.unique(group[order], return_inverse=True)
+
+    # A single running maximum over the whole array only works if the end
+    # addresses of a group always compare above those of the groups before
+    # it, so both starts and ends are replaced by their rank and offset by
+    # the group number.
+    values, ranks = np.unique(np.concatenate((start[order], end[order])), return_inverse=True)
+    offset = g.astype(np.int64) * len(values)
+    skey = offset + ranks[:n]
+    ekey = offset + ranks[n:]
+
+    running = np.maximum.accumulate(ekey)
+    argmax = np.maximum.accumulate(np.where(ekey == running, np.arange(n), 0))
+
+    hit = np.flatnonzero(running[:-1] >= skey[1:]) + 1
+    return order[hit], order[argmax[hit - 1]]
+
+
+def find_overlaps(table):
+    """Pairs of rows whose regions collide."""
+    found = set()
+
+    # Everything directly on one bus (BARs and the windows of the bridges on
+    # it) has to be disjoint.
+    i, j = overlapping(table.bus.astype(np.int64) * 2 + table.space, table.start, table.end)
+    found.update(zip(i.tolist(), j.tolist()))
+
+    # BARs have to be disjoint across the whole system too.
+    bars = np.flatnonzero(~table.window)
+    i, j = overlapping(table.space[bars], table.start[bars], table.end[bars])
+    found.update(zip(bars[i].tolist(), bars[j].tolist()))
+
+    return sorted(found)
+
+
+def _allowed_windows(table):
+    """The first and second choice parent window row for every row."""
+    parent = np.where(table.parent >= 0, table.parent, 0)
+    first = np.where(table.parent >= 0, table.windows[parent, table.kind], -1)
+    # Prefetchable regions can also live in the non-prefetchable window.
+    second_kind = np.where(table.kind == W_PREF, W_MEM, table.kind)
+    second = np.where(table.parent >= 0, table.windows[parent, second_kind], -1)
+    return first, second
+
+
+def _inside(table, rows):
+    w = np.where(rows >= 0, rows, 0)
+    return (rows >= 0) & (table.start >= table.start[w]) & (table.end <= table.end[w])
+
+
+def find_outside(table):
+    """Rows which aren't inside a suitable window of their parent bridge."""
+    first, second = _allowed_windows(table)
+    ok = _inside(table, first) | _inside(table, second)
+    return np.flatnonzero((table.parent >= 0) & ~ok).tolist()
+
+
+def find_undersized(table):
+    """
+    Returns `(row, needed)` for the bridge windows which are smaller than the
+    total size of the regions which should be allocated from them.
+    """
+    first, second = _allowed_windows(table)
+    target = np.where(first >= 0, first, second)
+    children = np.flatnonzero(target >= 0)
+
+    needed = np.zeros(len(table), dtype=np.uint64)
+    np.add.at(needed, target[children], table.size[children])
+
+    small = np.flatnonzero(table.window & (needed > table.size))
+    return [(row, int(needed[row])) for row in small.tolist()]
+
+
+def check(devices):
+    """
+    >>> devices = lspci.parse_lspci_output(
+    ...     "00:01.0 PCI bridge: Intel Corporation Root Port 1\\n"
+    ...     "\\tBus: primary=00, secondary=01, subordinate=01, sec-latency=0\\n"
+    ...     "\\tMemory behind bridge: 90000000-900fffff [size=1M] [32-bit]\\n"
+    ...     "\\n"
+    ...     "00:02.0 SATA controller: Intel Corporation SATA\\n"
+    ...     "\\tRegion 0: Memory at 90080000 (32-bit, non-prefetchable) [size=8K]\\n"
+    ...     "\\n"
+    ...     "01:00.0 Ethernet controller: Intel Corporation I350\\n"
+    ...     "\\tRegion 0: Memory at 90000000 (32-bit, non-prefetchable) [size=512K]\\n"
+    ...     "\\tRegion 3: Memory at 90100000 (32-bit, non-prefetchable) [size=512K]\\n"
+    ...     "\\tRegion 4: Memory at 90080000 (32-bit, non-prefetchable) [size=16K]\\n"
+    ...     "\\n")
+    >>> for problem in check(devices):
+    ...     print(*problem)
+    overlap 00:02.0 BAR 0 [90080000-90081fff] 00:01.0 memory window [90000000-900fffff]
+    overlap 01:00.0 BAR 4 [90080000-90083fff] 00:02.0 BAR 0 [90080000-90081fff]
+    outside 01:00.0 BAR 3 [90100000-9017ffff] 00:01.0 memory window [90000000-900fffff]
+    undersized 00:01.0 memory window [90000000-900fffff] needs at least 1064960 bytes
+    """
+    table = RegionTable(devices)
+    problems = []
+
+    for i, j in find_overlaps(table):
+        problems.append(('overlap', table.label(i), table.label(j)))
+
+    first, second = _allowed_windows(table)
+    for row in find_outside(table):
+        w = first[row] if first[row] >= 0 else second[row]
+        if w >= 0:
+            where = table.label(w)
+        else:
+            where = '{} (no window)'.format(table.devices[table.parent[row]][0].split(' ', 1)[0])
+        problems.append(('outside', table.label(row), where))
+
+    for row, needed in find_undersized(table):
+        problems.append(('undersized', table.label(row), 'needs at least {} bytes'.format(needed)))
+
+    return problems
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
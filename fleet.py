@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import sys
+
+import addrmap
+import lspci
+
+# Snapshot directories hold the output of the collection commands for one
+# host, see 4028GR-TVRT/, 6049P/ and ThinkStation-P920/.
+LSPCI_FILES = ('lspci.vvv', 'lspci.full')
+
+
+def discover(roots):
+    """
+    Yields every directory below `roots` which contains an lspci -vvv dump.
+
+    >>> top = os.path.dirname(os.path.abspath(__file__))
+    >>> sorted(os.path.basename(d) for d in discover([top]))
+    ['4028GR-TVRT', '6049P', 'ThinkStation-P920']
+    """
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+            if any(f in filenames for f in LSPCI_FILES):
+                yield dirpath
+
+
+def summarize_host(path):
+    """
+    Parses the snapshot in directory `path` and returns a small summary dict,
+    so only the summary has to be sent back from the worker process.
+    """
+    for f in LSPCI_FILES:
+        lspci_path = os.path.join(path, f)
+        if os.path.exists(lspci_path):
+            break
+    with open(lspci_path, 'rb') as f:
+        devices = lspci.cached_parse(f.read())
+
+    summary = {
+        'host': os.path.basename(os.path.abspath(path)),
+        'path': path,
+        'devices': len(devices),
+        'bridges': 0,
+        'regions': 0,
+        'enabled_regions': 0,
+        'bridge_windows': 0,
+        'bar_bytes': 0,
+        'downgraded_links': 0,
+        'drivers': collections.Counter(),
+        'iomem': None,
+        'ioports': None,
+    }
+
+    for name, details in devices:
+        if lspci.bridge_buses(details):
+            summary['bridges'] += 1
+        for r in details.get('Regions', []):
+            summary['regions'] += 1
+            if not r.disabled:
+                summary['enabled_regions'] += 1
+                if r.size and r.rtype != 'I/O ports':
+                    summary['bar_bytes'] += r.size
+        summary['bridge_windows'] += len(details.get('BridgeRegions', []))
+
+        driver = details.get('Kernel driver in use', None)
+        if driver:
+            summary['drivers'][driver] += 1
+
+        for cap in details.get('Capabilities', []):
+            sta = cap.properties.get('LnkSta', None)
+            if isinstance(sta, dict) and 'downgraded' in '{} {}'.format(sta.get('Speed'), sta.get('Width')):
+                summary['downgraded_links'] += 1
+
+    for f in ('iomem', 'ioports'):
+        try:
+            with open(os.path.join(path, f)) as data:
+                summary[f] = sum(1 for _ in addrmap.iter_iomem(data.read()))
+        except FileNotFoundError:
+            pass
+
+    return summary
+
+
+def ingest(paths, jobs=None):
+    """Summarizes each snapshot directory in `paths` in a pool of processes."""
+    paths = list(paths)
+    if jobs == 1 or len(paths) <= 1:
+        return [summarize_host(p) for p in paths]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(summarize_host, paths))
+
+
+def aggregate(summaries):
+    total = collections.Counter()
+    drivers = collections.Counter()
+    for s in summaries:
+        for k, v in s.items():
+            if k in ('host', 'path', 'drivers'):
+                continue
+            if v is not None:
+                total[k] += v
+        drivers.update(s['drivers'])
+    return {'hosts': len(summaries), 'total': dict(total), 'drivers': dict(drivers.most_common())}
+
+
+COLUMNS = (
+    ('host', 'Host'),
+    ('devices', 'Devices'),
+    ('bridges', 'Bridges'),
+    ('regions', 'Regions'),
+    ('enabled_regions', 'Enabled'),
+    ('bridge_windows', 'Windows'),
+    ('bar_bytes', 'BAR bytes'),
+    ('downgraded_links', 'Downgraded'),
+    ('iomem', 'iomem'),
+    ('ioports', 'ioports'),
+)
+
+
+def print_report(summaries, report):
+    rows = [[str(s[k]) if s[k] is not None else '-' for k, _ in COLUMNS] for s in summaries]
+    rows.append(['TOTAL ({} hosts)'.format(report['hosts'])] +
+                [str(report['total'].get(k, '-')) for k, _ in COLUMNS[1:]])
+    header = [h for _, h in COLUMNS]
+    widths = [max(len(r[i]) for r in rows + [header]) for i in range(len(header))]
+
+    def line(cells):
+        return ' | '.join(c.ljust(w) if i == 0 else c.rjust(w) for i, (c, w) in enumerate(zip(cells, widths)))
+
+    print(line(header))
+    print('-+-'.join('-'*w for w in widths))
+    for r in rows[:-1]:
+        print(line(r))
+    print('-+-'.join('-'*w for w in widths))
+    print(line(rows[-1]))
+    print()
+    print('Drivers')
+    for driver, count in report['drivers'].items():
+        print('   {:6d} {}'.format(count, driver))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Parse every snapshot directory below ROOT in parallel.')
+    parser.add_argument('roots', nargs='*', default=['.'], metavar='ROOT')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: one per CPU)')
+    parser.add_argument('--json', action='store_true', help='print the summaries as JSON')
+    opts = parser.parse_args(args[1:])
+
+    summaries = ingest(discover(opts.roots), jobs=opts.jobs)
+    report = aggregate(summaries)
+
+    if opts.json:
+        json.dump({'hosts': summaries, 'report': report}, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(summaries, report)
+    return 0
+
+
+if __name__ == "__main__":
+    import doctest
+    if doctest.testmod().failed > 0:
+        sys.exit(1)
+    sys.exit(main(sys.argv))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import contextlib
+import json
+import sys
+import time
+import tracemalloc
+
+# Opt-in timing of the stages of the parsers and reports.
+#
+# The parsers mark their stages with `with instrument.stage(name, *key):`,
+# where the key says what the stage is working on (a device, a capability of
+# a device).  Nothing is recorded unless a Profiler is active, in which case
+# each stage's wall time, call count and the bytes it allocated (and didn't
+# free) are added to the stage's totals and to those of its key, so when one
+# host's dump is slow to parse the report shows which device and capability
+# it was.
+#
+#   with instrument.profiling() as prof:
+#       lspci.parse_lspci_output(data)
+#   prof.write('profile.json')
+#
+# Stages nest (parse_device includes the parse_cap_properties of its
+# capabilities), so their totals overlap.  Tracing the allocations slows
+# everything down a little; Profiler(memory=False) leaves it off.
+
+_NULL = contextlib.nullcontext()
+
+# The Profiler stage() records to, if any.
+active = None
+
+
+class Stats:
+    __slots__ = ('calls', 'seconds', 'bytes')
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def add(self, seconds, nbytes):
+        self.calls += 1
+        self.seconds += seconds
+        self.bytes += nbytes
+
+    def as_dict(self):
+        return {'calls': self.calls, 'seconds': self.seconds, 'bytes': self.bytes}
+
+
+class Profiler:
+    """
+    >>> prof = Profiler(memory=False)
+    >>> with prof.stage('parse_device', '00:01.0'):
+    ...     for cap in ('[40] Express', '[100] AER'):
+    ...         with prof.stage('parse_cap_properties', '00:01.0', cap):
+    ...             pass
+    >>> report = prof.report()
+    >>> {name: s['calls'] for name, s in report['stages'].items()}
+    {'parse_cap_properties': 2, 'parse_device': 1}
+    >>> [(i['stage'], i['key']) for i in report['items']][:1]
+    [('parse_device', ['00:01.0'])]
+    """
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.stages = {}
+        self.items = {}
+        self.start = None
+        self.seconds = 0.0
+        self._started_tracing = False
+
+    def __enter__(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds += time.perf_counter() - self.start
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    @contextlib.contextmanager
+    def stage(self, name, *key):
+        memory = self.memory and tracemalloc.is_tracing()
+        before = tracemalloc.get_traced_memory()[0] if memory else 0
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            nbytes = tracemalloc.get_traced_memory()[0] - before if memory else 0
+            s = self.stages.get(name)
+            if s is None:
+                s = self.stages[name] = Stats()
+            s.add(seconds, nbytes)
+            if key:
+                k = (name,) + key
+                s = self.items.get(k)
+                if s is None:
+                    s = self.items[k] = Stats()
+                s.add(seconds, nbytes)
+
+    def report(self, top=None):
+        """
+        The totals as `{"seconds", "stages": {name: stats}, "items": [...]}`,
+        where the items (stage, key and stats) are the slowest first, `top` of
+        them at most.
+        """
+        items = sorted(self.items.items(), key=lambda i: -i[1].seconds)
+        if top is not None:
+            items = items[:top]
+        return {
+            'seconds': self.seconds,
+            'memory': self.memory,
+            'stages': {name: s.as_dict() for name, s in self.stages.items()},
+            'items': [dict(stage=k[0], key=list(k[1:]), **s.as_dict()) for k, s in items],
+        }
+
+    def write(self, out=None, top=None):
+        """Writes the report as JSON to `out` (a file object or a path, stderr by default)."""
+        data = json.dumps(self.report(top), indent=1) + '\n'
+        if out is None:
+            out = sys.stderr
+        if isinstance(out, str):
+            with open(out, 'w', encoding='utf-8') as f:
+                f.write(data)
+        else:
+            out.write(data)
+
+
+def stage(name, *key):
+    """A context manager timing `name` (for `key`) if profiling, else doing nothing."""
+    if active is None:
+        return _NULL
+    return active.stage(name, *key)
+
+
+@contextlib.contextmanager
+def profiling(memory=True):
+    """Records the stages run inside it to the Profiler it returns."""
+    global active
+    previous = active
+    prof = active = Profiler(memory)
+    try:
+        with prof:
+            yield prof
+    finally:
+        active = previous
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
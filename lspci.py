@@ -1,6 +1,13 @@
 #!/usr/bin/env python3
 
+import argparse
+import enum
+import functools
+import hashlib
+import io
+import json
 import os
+import pickle
 import re
 import shutil
 import sys
@@ -9,6 +16,13 @@ from typing import Optional
 from pprint import pprint as _pprint
 from dataclasses import dataclass, field
 
+import addrmap
+import instrument
+import query
+import render
+
+from render import twidth
+
 # Each non-bridge PCI device function can implement up to 6 BARs, each of which
 # can respond to different addresses in I/O port and memory-mapped address
 # space.
@@ -24,14 +38,6 @@ from dataclasses import dataclass, field
 # BAR6: PCI ROM aperture
 
 
-def twidth():
-    w = os.environ.get('WIDTH', None)
-    if w:
-        return int(w)
-    t = os.get_terminal_size(0)
-    return t.columns
-
-
 def pprint(*args, **kw):
     kw['width'] = twidth()
     kw['compact'] = False
@@ -62,7 +68,40 @@ F = 0xffffffffffff
 M = len('39c000000000')
 
 
-def pmem(region, i=0):
+def _count(region):
+    return sum(1 + _count(d) for k, d in region.items() if k != (0, 0))
+
+
+def pmem(region, i=0, out=None):
+    """
+    Renders the parents() tree `region` as a table to the render.Renderer
+    `out`, or straight to stdout.  Rows deeper than `out.max_depth` are
+    collapsed into their parent row, which shows how many were hidden.
+
+    >>> tree = {}
+    >>> for start, end, name in [
+    ...         (0x90000000, 0x92ffffff, '00:02.0'), (0x90000000, 0x90ffffff, '0b:00.0'),
+    ...         (0x90000000, 0x90ffffff, '0d:00.0'), (0x91000000, 0x91ffffff, '0e:00.0')]:
+    ...     parents(start, end, tree).setdefault((0, 0), []).append(name)
+    >>> out = render.Renderer(width=100)
+    >>> pmem(tree, out=out)
+    >>> out.write()
+    |        Start          End        |         Size | Device
+    |  000090000000 000092ffffff       |      3000000 |  00:02.0
+    |   000090000000 000090ffffff      |      1000000 |   0b:00.0 && 0d:00.0
+    |   000091000000 000091ffffff      |      1000000 |   0e:00.0
+    >>> out = render.Renderer(width=100, max_depth=1)
+    >>> pmem(tree, out=out)
+    >>> out.write()
+    |        Start          End        |         Size | Device
+    |  000090000000 000092ffffff       |      3000000 |  [+2] 00:02.0
+    """
+    if out is None:
+        out = render.Renderer()
+        pmem(region, i, out)
+        out.write()
+        return
+
     # '|',    == 1+1
     # p1,     == 5+1
     # hstart, == M+1
@@ -75,11 +114,12 @@ def pmem(region, i=0):
     S = 1+1 + 5+1 + M+1 + M+1 + 0+1 + 1+1 + M+1 + 1+1 + 5+1 + 1
 
     def print_header():
-        print('|', lpad('Start', ' ', M), lpad('End', ' ', M), '      ', '|', lpad('Size', ' ', M), '|', "Device")
+        out.line('|', 'Start'.rjust(M), 'End'.rjust(M), '      ', '|', 'Size'.rjust(M), '|', "Device")
     if i == 0:
         print_header()
 
     rend = [F]
+    collapsed = out.collapsed(i)
 
     for (istart, iend), d in region.items():
         if (istart, iend) == (0, 0):
@@ -87,34 +127,37 @@ def pmem(region, i=0):
 
         isize = iend-istart+1
 
-        hstart = lpad(hex(istart)[2:], '0', M)
-        hend   = lpad(hex(iend)[2:], '0', M)
-        hsize  = lpad(hex(isize)[2:], ' ', M)
+        hstart = render.hexpad(istart, M)
+        hend   = render.hexpad(iend, M)
+        hsize  = render.hexpad(isize, M, ' ')
 
         info = d.get((0, 0), [])
 
         if 'DMI2' in repr(info) or 'Root Port' in repr(info):
-            print()
-            print()
+            out.line()
+            out.line()
             print_header()
             rend[0] = iend+1
         elif istart >= rend[0]:
-            print()
-            print()
+            out.line()
+            out.line()
             print_header()
             rend[0] = F
 
         p1 = ' '*i
         p2 = ' '*(5-i)
 
-        sinfo = " && ".join(info)[:twidth()-S]
+        sinfo = " && ".join(info)
+        if collapsed and len(d) > 1:
+            sinfo = '[+{}] {}'.format(_count(d), sinfo)
+        sinfo = sinfo[:out.width-S]
 
-        print('|', p1, hstart, hend, p2, '|', hsize, '|', p1, sinfo) #" && ".join(info))
+        out.line('|', p1, hstart, hend, p2, '|', hsize, '|', p1, sinfo) #" && ".join(info))
 
-        if len(d) == 1:
+        if len(d) == 1 or collapsed:
             continue
 
-        pmem(d, i+1)
+        pmem(d, i+1, out)
 
 
 def lpad(s, n, l):
@@ -213,8 +256,72 @@ class HexInt(int):
         return hex(self)
 
 
-@dataclass(eq=True, order=True, unsafe_hash=True)
+class RegionFlags(enum.IntFlag):
+    """
+    The flags of a Region or BridgeRegion, one bit each so the predicates
+    don't have to search lists of strings.  The low bits match the reg.flags
+    column of snapshot.py.
+
+    >>> Region('Memory', 0, HexInt(0), 4096, flags=['disabled'], props=['64-bit', 'prefetchable']).mask
+    <RegionFlags.DISABLED|PREFETCHABLE|BITS64: 37>
+    """
+    DISABLED = 1 << 0
+    VIRTUAL = 1 << 1
+    PREFETCHABLE = 1 << 2
+    NON_PREFETCHABLE = 1 << 3
+    BITS32 = 1 << 4
+    BITS64 = 1 << 5
+    # Only used by snapshot.py.
+    UNASSIGNED = 1 << 6
+    NO_SIZE = 1 << 7
+    BITS16 = 1 << 8
+    LOW_1M = 1 << 9
+
+
+# The `[flags]` and `(props)` of a Region, in the order lspci prints them.
+REGION_FLAGS = (
+    ('virtual', RegionFlags.VIRTUAL),
+    ('disabled', RegionFlags.DISABLED),
+)
+REGION_PROPS = (
+    ('32-bit', RegionFlags.BITS32),
+    ('64-bit', RegionFlags.BITS64),
+    ('low-1M', RegionFlags.LOW_1M),
+    ('prefetchable', RegionFlags.PREFETCHABLE),
+    ('non-prefetchable', RegionFlags.NON_PREFETCHABLE),
+)
+_REGION_FLAG_BITS = {n: int(bit) for n, bit in REGION_FLAGS}
+_REGION_PROP_BITS = {n: int(bit) for n, bit in REGION_PROPS}
+
+# Plain ints for the predicates, as IntFlag operators are slow.
+_DISABLED = int(RegionFlags.DISABLED)
+_VIRTUAL = int(RegionFlags.VIRTUAL)
+_PREFETCHABLE = int(RegionFlags.PREFETCHABLE)
+_NON_PREFETCHABLE = int(RegionFlags.NON_PREFETCHABLE)
+_BITS16 = int(RegionFlags.BITS16)
+_BITS32 = int(RegionFlags.BITS32)
+_BITS64 = int(RegionFlags.BITS64)
+
+
+# Every Region with the same flags (or props) shares one list, so don't
+# change them in place.
+_NAMES = {}
+
+
+def _shared(names):
+    key = tuple(names)
+    l = _NAMES.get(key, None)
+    if l is None:
+        l = _NAMES[key] = list(key)
+    return l
+
+
+@dataclass(eq=True, order=True, unsafe_hash=True, slots=True)
 class Region:
+    """
+    A BAR.  The predicates test the RegionFlags bits of `mask` rather than
+    searching `flags` and `props`.
+    """
     rtype: str
     region: int = field(compare=False)
     address: HexInt
@@ -223,27 +330,43 @@ class Region:
     flags: Optional[list] = field(compare=False, default_factory=list)
     props: Optional[list] = field(compare=False, default_factory=list)
 
+    _mask: int = field(init=False, repr=False, compare=False, default=0)
+
+    def __post_init__(self):
+        mask = 0
+        for f in self.flags:
+            mask |= _REGION_FLAG_BITS.get(f, 0)
+        for p in self.props:
+            mask |= _REGION_PROP_BITS.get(p, 0)
+        self._mask = mask
+        self.flags = _shared(self.flags)
+        self.props = _shared(self.props)
+
+    @property
+    def mask(self):
+        return RegionFlags(self._mask)
+
     @property
     def bits(self):
-        if '64-bit' in self.props:
+        if self._mask & _BITS64:
             return 64
-        if '32-bit' in self.props:
+        if self._mask & _BITS32:
             return 32
         return -1
 
     @property
     def disabled(self):
-        return 'disabled' in self.flags
+        return bool(self._mask & _DISABLED)
 
     @property
     def virtual(self):
-        return 'virtual' in self.flags
+        return bool(self._mask & _VIRTUAL)
 
     @property
     def prefetchable(self):
-        if 'prefetchable' in self.props:
+        if self._mask & _PREFETCHABLE:
             return True
-        if 'non-prefetchable' in self.props:
+        if self._mask & _NON_PREFETCHABLE:
             return False
         return None
 
@@ -261,8 +384,21 @@ class Region:
         return self.address, self.end
 
 
-@dataclass(eq=True, order=True, unsafe_hash=True)
+_WINDOW_BITS = {
+    None: 0,
+    16: _BITS16,
+    32: _BITS32,
+    64: _BITS64,
+}
+
+
+@dataclass(eq=True, order=True, unsafe_hash=True, slots=True)
 class BridgeRegion:
+    """
+    A bridge window.  Note `prefetchable` is True for the I/O and (non
+    prefetchable) memory windows and False for the prefetchable one; `mask`
+    has the real PREFETCHABLE / NON_PREFETCHABLE bit.
+    """
     prefetchable: bool
     type: str
 
@@ -273,6 +409,14 @@ class BridgeRegion:
     disabled: bool
     bits: int
 
+    @property
+    def mask(self):
+        mask = _WINDOW_BITS[self.bits]
+        mask |= _NON_PREFETCHABLE if self.prefetchable else _PREFETCHABLE
+        if self.disabled:
+            mask |= _DISABLED
+        return RegionFlags(mask)
+
     @property
     def range(self):
         return self.start, self.end
@@ -305,6 +449,32 @@ class Capability:
     properties: list = field(hash=False)
     regions: Optional[list[Region]] = field(hash=False, default_factory=list)
 
+    def defer_properties(self, lines, *key):
+        """
+        Keeps the property `lines`, which are decoded when first used (timed
+        by the instrument module as parse_cap_properties of `key`).
+        """
+        self.__dict__.pop('properties', None)
+        self._raw = (lines, key)
+
+    def __getattr__(self, name):
+        # Only called when `properties` hasn't been set, or decoded yet.
+        raw = self.__dict__.get('_raw', None)
+        if name != 'properties' or raw is None:
+            raise AttributeError(name)
+        lines, key = raw
+        with instrument.stage('parse_cap_properties', *key):
+            self.properties = parse_cap_properties(lines)
+        del self._raw
+        return self.properties
+
+    def registers(self):
+        """The names of the registers in `properties`, without decoding them."""
+        if 'properties' in self.__dict__:
+            return list(self.properties)
+        lines, _ = self._raw
+        return list(dict.fromkeys(p.split(': ', 1)[0] for p in lines if isinstance(p, str) and ': ' in p))
+
 
 def convert_size_to_bytes(size: str) -> int:
     """
@@ -574,100 +744,163 @@ RE_COLON_SPACE_CONT = re.compile('^\t+ ')
 RE_COLON_TAB_CONT   = re.compile('^\t+')
 
 
+# The normalizations done by _fixup, keyed by the token which triggers them.
+_FIXUPS = {
+    'Capabilities: ': 'Capabilities:\t',
+    'BridgeCtl: ': 'BridgeCtl:\t',
+    'Read-only fields:': 'Read only fields:\t',
+    'Expansion ROM at ': 'Region E: Expansion ROM at ',
+    'bit, ': 'bit ',
+    'LN System CLS': 'LN-System-CLS',
+    'dB de-emphasis, ': 'dB de-emphasis ',
+    'dB de-emphasis; ': 'dB de-emphasis ',
+    'L1SubCtl2:\n': 'L1SubCtl2: \n',
+}
+
+# Only replaced when preceded by a space.
+_FIXUPS_SPACED = {
+    'CrosslinkRes: unsupported': 'CrosslinkRes=unsupported',
+    'Interrupt Message Number: ': 'Interrupt-Message-Number=',
+}
+
+# Every alternative starts with a literal character (rather than a space) so
+# the regex engine can skip ahead to candidate positions without trying each
+# alternative at every offset.
+RE_FIXUP = re.compile('|'.join(
+    [re.escape(t) for t in _FIXUPS] +
+    [re.escape(t) for t in _FIXUPS_SPACED] +
+    ['; ', ', (?=L1)', r'PME\(']))
+
+
 def _fixup(s):
-    # Convert the following into "colon-tab" setup.
-    s = s.replace('Capabilities: ', 'Capabilities:\t')
-    s = s.replace('BridgeCtl: ', 'BridgeCtl:\t')
-    s = s.replace('Read-only fields:', 'Read only fields:\t')
-
-    # Convert 'Expansion ROM at d0800000 [disabled] [size=256K]`
-    # to      'Region E: Expansion ROM at d0800000 [disabled] [size=256K]`
-    s = s.replace('Expansion ROM at ', 'Region E: Expansion ROM at ')
-
-    # Convert 'Region 0: Memory at 90330000 (32-bit, non-prefetchable) [disabled] [size=16K]'
-    # to      'Region 0: Memory at 90330000 (32-bit non-prefetchable) [disabled] [size=16K]'
-    s = s.replace('bit, ', 'bit ')
-    # Convert 'FRS- LN System CLS Not Supported, TPHComp+ ExtTPHComp- ARIFwd+'
-    # to      'FRS- LN System CLS Not Supported, TPHComp+ ExtTPHComp- ARIFwd+'
-    s = s.replace('LN System CLS', 'LN-System-CLS')
-	# Convert `LnkCtl: ASPM Disabled; RCB 64 bytes, Disabled- CommClk+`
-	# to      `LnkCtl: ASPM Disabled, RCB 64 bytes, Disabled- CommClk+`
-    s = s.replace('; ', ', ')
-    # Convert 'Exit Latency L0s <1us, L1 <4us'
-    # to      'Exit Latency L0s <1us L1 <4us'
-    s = s.replace(', L1', ' L1')
-
-    # Convert: `Flags: PMEClk- DSI- D1- D2- AuxCurrent=0mA PME(D0+,D1-,D2-,D3hot+,D3cold+)`
-    # to       `Flags: PMEClk- DSI- D1- D2- AuxCurrent=0mA, PME: D0+ D1- D2- D3hot+ D3cold+,`
-    def _fix_pme(match_obj):
-        f = match_obj.group(1).replace(",", " ")
-        return f', PME: {f}, '
-    s = re.sub(r' *PME\(([^\)]+)\) *', _fix_pme, s)
-
-    # Convert `Compliance Preset/De-emphasis: -6dB de-emphasis, 0dB preshoot`
-    # to      `Compliance Preset/De-emphasis: -6dB de-emphasis 0dB preshoot`
-    s = s.replace('dB de-emphasis, ', 'dB de-emphasis ')
-
-    # Convert ` CrosslinkRes: unsupported`
-    # to      ` CrosslinkRes=unsupported`
-    s = s.replace(' CrosslinkRes: unsupported', ' CrosslinkRes=unsupported')
-
-    # Convert ' Interrupt Message Number: '
-    # to      ' Interrupt-Message-Number='
-    s = s.replace(' Interrupt Message Number: ', ' Interrupt-Message-Number=')
-
-    # Convert 'L1SubCtl2:\n'
-    # to      'L1SubCtl2: Unsupported\n'
-    s = s.replace('L1SubCtl2:\n', 'L1SubCtl2: \n')
+    """
+    Normalizes the lspci output so it can be split into "name: value" pairs,
+    doing all the rewrites in a single scan over `s` (test_lspci.py checks it
+    against the chain of str.replace() calls it replaced).
+
+    >>> print(_fixup(
+    ...     "\\tExpansion ROM at d0800000 [disabled] [size=256K]\\n"
+    ...     "\\tCapabilities: [c8] Power Management version 3\\n"
+    ...     "\\t\\tFlags: PMEClk- DSI- D1- D2- AuxCurrent=0mA PME(D0+,D1-,D2-,D3hot+,D3cold+)\\n"
+    ...     "\\t\\tLnkCap:\\tPort #9, Speed 8GT/s, Width x1, ASPM L0s L1, Exit Latency L0s <1us, L1 <4us\\n"
+    ...     "\\t\\tLnkCtl:\\tASPM Disabled; RCB 64 bytes, Disabled- CommClk+\\n"
+    ...     "\\t\\tL1SubCtl2:\\n"
+    ...     "\\t\\t\\t Retimer- 2Retimers- CrosslinkRes: unsupported\\n"
+    ... ).expandtabs(1))
+     Region E: Expansion ROM at d0800000 [disabled] [size=256K]
+     Capabilities: [c8] Power Management version 3
+      Flags: PMEClk- DSI- D1- D2- AuxCurrent=0mA, PME: D0+ D1- D2- D3hot+ D3cold+, 
+      LnkCap: Port #9, Speed 8GT/s, Width x1, ASPM L0s L1, Exit Latency L0s <1us L1 <4us
+      LnkCtl: ASPM Disabled, RCB 64 bytes, Disabled- CommClk+
+      L1SubCtl2: 
+        Retimer- 2Retimers- CrosslinkRes=unsupported
+    <BLANKLINE>
+    """
+    out = []
+    pos = 0
+    for m in RE_FIXUP.finditer(s):
+        start, end = m.span()
+        if start < pos:
+            # Inside a PME(...) which has already been rewritten.
+            continue
+        token = m.group()
+        chunk = s[pos:start]
 
-    return s
+        if token == 'PME(':
+            # ' *PME\(([^\)]+)\) *'
+            close = s.find(')', end)
+            if close <= end:
+                continue
+            new = ', PME: ' + s[end:close].replace(',', ' ') + ', '
+            end = close + 1
+            while s.startswith(' ', end):
+                end += 1
+            chunk = chunk.rstrip(' ')
+            if not chunk and out:
+                out[-1] = out[-1].rstrip(' ')
+        elif token in _FIXUPS_SPACED:
+            if not chunk.endswith(' '):
+                continue
+            new = _FIXUPS_SPACED[token]
+        elif token[0] in ',;':
+            if s.startswith('L1', end):
+                new = ' '
+            else:
+                new = ', '
+        else:
+            new = _FIXUPS[token]
 
+        out.append(chunk)
+        out.append(new)
+        pos = end
+    out.append(s[pos:])
+    return ''.join(out)
 
-def undo_multiline(x):
+
+def _fold_continuations(lines):
     o = []
+    parts = None
     mode = None
-    while x:
-        l = x.pop(0)
+    for l in lines:
         if mode == 'colon-space' and RE_COLON_SPACE_CONT.search(l):
-            o[-1] += ', ' + l.strip()
+            parts.append(l.strip())
         elif RE_COLON_SPACE.search(l):
-            o.append(l)
+            parts = [l]
+            o.append(parts)
             mode = 'colon-space'
         elif RE_COLON_TAB.search(l):
             a, b = l.split(':\t', 1)
-            o.append(a+": "+b)
+            parts = [a+": "+b]
+            o.append(parts)
             mode = 'colon-tab'
         elif mode == 'colon-tab' and RE_COLON_TAB_CONT.search(l):
-            o[-1] += ', ' + l.strip()
+            parts.append(l.strip())
         else:
-            assert False, (l, mode, o[-1])
+            assert False, (l, mode, parts)
+    return [', '.join(parts) for parts in o]
 
-    x = o
-    o = [None]
-    while x:
-        l = x.pop(0)
 
-        if l.startswith('\t'):
-            if not isinstance(o[-1], list):
-                o[-1] = [o[-1], l[1:]]
-            else:
-                o[-1].append(l[1:])
-
-        if isinstance(o[-1], list) and (not l.startswith('\t') or not x):
-            o[-1] = undo_multiline(o[-1])
+def undo_multiline(x):
+    """
+    Joins wrapped continuation lines back onto the line they continue and
+    nests tab indented lines under the line above them.
+
+    Each line is visited once per indentation level, so the cost is linear in
+    the size of the block.
+
+    >>> undo_multiline([
+    ...     'Capabilities: [90] Express (v2) Root Port (Slot-), MSI 00',
+    ...     '\\tDevCap:\\tMaxPayload 128 bytes, PhantFunc 0',
+    ...     '\\t\\tExtTag- RBE+',
+    ...     '\\tDevCap2: Completion Timeout: Range BCD, TimeoutDis+',
+    ...     '\\t\\t 10BitTagComp- 10BitTagReq-',
+    ...     'Kernel driver in use: pcieport',
+    ... ])
+    [['Capabilities: [90] Express (v2) Root Port (Slot-), MSI 00', 'DevCap: MaxPayload 128 bytes, PhantFunc 0, ExtTag- RBE+', 'DevCap2: Completion Timeout: Range BCD, TimeoutDis+, 10BitTagComp- 10BitTagReq-'], 'Kernel driver in use: pcieport']
+    """
+    x = _fold_continuations(x)
 
-        if not l.startswith('\t'):
-            o.append(l)
+    o = []
+    i = 0
+    n = len(x)
+    while i < n:
+        j = i + 1
+        while j < n and x[j].startswith('\t'):
+            j += 1
+
+        if j - i > 1:
+            o.append(undo_multiline([x[i]] + [l[1:] for l in x[i+1:j]]))
+        else:
+            o.append(x[i])
+        i = j
 
-    return o[1:]
+    return o
 
 
 def group_device_lines(lines):
     devices = []
     current_device = None
-    while lines:
-        line = lines.pop(0)
-
+    for line in lines:
         if not line.strip():
             if current_device:
                 current_device[-1] = undo_multiline(current_device[-1])
@@ -681,179 +914,277 @@ def group_device_lines(lines):
         else:
             assert line[0] == '\t', repr(line)
             current_device[-1].append(line[1:])
-        continue
 
     return devices
 
 
+# Registers which are just a list of flags, with the boolean ones lspci shows.
 FLAGS = {
-    'Control': None,
-    'Status': None,
-    'BridgeCtl': None,
-    'Secondary status': None,
+    'Control': (
+        'I/O', 'Mem', 'BusMaster', 'SpecCycle', 'MemWINV', 'VGASnoop', 'ParErr', 'Stepping', 'SERR',
+        'FastB2B', 'DisINTx'),
+    'Status': (
+        'Cap', '66MHz', 'UDF', 'FastB2B', 'ParErr', '>TAbort', '<TAbort', '<MAbort', '>SERR', '<PERR',
+        'INTx'),
+    'BridgeCtl': (
+        'Parity', 'SERR', 'NoISA', 'VGA', 'VGA16', 'MAbort', '>Reset', 'FastB2B', 'PriDiscTmr',
+        'SecDiscTmr', 'DiscTmrStat', 'DiscTmrSERREn'),
+    'Secondary status': (
+        '66MHz', 'FastB2B', 'ParErr', '>TAbort', '<TAbort', '<MAbort', '<SERR', '<PERR'),
 }
 
 
+# The rewrites which turn the `Name value` fields of a flags string
+# into `Name=value` so everything else is a `Name+` or `Name-`.
+_FLAG_REWRITES = {
+    ' Not Supported': '=Unsupported',
+    ' not supported': '=Unsupported',
+    ' Disabled': '=Disabled',
+    ' Via ': '=Via-',
+    'PME ReqID ': 'PME-ReqID=',
+    'SlotPowerLimit ': 'SlotPowerLimit=',
+    'D0 ': 'D0+ ',
+    'D3 ': 'D3+ ',
+    'IntMsg ': 'IntMsg=',
+    'INT Msg #': 'IntMsg=',
+    'RP PIO Log ': 'RP-PIO-Log=',
+    'RP PIO ErrPtr:': 'RP-PIO-ErrPtr=',
+    'Trigger:': 'Trigger=',
+    'TriggerExt:': 'TriggerExt=',
+    'Reason:': 'Reason=',
+    'Slot #': 'Slot=#',
+    'PowerLimit ': 'PowerLimit=',
+}
+RE_FLAG_REWRITES = re.compile('|'.join(
+    re.escape(t) for t in sorted(_FLAG_REWRITES, key=len, reverse=True)))
 
-def parse_flags(l):
-    """
-    >>> parse_flags('I/O+ Mem+ BusMaster+ SpecCycle- MemWINV-')
-    {'I/O': True, 'Mem': True, 'BusMaster': True, 'SpecCycle': False, 'MemWINV': False}
+_FLAG_VALUES = {'-': False, '+': True}
 
-    >>> parse_flags(['I/O+ Mem+ BusMaster+', 'SpecCycle-'])
-    {'I/O': True, 'Mem': True, 'BusMaster': True, 'SpecCycle': False}
 
+@functools.lru_cache(maxsize=4096)
+def _decode_flags(l):
+    """
+    The `((name, value), ...)` of a flags string, with the names (and string
+    values) interned.  The same few lines repeat across every device of a
+    dump, so they are cached.
     """
-    if isinstance(l, list):
-        l = ' '.join(l)
-
     assert ', ' not in l, l
     assert ': ' not in l, l
 
-	# `LnkCap:	Port #9, Speed 8GT/s, Width x1, ASPM L0s L1, Exit Latency L0s <1us, L1 <4us`
     if 'ASPM ' in l:
         b = l.split(' ')
         assert b[0] == 'ASPM', (b, l)
         l = 'ASPM='+','.join(b[1:])
 
-	# `10BitTagComp- 10BitTagReq- OBFF Not Supported, ExtFmt- EETLPPrefix-`
-	# `EmergencyPowerReduction Not Supported, EmergencyPowerReductionInit-`
-    l = l.replace(' Not Supported','=Unsupported')
-	# `LnkCap:	Port #1, Speed 8GT/s, Width x8, ASPM not supported`
-    l = l.replace(' not supported','=Unsupported')
-	# `DevCtl2: Completion Timeout: 50us to 50ms, TimeoutDis- LTR- 10BitTagReq- OBFF Disabled,`
-	# `LnkCtl:	ASPM Disabled; RCB 64 bytes, Disabled- CommClk+`
-    l = l.replace(' Disabled', '=Disabled')
-    # `10BitTagComp- 10BitTagReq- OBFF Via message, ExtFmt- EETLPPrefix-`
-    l = l.replace(' Via ','=Via-')
-	# `RootSta: PME ReqID 0000, PMEStatus- PMEPending-`
-    l = l.replace('PME ReqID ','PME-ReqID=')
-	# `ExtTag- AttnBtn- AttnInd- PwrInd- RBE+ FLReset+ SlotPowerLimit 0W`
-    l = l.replace('SlotPowerLimit ', 'SlotPowerLimit=')
-    # `Status: D0 NoSoftRst+ PME-Enable- DSel=0 DScale=0 PME-`
-    l = l.replace('D0 ', 'D0+ ')
-	# `Status: D3 NoSoftRst- PME-Enable+ DSel=0 DScale=0 PME-`
-    l = l.replace('D3 ', 'D3+ ')
-    # `FirstFatal- NonFatalMsg- FatalMsg- IntMsg 0`
-    l = l.replace('IntMsg ', 'IntMsg=')
-    l = l.replace('INT Msg #', 'IntMsg=')
-    l = l.replace('RP PIO Log ', 'RP-PIO-Log=')
-    l = l.replace('RP PIO ErrPtr:', 'RP-PIO-ErrPtr=')
-    l = l.replace('Trigger:', 'Trigger=')
-    l = l.replace('TriggerExt:', 'TriggerExt=')
-    l = l.replace('Reason:', 'Reason=')
-    # ``
-    l = l.replace('Slot #', 'Slot=#')
-    l = l.replace('PowerLimit ', 'PowerLimit=')
-
-    flags = {}
+    l = RE_FLAG_REWRITES.sub(lambda m: _FLAG_REWRITES[m.group()], l)
+
+    flags = []
+    seen = set()
     for f in l.split():
         if '=' in f:
             name, value = f.split('=')
-            flags[name] = value
+            seen.add(name)
+            flags.append((sys.intern(name), sys.intern(value)))
             continue
 
-        assert f[-1] in '-+', (f, l)
+        value = _FLAG_VALUES.get(f[-1], None)
+        assert value is not None, (f, l)
         name = f[:-1]
-        value = {'-': False, '+': True}[f[-1]]
-        assert name not in flags, (name, flags, l)
+        assert name not in seen, (name, flags, l)
 
         if name.endswith(':'):
             name = name[:-1]
+        seen.add(name)
+
+        flags.append((sys.intern(name), value))
+    return tuple(flags)
+
+
+def parse_flags(l):
+    """
+    >>> parse_flags('I/O+ Mem+ BusMaster+ SpecCycle- MemWINV-')
+    {'I/O': True, 'Mem': True, 'BusMaster': True, 'SpecCycle': False, 'MemWINV': False}
+
+    >>> parse_flags(['I/O+ Mem+ BusMaster+', 'SpecCycle-'])
+    {'I/O': True, 'Mem': True, 'BusMaster': True, 'SpecCycle': False}
+
+    >>> parse_flags('Status: D0 NoSoftRst+ PME-Enable- DSel=0 DScale=0 PME-'[8:])
+    {'D0': True, 'NoSoftRst': True, 'PME-Enable': False, 'DSel': '0', 'DScale': '0', 'PME': False}
 
-        flags[name] = value
-    return flags
+    A flag can't be given twice.
+
+    >>> parse_flags('X=1 X+')
+    Traceback (most recent call last):
+        ...
+    AssertionError: ('X', [('X', '1')], 'X=1 X+')
+    """
+    if isinstance(l, list):
+        l = ' '.join(l)
+    return dict(_decode_flags(l))
+
+
+_register_flags = {}
+
+
+def register_flags(register, table=None):
+    """
+    An IntFlag with a bit for each of the boolean flags of `register` in
+    `table` (CAPS_FLAGS, or FLAGS for the non capability registers).  The
+    bits are numbered in the order lspci shows the flags, not their position
+    in the hardware register.
+    """
+    if table is None:
+        table = CAPS_FLAGS
+    key = (register, table is FLAGS)
+    cls = _register_flags.get(key, None)
+    if cls is None:
+        names = table[register]
+        assert names, register
+        cls = _register_flags[key] = enum.IntFlag(register, [(n, 1 << i) for i, n in enumerate(names)])
+    return cls
+
+
+def parse_flag_bits(l, register, table=None):
+    """
+    Like parse_flags, but returns the set flags of `register` as its
+    register_flags() bitset.  Fields which aren't booleans, and flags the
+    table doesn't know, are left out.
+
+    >>> parse_flag_bits('CorrErr- NonFatalErr- FatalErr- UnsupReq+ AuxPwr- TransPend+', 'DevSta')
+    <DevSta.UnsupReq|TransPend: 40>
+    >>> parse_flag_bits('I/O+ Mem+ BusMaster- SpecCycle- MemWINV- VGASnoop- ParErr- Stepping- SERR- FastB2B- DisINTx+', 'Control', FLAGS)
+    <Control.I/O|Mem|DisINTx: 1027>
+    """
+    cls = register_flags(register, table)
+    if isinstance(l, list):
+        l = ' '.join(l)
+    bits = 0
+    members = cls.__members__
+    for name, value in _decode_flags(l):
+        if value is True and name in members:
+            bits |= members[name]._value_
+    return cls(bits)
+
+
+def _flag_inputs(paths):
+    """
+    Every value parse_flags() is given while parsing the `lspci -vvv` outputs
+    `paths`.
+    """
+    inputs = []
+
+    def record(l):
+        inputs.append(l)
+        return parse_flags(l)
+
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            data = f.read()
+        for device, lines in group_device_lines(_fixup(data).splitlines()):
+            parse_device(device, lines, flags=record)
+    return inputs
 
 
 RE_CAPS = re.compile(r"Capabilities: \[([\da-fA-F]+)( v\d+)?\] (.*?)$")
 RE_VENDOR = re.compile(r"Vendor Specific Information:\s*(ID=(?P<id>[\da-fA-F]+))?\s*(Rev=(?P<rev>\d+))?\s*Len=(?P<len>\w+) <\?>")
 
 
+# Capability registers which are (mostly) a list of flags, with the boolean
+# ones lspci shows, in order.  Registers with none known are empty.
 CAPS_FLAGS = {
-    'SltCap':  None,
+    'SltCap':  ('AttnBtn', 'PwrCtrl', 'MRL', 'AttnInd', 'PwrInd', 'HotPlug', 'Surprise', 'Interlock', 'NoCompl'),
 
-    'DpcCap':  None,
-    'DpcCtl':  None,
-    'DpcSta':  None,
+    'DpcCap':  ('RPExt', 'PoisonedTLP', 'SwTrigger', 'DL_ActiveErr'),
+    'DpcCtl':  ('Cmpl', 'INT', 'ErrCor', 'PoisonedTLP', 'SwTrigger', 'DL_ActiveErr'),
+    'DpcSta':  ('Trigger', 'INT', 'RPBusy'),
 
-    'DevCap':  None, # Special cased
-    'DevCtl':  None,
-    'DevSta':  None,
+    'DevCap':  ('ExtTag', 'AttnBtn', 'AttnInd', 'PwrInd', 'RBE', 'FLReset'), # Special cased
+    'DevCtl':  ('CorrErr', 'NonFatalErr', 'FatalErr', 'UnsupReq', 'RlxdOrd', 'ExtTag', 'PhantFunc',
+                'AuxPwr', 'NoSnoop', 'BrConfRtry', 'FLReset'),
+    'DevSta':  ('CorrErr', 'NonFatalErr', 'FatalErr', 'UnsupReq', 'AuxPwr', 'TransPend'),
 
-    'DevCap2': None,
-    'DevCtl2': None,
-    'DevSta2': None,
+    'DevCap2': ('TimeoutDis', 'NROPrPrP', 'LTR', '10BitTagComp', '10BitTagReq', 'ExtFmt', 'EETLPPrefix',
+                'EmergencyPowerReductionInit', 'FRS', 'TPHComp', 'ExtTPHComp', 'ARIFwd'),
+    'DevCtl2': ('TimeoutDis', 'LTR', '10BitTagReq', 'ARIFwd'),
+    'DevSta2': (),
 
-    'LnkCap':  None, # Special cased
-    'LnkCtl':  None, # Special cased
-    'LnkSta':  None, # Special cased
+    'LnkCap':  ('ClockPM', 'Surprise', 'LLActRep', 'BwNot', 'ASPMOptComp'), # Special cased
+    'LnkCtl':  ('Disabled', 'CommClk', 'ExtSynch', 'ClockPM', 'AutWidDis', 'BWInt', 'AutBWInt'), # Special cased
+    'LnkSta':  ('TrErr', 'Train', 'SlotClk', 'DLActive', 'BWMgmt', 'ABWMgmt'), # Special cased
 
-    'LnkCap2': None,
-    'LnkCtl2': None,
-    'LnkSta2': None,
+    'LnkCap2': ('Crosslink', 'Retimer', '2Retimers', 'DRS'),
+    'LnkCtl2': ('EnterCompliance', 'SpeedDis', 'EnterModifiedCompliance', 'ComplianceSOS'),
+    'LnkSta2': ('EqualizationComplete', 'EqualizationPhase1', 'EqualizationPhase2', 'EqualizationPhase3',
+                'LinkEqualizationRequest', 'Retimer', '2Retimers'),
 
-    'L1SubCap':  None,
-    'L1SubCtl1': None,
-    'L1SubCtl2': None,
+    'L1SubCap':  ('PCI-PM_L1.2', 'PCI-PM_L1.1', 'ASPM_L1.2', 'ASPM_L1.1', 'L1_PM_Substates'),
+    'L1SubCtl1': ('PCI-PM_L1.2', 'PCI-PM_L1.1', 'ASPM_L1.2', 'ASPM_L1.1'),
+    'L1SubCtl2': (),
 
-    'IOVCap':   None,
-    'IOVCtl':   None,
-    'IOVSta':   None,
+    'IOVCap':   ('Migration', '10BitTagReq'),
+    'IOVCtl':   ('Enable', 'Migration', 'Interrupt', 'MSE', 'ARIHierarchy', '10BitTagReq'),
+    'IOVSta':   ('Migration',),
 
-    'AFCap':    None,
-    'AFCtrl':   None,
-    'AFStatus': None,
+    'AFCap':    ('TP', 'FLR'),
+    'AFCtrl':   ('FLR',),
+    'AFStatus': ('TP',),
 
-    'PTMCap':     None,
-    'PTMControl': None,
+    'PTMCap':     ('Requester', 'Responder', 'Root'),
+    'PTMControl': ('Enabled', 'RootSelected'),
 
-    'ATSCap':  None,
-    'ATSCtl':  None,
-    'ATSSta':  None,
+    'ATSCap':  (),
+    'ATSCtl':  ('Enable',),
+    'ATSSta':  (),
 
-    'ACSCap':  None,
-    'ACSCtl':  None,
-    'ACSSta':  None,
+    'ACSCap':  ('SrcValid', 'TransBlk', 'ReqRedir', 'CmpltRedir', 'UpstreamFwd', 'EgressCtrl', 'DirectTrans'),
+    'ACSCtl':  ('SrcValid', 'TransBlk', 'ReqRedir', 'CmpltRedir', 'UpstreamFwd', 'EgressCtrl', 'DirectTrans'),
+    'ACSSta':  (),
 
-    'RootCmd': None,
-    'RootCap': None,
-    'RootCtl': None,
-    'RootSta': None,
+    'RootCmd': ('CERptEn', 'NFERptEn', 'FERptEn'),
+    'RootCap': ('CRSVisible',),
+    'RootCtl': ('ErrCorrectable', 'ErrNon-Fatal', 'ErrFatal', 'PMEIntEna', 'CRSVisible'),
+    # Both the Express and the AER capability's.
+    'RootSta': ('PMEStatus', 'PMEPending',
+                'CERcvd', 'MultCERcvd', 'UERcvd', 'MultUERcvd', 'FirstFatal', 'NonFatalMsg', 'FatalMsg'),
 
-    'AERCap':  None,
-    'AERCtl':  None,
-    'AERSta':  None,
+    'AERCap':  ('ECRCGenCap', 'ECRCGenEn', 'ECRCChkCap', 'ECRCChkEn', 'MultHdrRecCap', 'MultHdrRecEn',
+                'TLPPfxPres', 'HdrLogCap'),
+    'AERCtl':  (),
+    'AERSta':  (),
 
-    'UECap':   None,
-    'UECtl':   None,
-    'UESta':   None,
-    'UEMsk':   None,
+    'UECap':   (),
+    'UECtl':   (),
+    'UESta':   ('DLP', 'SDES', 'TLP', 'FCP', 'CmpltTO', 'CmpltAbrt', 'UnxCmplt', 'RxOF', 'MalfTLP', 'ECRC',
+                'UnsupReq', 'ACSViol'),
+    'UEMsk':   ('DLP', 'SDES', 'TLP', 'FCP', 'CmpltTO', 'CmpltAbrt', 'UnxCmplt', 'RxOF', 'MalfTLP', 'ECRC',
+                'UnsupReq', 'ACSViol'),
 
-    'CEMsk':   None,
-    'CESta':   None,
+    'CEMsk':   ('RxErr', 'BadTLP', 'BadDLLP', 'Rollover', 'Timeout', 'AdvNonFatalErr'),
+    'CESta':   ('RxErr', 'BadTLP', 'BadDLLP', 'Rollover', 'Timeout', 'AdvNonFatalErr'),
 
-    'UESvrt':  None,
+    'UESvrt':  ('DLP', 'SDES', 'TLP', 'FCP', 'CmpltTO', 'CmpltAbrt', 'UnxCmplt', 'RxOF', 'MalfTLP', 'ECRC',
+                'UnsupReq', 'ACSViol'),
 
-    'Flags':  None,
-    'Status': None,
+    'Flags':  ('PMEClk', 'DSI', 'D1', 'D2'),
+    'Status': ('D0', 'D3', 'NoSoftRst', 'PME-Enable', 'PME', 'InProgress'),
 
-    'PRICtl': None,
-    'PRISta': None,
+    'PRICtl': ('Enable', 'Reset'),
+    'PRISta': ('RF', 'UPRGI', 'Stopped'),
 
-    'PASIDCap': None,
-    'PASIDCtl': None,
+    'PASIDCap': ('Exec', 'Priv'),
+    'PASIDCtl': ('Enable', 'Exec', 'Priv'),
 
     # subsub-capacity flags
-    'AtomicOpsCap': None,
-    'AtomicOpsCtl': None,
-    'AtomicOpsSta': None,
+    'AtomicOpsCap': ('Routing', '32bit', '64bit', '128bitCAS'),
+    'AtomicOpsCtl': ('ReqEn', 'EgressBlck'),
+    'AtomicOpsSta': (),
 
-    'PME': None,
+    'PME': ('D0', 'D1', 'D2', 'D3hot', 'D3cold'),
 
     # Capabilities: [220 v1] Secondary PCI Express
 	#	LnkCtl3: LnkEquIntrruptEn- PerformEqu+
 	#	LaneErrStat: 0
-    'LnkCtl3': None,
+    'LnkCtl3': ('LnkEquIntrruptEn', 'PerformEqu'),
 }
 
 
@@ -922,133 +1253,707 @@ def parse_caps(p):
     return Capability(int(cap, 16), v, name, [], vendor=vendor, types=types)
 
 
-def parse_lspci_output(output):
-    output = _fixup(output)
+def parse_cap_properties(lines, flags=None):
+    """
+    The `{register: value}` properties of a capability from its lines, with
+    the flags decoded by `flags` (parse_flags by default).
+    """
+    if flags is None:
+        flags = parse_flags
+    properties = {}
+    for p in lines:
+        if ': ' in p:
+            key, value = p.split(': ', 1)
+
+            bits = value.split(', ')
+
+            subproperties = {}
+            def u(s, b):
+                for k, v in flags(b).items():
+                    assert k not in s, (k, v, s[k], b)
+                    s[k] = v
+
+            for b in bits:
+                if ': ' in b:
+                    skey, svalue = b.split(': ', 1)
+                    if skey in CAPS_FLAGS:
+                        subproperties[skey] = {}
+                        u(subproperties[skey], svalue)
+                    else:
+                        subproperties[skey] = svalue
+                elif key in ('DevCap', 'DevCtl',):
+                    if b.startswith('MaxPayload '):
+                        assert b.endswith(' bytes'), (key, b, lines)
+                        subproperties['MaxPayload'] = int(b[len('MaxPayload '):-len(' bytes')])
+                    elif b.startswith('MaxReadReq '):
+                        assert b.endswith(' bytes'), (key, b, lines)
+                        subproperties['MaxReadReq'] = int(b[len('MaxReadReq '):-len(' bytes')])
+                    elif b.startswith('PhantFunc '):
+                        subproperties['PhantFunc'] = b[len('PhantFunc '):]
+                    elif b.startswith('Latency L0s') or b.startswith('L1 '):
+                        subproperties[b] = None
+                    else:
+                        u(subproperties, b)
+                elif key in ('LnkCap', 'LnkCtl', 'LnkSta'):
+                    if b.startswith('Port #'):
+                        subproperties['Port #'] = int(b[len('Port #'):])
+                    elif b.startswith('Speed '):
+                        subproperties['Speed'] = b[len('Speed '):]
+                    elif b.startswith('Exit Latency '):
+                        subproperties['Exit Latency'] = b[len('Exit Latency '):]
+                    elif b.startswith('Width '):
+                        subproperties['Width'] = b[len('Width '):]
+                    elif b.startswith('RCB '):
+                        assert b.endswith(' bytes'), (key, b, lines)
+                        subproperties['RCB'] = int(b[len('RCB '):-len(' bytes')])
+                    else:
+                        u(subproperties, b)
+                elif key in CAPS_FLAGS:
+                    u(subproperties, b)
+                else:
+                    subproperties[b] = None
+
+            value = subproperties
+        properties[key] = value
+    return properties
+
+
+def parse_device(device, lines, lazy=False, flags=None):
+    """
+    Parses the `lines` of one device.  With `lazy` each capability's
+    properties are only decoded when they are first used, which most
+    reports (regions, topology) never do.  `flags` is used in place of
+    parse_flags.
+    """
+    if flags is None:
+        flags = parse_flags
+    details = {}
+    for l in lines:
+        if isinstance(l, str) and l.startswith('Capabilities: '):
+            l = [l]
+
+        if isinstance(l, list):
+            assert l[0].startswith('Capabilities: '), l[0]
+            if 'Capabilities' not in details:
+                details['Capabilities'] = []
+            cap = parse_caps(l[0])
+
+            # The SR-IOV VF BARs are always wanted, so aren't deferred.
+            props = []
+            for p in l[1:]:
+                if ': ' in p and p.startswith('Region '):
+                    cap.regions.append(parse_region(p))
+                else:
+                    props.append(p)
+
+            if lazy:
+                cap.defer_properties(props, device, l[0])
+            else:
+                with instrument.stage('parse_cap_properties', device, l[0]):
+                    cap.properties = parse_cap_properties(props, flags)
+            details['Capabilities'].append(cap)
+            continue
+
+        if 'Regions' not in details:
+            details['Regions'] = []
+        if l.startswith('Region '):
+            details['Regions'].append(parse_region(l))
+            continue
+        if l.startswith('Expansion ROM '):
+            details['Regions'].append(parse_region(l))
+            continue
+
+        assert isinstance(l, str), l
+        assert ': ' in l, l
+        name, value = l.split(': ', 1)
+
+        if name.endswith(' behind bridge'):
+            value = parse_behind_bridge(l)
+            if 'BridgeRegions' not in details:
+                details['BridgeRegions'] = []
+            details['BridgeRegions'].append(value)
+
+        elif ',' in value:
+            value = [v.strip() for v in value.split(',')]
 
-    device_lines = group_device_lines(output.splitlines())
+        if name in FLAGS:
+            value = flags(value)
+
+        details[name] = value
+    return device, details
+
+
+def parse_lspci_output(output, lazy=False):
+    """
+    >>> text = (
+    ...     "00:01.0 PCI bridge: Intel Corporation Root Port 1\\n"
+    ...     "\\tCapabilities: [90] Express (v2) Root Port (Slot-), MSI 00\\n"
+    ...     "\\t\\tDevSta:\\tCorrErr- NonFatalErr- FatalErr- UnsupReq- AuxPwr- TransPend-\\n"
+    ...     "\\t\\tLnkSta:\\tSpeed 8GT/s (ok), Width x16 (ok)\\n"
+    ...     "\\n")
+    >>> cap = parse_lspci_output(text, lazy=True)[0][1]['Capabilities'][0]
+    >>> cap.registers(), 'properties' in cap.__dict__
+    (['DevSta', 'LnkSta'], False)
+    >>> cap.properties['LnkSta']
+    {'Speed': '8GT/s (ok)', 'Width': 'x16 (ok)'}
+    >>> 'properties' in cap.__dict__, '_raw' in cap.__dict__
+    (True, False)
+    >>> cap == parse_lspci_output(text)[0][1]['Capabilities'][0]
+    True
+    """
+    with instrument.stage('_fixup'):
+        output = _fixup(output)
+
+    with instrument.stage('group_device_lines'):
+        device_lines = group_device_lines(output.splitlines())
     devices = []
     for device, lines in device_lines:
-        details = {}
-        for l in lines:
-            if isinstance(l, str) and l.startswith('Capabilities: '):
-                l = [l]
-
-            if isinstance(l, list):
-                assert l[0].startswith('Capabilities: '), l[0]
-                if 'Capabilities' not in details:
-                    details['Capabilities'] = []
-                cap = parse_caps(l[0])
-
-                properties = {}
-                for p in l[1:]:
-                    if ': ' in p:
-                        if p.startswith('Region '):
-                            cap.regions.append(parse_region(p))
-                            continue
-
-                        key, value = p.split(': ', 1)
-
-                        bits = value.split(', ')
-
-                        subproperties = {}
-                        def u(s, b):
-                            for k, v in parse_flags(b).items():
-                                assert k not in s, (k, v, s[k], b)
-                                s[k] = v
-
-                        for b in bits:
-                            if ': ' in b:
-                                skey, svalue = b.split(': ', 1)
-                                if skey in CAPS_FLAGS:
-                                    subproperties[skey] = {}
-                                    u(subproperties[skey], svalue)
-                                else:
-                                    subproperties[skey] = svalue
-                            elif key in ('DevCap', 'DevCtl',):
-                                if b.startswith('MaxPayload '):
-                                    assert b.endswith(' bytes'), (key, b, l)
-                                    subproperties['MaxPayload'] = int(b[len('MaxPayload '):-len(' bytes')])
-                                elif b.startswith('MaxReadReq '):
-                                    assert b.endswith(' bytes'), (key, b, l)
-                                    subproperties['MaxReadReq'] = int(b[len('MaxReadReq '):-len(' bytes')])
-                                elif b.startswith('PhantFunc '):
-                                    subproperties['PhantFunc'] = b[len('PhantFunc '):]
-                                elif b.startswith('Latency L0s') or b.startswith('L1 '):
-                                    subproperties[b] = None
-                                else:
-                                    u(subproperties, b)
-                            elif key in ('LnkCap', 'LnkCtl', 'LnkSta'):
-                                if b.startswith('Port #'):
-                                    subproperties['Port #'] = int(b[len('Port #'):])
-                                elif b.startswith('Speed '):
-                                    subproperties['Speed'] = b[len('Speed '):]
-                                elif b.startswith('Exit Latency '):
-                                    subproperties['Exit Latency'] = b[len('Exit Latency '):]
-                                elif b.startswith('Width '):
-                                    subproperties['Width'] = b[len('Width '):]
-                                elif b.startswith('RCB '):
-                                    assert b.endswith(' bytes'), (key, b, l)
-                                    subproperties['RCB'] = int(b[len('RCB '):-len(' bytes')])
-                                else:
-                                    u(subproperties, b)
-                            elif key in CAPS_FLAGS:
-                                u(subproperties, b)
-                            else:
-                                subproperties[b] = None
-
-                        value = subproperties
-                    properties[key] = value
-                cap.properties = properties
-                details['Capabilities'].append(cap)
-                continue
+        with instrument.stage('parse_device', device):
+            devices.append(parse_device(device, lines, lazy))
+    return devices
+
 
-            if 'Regions' not in details:
-                details['Regions'] = []
-            if l.startswith('Region '):
-                details['Regions'].append(parse_region(l))
+def iter_lspci_devices(fileobj, lazy=False):
+    """
+    Yields each `(device, details)` tuple as soon as its blank line terminated
+    block has been read from `fileobj`, so memory use only depends on the size
+    of the largest device block.
+
+    >>> import io
+    >>> f = io.StringIO(
+    ...     "00:00.0 Host bridge: Intel Corporation DMI2\\n"
+    ...     "\\tControl: I/O- Mem- BusMaster-\\n"
+    ...     "\\tExpansion ROM at 000c0000 [disabled] [size=128K]\\n"
+    ...     "\\n"
+    ...     "00:01.0 PCI bridge: Intel Corporation Root Port 1\\n"
+    ...     "\\tBus: primary=00, secondary=01, subordinate=0a, sec-latency=0\\n")
+    >>> devices = iter_lspci_devices(f)
+    >>> next(devices)
+    ('00:00.0 Host bridge: Intel Corporation DMI2', {'Regions': [Region(rtype='Expansion ROM', region=None, address=0xc0000, size=131072, flags=['disabled'], props=[])], 'Control': {'I/O': False, 'Mem': False, 'BusMaster': False}})
+    >>> f.tell() < len(f.getvalue())
+    True
+    >>> next(devices)
+    ('00:01.0 PCI bridge: Intel Corporation Root Port 1', {'Regions': [], 'Bus': ['primary=00', 'secondary=01', 'subordinate=0a', 'sec-latency=0']})
+    >>> next(devices)
+    Traceback (most recent call last):
+        ...
+    StopIteration
+    """
+    block = []
+    for line in fileobj:
+        if line.strip():
+            block.append(line.rstrip('\n'))
+            continue
+        if block:
+            yield from _parse_block(block, lazy)
+            block = []
+    if block:
+        yield from _parse_block(block, lazy)
+
+
+def _parse_block(block, lazy=False):
+    block.append('')
+    with instrument.stage('_fixup'):
+        fixed = _fixup('\n'.join(block))
+    with instrument.stage('group_device_lines'):
+        device_lines = group_device_lines(fixed.split('\n'))
+    for device, lines in device_lines:
+        with instrument.stage('parse_device', device):
+            parsed = parse_device(device, lines, lazy)
+        yield parsed
+
+
+def parse_bdf(name):
+    """
+    Returns `(domain, bus, device, function)` for the device `name` line (or
+    slot), which can use the plain, domain or `lspci -P` path forms.
+
+    >>> parse_bdf('00:1f.3 Audio device: Intel Corporation Device a1f0')
+    (0, 0, 31, 3)
+    >>> parse_bdf('00:02.0/0b:00.0/0c:04.0 PCI bridge: PLX Technology, Inc. Device 9765 (rev aa)')
+    (0, 12, 4, 0)
+    >>> parse_bdf('0001:17:00.0')
+    (1, 23, 0, 0)
+    """
+    slot = name.split(' ', 1)[0].rsplit('/', 1)[-1]
+    if slot.count(':') == 1:
+        slot = '0000:' + slot
+    domain, bus, devfn = slot.split(':')
+    dev, fn = devfn.split('.')
+    return int(domain, 16), int(bus, 16), int(dev, 16), int(fn, 16)
+
+
+def bridge_buses(details):
+    """
+    Returns the `(primary, secondary, subordinate)` bus numbers of a bridge,
+    or None for a device which isn't a bridge.
+
+    >>> bridge_buses({'Bus': ['primary=00', 'secondary=01', 'subordinate=0a', 'sec-latency=0']})
+    (0, 1, 10)
+    >>> bridge_buses({}) is None
+    True
+    """
+    bus = details.get('Bus', None)
+    if not bus:
+        return None
+    values = dict(b.split('=', 1) for b in bus)
+    return tuple(int(values[k], 16) for k in ('primary', 'secondary', 'subordinate'))
+
+
+def address_index(devices, iomem=None):
+    """
+    Builds an index of the memory address space claimed by the enabled BARs
+    and bridge windows of `devices`, plus the entries of `iomem` (the contents
+    of /proc/iomem) when given.
+
+    >>> devices = parse_lspci_output(
+    ...     "00:01.0 PCI bridge: Intel Corporation Root Port 1\\n"
+    ...     "\\tMemory behind bridge: 90000000-900fffff [size=1M] [32-bit]\\n"
+    ...     "\\n"
+    ...     "01:00.0 SATA controller: Intel Corporation SATA\\n"
+    ...     "\\tRegion 0: Memory at 90034000 (32-bit, non-prefetchable) [size=8K]\\n"
+    ...     "\\tRegion 2: I/O ports at 3050 [size=8]\\n"
+    ...     "\\n")
+    >>> index = address_index(devices, "90000000-9fffffff : PCI Bus 0000:00\\n")
+    >>> for start, end, (name, what) in index.whois(0x90034010):
+    ...     print(hex(start), hex(end), name.split(' ', 1)[0], what)
+    0x90000000 0x9fffffff iomem PCI Bus 0000:00
+    0x90000000 0x900fffff 00:01.0 BridgeRegion(prefetchable=True, type='memory', start=0x90000000, end=0x900fffff, size=1048576, disabled=False, bits=32)
+    0x90034000 0x90035fff 01:00.0 Region(rtype='Memory', region=0, address=0x90034000, size=8192, flags=[], props=['32-bit', 'non-prefetchable'])
+    >>> index.whois(0x3050)
+    []
+    """
+    index = addrmap.AddressIndex()
+    if iomem:
+        for depth, start, end, what in addrmap.iter_iomem(iomem):
+            index.add(start, end, ('iomem', what))
+
+    for name, details in devices:
+        regions = list(details.get('Regions', []))
+        for cap in details.get('Capabilities', []):
+            regions.extend(cap.regions)
+        for r in regions:
+            if r.disabled or r.size is None or r.address < 0:
                 continue
-            if l.startswith('Expansion ROM '):
-                details['Regions'].append(parse_region(l))
+            if r.rtype == 'I/O ports':
                 continue
+            index.add(r.start, r.end, (name, r))
+        for r in details.get('BridgeRegions', []):
+            if r.disabled or r.type != 'memory':
+                continue
+            index.add(r.start, r.end, (name, r))
+    return index
 
-            assert isinstance(l, str), l
-            assert ': ' in l, l
-            name, value = l.split(': ', 1)
 
-            if name.endswith(' behind bridge'):
-                value = parse_behind_bridge(l)
-                if 'BridgeRegions' not in details:
-                    details['BridgeRegions'] = []
-                details['BridgeRegions'].append(value)
+# Parsed device lists are cached on disk, keyed by a hash of the raw lspci
+# output and of the parser itself (so editing this file invalidates them).
+CACHE_DIR = os.environ.get(
+    'PCIEE_CACHE_DIR',
+    os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'pciee'))
+CACHE_SIZE = int(os.environ.get('PCIEE_CACHE_SIZE', 256*1024*1024))
 
-            elif ',' in value:
-                value = [v.strip() for v in value.split(',')]
+_parser_version = []
 
-            if name in FLAGS:
-                value = parse_flags(value)
 
-            details[name] = value
-        devices.append((device, details))
-    return devices
+def parser_version():
+    if not _parser_version:
+        with open(__file__, 'rb') as f:
+            _parser_version.append(hashlib.sha256(f.read()).hexdigest())
+    return _parser_version[0]
 
 
-def main(args):
+def parse_cache_key(data, lazy=False):
+    return _cache_key([data], lazy)
+
+
+def _cache_key(chunks, lazy=False):
+    h = hashlib.sha256()
+    h.update(parser_version().encode())
+    if lazy:
+        h.update(b'lazy')
+    # Pickles made when run as a script reference __main__ rather than lspci.
+    h.update(__name__.encode())
+    for data in chunks:
+        h.update(data)
+    return h.hexdigest()
+
+
+def cached_parse(data, cache_dir=None, max_size=None, lazy=False):
+    """
+    Parses the lspci output `data` (bytes), reusing the result of an earlier
+    run from `cache_dir` when the same output has been parsed before.  The
+    least recently used entries are removed once the cache grows above
+    `max_size` bytes.
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> a = b"00:00.0 Host bridge: Intel Corporation DMI2\\n\\tControl: I/O- Mem-\\n\\n"
+    >>> cached_parse(a, d)
+    [('00:00.0 Host bridge: Intel Corporation DMI2', {'Regions': [], 'Control': {'I/O': False, 'Mem': False}})]
+    >>> os.listdir(d) == [parse_cache_key(a) + '.pickle']
+    True
+    >>> cached_parse(a, d) == cached_parse(a, d)
+    True
+
+    >>> b = b"00:01.0 PCI bridge: Intel Corporation Root Port 1\\n\\tControl: I/O+ Mem+\\n\\n"
+    >>> cached_parse(b, d, max_size=1)[0][0]
+    '00:01.0 PCI bridge: Intel Corporation Root Port 1'
+    >>> os.listdir(d) == [parse_cache_key(b) + '.pickle']
+    True
+    """
+    return list(iter_cached_parse(io.BytesIO(data), cache_dir, max_size, lazy))
+
+
+def iter_cached_parse(f, cache_dir=None, max_size=None, lazy=False):
+    """
+    Yields the devices of the lspci output in the binary file `f` as
+    cached_parse() returns them.  The output is hashed, and the cache entry
+    read or written, a device at a time, so like iter_lspci_devices() memory
+    use only depends on the size of the largest device block.
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> a = b"00:00.0 Host bridge: Intel Corporation DMI2\\n\\n00:01.0 PCI bridge: Intel Corporation Root Port 1\\n\\n"
+    >>> devices = iter_cached_parse(io.BytesIO(a), d)
+    >>> next(devices)[0]
+    '00:00.0 Host bridge: Intel Corporation DMI2'
+    >>> devices.close()
+    >>> os.listdir(d)
+    []
+    >>> [name[:7] for name, _ in iter_cached_parse(io.BytesIO(a), d)]
+    ['00:00.0', '00:01.0']
+    >>> [name[:7] for name, _ in iter_cached_parse(io.BytesIO(a), d)]
+    ['00:00.0', '00:01.0']
+    """
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    if max_size is None:
+        max_size = CACHE_SIZE
+
+    key = _cache_key(iter(functools.partial(f.read, 1 << 20), b''), lazy)
+    f.seek(0)
+    path = os.path.join(cache_dir, key + '.pickle')
+
+    # An entry is the pickle of each device followed by a None.
+    loaded = 0
     try:
-        output = open('lspci.vvv').read()
+        with open(path, 'rb') as entry:
+            while True:
+                with instrument.stage('cache_load'):
+                    device = pickle.load(entry)
+                if device is None:
+                    break
+                loaded += 1
+                yield device
+    except FileNotFoundError:
+        pass
+    except (OSError, pickle.UnpicklingError, AttributeError, EOFError):
+        # A broken entry is parsed again, unless it was already half used.
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        if loaded:
+            raise
+    else:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return
+
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        out = open(tmp, 'wb')
+    except OSError:
+        out = None
+    try:
+        for device in iter_lspci_devices(io.TextIOWrapper(f, encoding='utf-8'), lazy):
+            if out is not None:
+                with instrument.stage('cache_store'):
+                    out = _store(out, tmp, device)
+            yield device
+        if out is not None:
+            out = _store(out, tmp, None)
+        if out is not None:
+            out.close()
+            out = None
+            try:
+                os.replace(tmp, path)
+                _evict(cache_dir, max_size, keep=path)
+            except OSError:
+                pass
+    finally:
+        # Not finished, so not cached.
+        if out is not None:
+            _discard(out, tmp)
+
+
+def _store(out, tmp, device):
+    """Appends `device` to the cache entry being written, giving up on an error."""
+    try:
+        pickle.dump(device, out, protocol=pickle.HIGHEST_PROTOCOL)
+        return out
+    except OSError:
+        _discard(out, tmp)
+        return None
+
+
+def _discard(out, tmp):
+    out.close()
+    try:
+        os.unlink(tmp)
+    except OSError:
+        pass
+
+
+def _evict(cache_dir, max_size, keep):
+    entries = []
+    for e in os.scandir(cache_dir):
+        if e.name.endswith('.pickle'):
+            st = e.stat()
+            entries.append((st.st_mtime, st.st_size, e.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        if path == keep:
+            continue
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def lspci_devices(cache=True, sysfs=False, lazy=False):
+    """
+    Streams the parsed devices of ./lspci.vvv (through the parse cache), or
+    of `lspci -vvv` when there is no snapshot.  With `sysfs`
+    the config space of the running system is decoded directly instead.
+    `lazy` is passed on to parse_device.
+    """
+    if sysfs:
+        import pciconfig
+        yield from pciconfig.read_sysfs()
+        return
+
+    try:
+        f = open('lspci.vvv', 'rb')
     except FileNotFoundError:
         import subprocess
-        output = subprocess.check_output(["lspci", "-vvv"], universal_newlines=True)
+        with subprocess.Popen(["lspci", "-vvv"], stdout=subprocess.PIPE, universal_newlines=True).stdout as output:
+            yield from iter_lspci_devices(output, lazy)
+        return
+
+    with f:
+        if cache:
+            yield from iter_cached_parse(f, lazy=lazy)
+        else:
+            yield from iter_lspci_devices(io.TextIOWrapper(f, encoding='utf-8'), lazy)
+
+
+# Each type is written as the arguments it is constructed from, HexInt and
+# RegionFlags as plain numbers.
+_JSON_TYPES = {
+    Region: lambda r: {
+        'rtype': r.rtype, 'region': r.region, 'address': r.address, 'size': r.size,
+        'flags': r.flags, 'props': r.props},
+    BridgeRegion: lambda r: {
+        'prefetchable': r.prefetchable, 'type': r.type, 'start': r.start, 'end': r.end,
+        'size': r.size, 'disabled': r.disabled, 'bits': r.bits},
+    Capability: lambda c: {
+        'id': c.id, 'version': c.version, 'name': c.name, 'vendor': c.vendor, 'types': c.types,
+        'properties': c.properties, 'regions': c.regions},
+    CapabilityVendor: lambda v: {'id': v.id, 'rev': v.rev, 'len': v.len},
+}
+
+
+def _json_default(o):
+    f = _JSON_TYPES.get(o.__class__, None)
+    if f is None:
+        raise TypeError('{} is not JSON serializable'.format(o.__class__.__name__))
+    return f(o)
+
+
+_json_encoder = json.JSONEncoder(
+    default=_json_default, ensure_ascii=False, check_circular=False, separators=(',', ':'))
 
-    devices = parse_lspci_output(output)
 
+def write_json(devices, f=None, ndjson=False):
+    """
+    Writes each of the `(name, details)` `devices` to `f` as soon as it is
+    parsed, as a `{"name": ..., "details": ...}` object per line with
+    `ndjson` or as the items of a JSON array.  Returns the number written.
+
+    >>> devices = parse_lspci_output(
+    ...     "00:01.0 PCI bridge: Intel Corporation Root Port 1\\n"
+    ...     "\\tBus: primary=00, secondary=01, subordinate=01, sec-latency=0\\n"
+    ...     "\\tMemory behind bridge: c7000000-c70fffff [size=1M]\\n"
+    ...     "\\tCapabilities: [90] Express (v2) Root Port (Slot-), MSI 00\\n"
+    ...     "\\t\\tLnkSta:\\tSpeed 8GT/s (ok), Width x16 (ok)\\n"
+    ...     "\\n"
+    ...     "01:00.0 Ethernet controller: Intel Corporation I210 Gigabit Network Connection (rev 03)\\n"
+    ...     "\\tRegion 0: Memory at c7000000 (32-bit, non-prefetchable) [size=512K]\\n"
+    ...     "\\n")
+    >>> write_json(devices, sys.stdout, ndjson=True)
+    {"name":"00:01.0 PCI bridge: Intel Corporation Root Port 1","details":{"Regions":[],"Bus":["primary=00","secondary=01","subordinate=01","sec-latency=0"],"BridgeRegions":[{"prefetchable":true,"type":"memory","start":3338665984,"end":3339714559,"size":1048576,"disabled":false,"bits":null}],"Memory behind bridge":{"prefetchable":true,"type":"memory","start":3338665984,"end":3339714559,"size":1048576,"disabled":false,"bits":null},"Capabilities":[{"id":144,"version":-1,"name":"Unknown","vendor":null,"types":["Express (v2) Root Port (Slot-)","MSI 00"],"properties":{"LnkSta":{"Speed":"8GT/s (ok)","Width":"x16 (ok)"}},"regions":[]}]}}
+    {"name":"01:00.0 Ethernet controller: Intel Corporation I210 Gigabit Network Connection (rev 03)","details":{"Regions":[{"rtype":"Memory","region":0,"address":3338665984,"size":524288,"flags":[],"props":["32-bit","non-prefetchable"]}]}}
+    2
+    >>> out = io.StringIO()
+    >>> _ = write_json(devices, out)
+    >>> [d['name'][:7] for d in json.loads(out.getvalue())]
+    ['00:01.0', '01:00.0']
+    """
+    if f is None:
+        f = sys.stdout
+    encode = _json_encoder.encode
+    n = 0
+    if not ndjson:
+        f.write('[')
+    for name, details in devices:
+        s = encode({'name': name, 'details': details})
+        if ndjson:
+            f.write(s + '\n')
+        else:
+            f.write((',\n' if n else '\n') + s)
+        n += 1
+    if not ndjson:
+        f.write('\n]\n' if n else ']\n')
+    return n
+
+
+def whois(addresses, cache=True, sysfs=False):
+    # Only the BARs and windows are needed.
+    devices = list(lspci_devices(cache, sysfs, lazy=True))
+    try:
+        iomem = open('iomem').read()
+    except FileNotFoundError:
+        iomem = None
+    index = address_index(devices, iomem)
+
+    for addr in addresses:
+        print(hex(addr))
+        for start, end, (name, what) in index.whois(addr):
+            if name == 'iomem':
+                name = 'iomem: '+what
+            elif isinstance(what, Region):
+                name = '{} (BAR {})'.format(name, 'E' if what.region is None else what.region)
+            else:
+                name = '{} ({}{} behind bridge)'.format(name, '' if what.prefetchable else 'prefetchable ', what.type)
+            print('   ', lpad(hex(start)[2:], '0', M), lpad(hex(end)[2:], '0', M), name)
+    return 0
+
+
+def _address(s):
+    """A hex address from the command line or stdin."""
+    try:
+        return int(s, 16)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid address: {!r}'.format(s)) from None
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--whois', nargs='+', type=lambda s: s if s == '-' else _address(s), metavar='0xADDR',
+        help="print the devices and iomem ranges which contain each physical address ('-' reads them from stdin)")
+    parser.add_argument(
+        '--export-snapshot', metavar='PATH',
+        help="write the parsed devices to a columnar snapshot file (see snapshot.py) instead of printing them")
+    parser.add_argument(
+        '--where', action='append', metavar='EXPR',
+        help="only print the devices matching EXPR, e.g. 'LnkSta.Speed < LnkCap.Speed' (see query.py), can be repeated")
+    parser.add_argument(
+        '--select', metavar='FIELDS',
+        help="comma separated fields to print for each matching device, e.g. BDF,LnkSta")
+    parser.add_argument(
+        '--json', dest='format', action='store_const', const='json',
+        help="write the parsed devices as a JSON array, one device per line, instead of printing them")
+    parser.add_argument(
+        '--ndjson', dest='format', action='store_const', const='ndjson',
+        help="write each parsed device as a line of JSON as soon as it is parsed")
+    parser.add_argument(
+        '--max-depth', type=int, metavar='N',
+        help="collapse the memory map below N levels of nesting")
+    parser.add_argument(
+        '--map-output', metavar='PATH',
+        help="write the memory map to PATH instead of stdout")
+    parser.add_argument(
+        '--sysfs', action='store_true',
+        help="decode /sys/bus/pci/devices/*/config directly instead of parsing lspci -vvv output (needs root)")
+    parser.add_argument(
+        '--no-cache', dest='cache', action='store_false',
+        help="don't use the parse cache in $PCIEE_CACHE_DIR (default ~/.cache/pciee)")
+    parser.add_argument(
+        '--doctest', action='store_true',
+        help="run the doctests and exit (the checks over every snapshot are in test_lspci.py)")
+    parser.add_argument(
+        '--profile', nargs='?', const='', metavar='PATH',
+        help="write the time, calls and allocated bytes of each parser stage, device and capability as JSON "
+             "to PATH (default stderr), see instrument.py; with --no-cache to time the parsing rather than the cache")
+    opts = parser.parse_args(args[1:])
+
+    if opts.doctest:
+        import doctest
+        return 1 if doctest.testmod(sys.modules[__name__]).failed > 0 else 0
+
+    if opts.whois and '-' in opts.whois:
+        addresses = []
+        for a in opts.whois:
+            if a != '-':
+                addresses.append(a)
+                continue
+            for l in sys.stdin.read().split():
+                try:
+                    addresses.append(_address(l))
+                except argparse.ArgumentTypeError as e:
+                    parser.error('stdin: {}'.format(e))
+        opts.whois = addresses
+
+    try:
+        if opts.profile is None:
+            return run(opts)
+        with instrument.profiling() as prof:
+            ret = run(opts)
+        prof.write(opts.profile or None)
+        return ret
+    except query.QueryError as e:
+        # A bad --where or --select.
+        parser.error(str(e))
+
+
+def run(opts):
+    if opts.whois:
+        return whois(opts.whois, cache=opts.cache, sysfs=opts.sysfs)
+
+    if opts.where or opts.select:
+        return query.run(
+            lspci_devices(opts.cache, opts.sysfs, lazy=True), opts.where,
+            opts.select.split(',') if opts.select else None)
+
+    if opts.format:
+        write_json(lspci_devices(opts.cache, opts.sysfs), sys.stdout, opts.format == 'ndjson')
+        return 0
+
+    if opts.export_snapshot:
+        import snapshot
+        snapshot.write_snapshot(opts.export_snapshot, list(lspci_devices(opts.cache, opts.sysfs)))
+        return 0
+
+    devices = []
     regions = []
     enabled = []
     bridges = []
-    for name, details in devices:
+    for name, details in lspci_devices(opts.cache, opts.sysfs):
+        devices.append((name, details))
         print()
         print()
         print(name)
-        pprint(details)
+        with instrument.stage('pprint', name):
+            pprint(details)
         for r in details.get('Regions', []):
             regions.append((r, name))
             if not r.disabled:
@@ -1090,15 +1995,36 @@ def main(args):
         print(r.range, r.__class__.__name__[0], d)
     print('-'*twidth())
 
+    print()
+    print('Conflicts (overlapping, outside parent window, undersized window)')
+    print('-'*twidth())
+    try:
+        import conflicts
+    except ImportError as e:
+        print('Skipped:', e)
+    else:
+        with instrument.stage('conflicts'):
+            problems = list(conflicts.check(devices))
+        for problem in problems:
+            print(*problem)
+    print('-'*twidth())
+
+    # The map nests the regions by address range rather than by bus (the
+    # topology model), as that is what the address space actually looks like.
     tree = {}
-    for r, n in enabled:
-        d = parents(r.start, r.end, tree)
-        if (0, 0) not in d:
-            d[(0,0)] = []
-        d[(0,0)].append(n)
+    with instrument.stage('parents'):
+        for r, n in enabled:
+            d = parents(r.start, r.end, tree)
+            if (0, 0) not in d:
+                d[(0,0)] = []
+            d[(0,0)].append(n)
 
     print()
-    pmem(tree)
+    out = render.Renderer(max_depth=opts.max_depth)
+    with instrument.stage('pmem'):
+        pmem(tree, out=out)
+    with instrument.stage('write'):
+        out.write(opts.map_output)
     print()
     print('='*twidth())
     print()
@@ -1107,7 +2033,4 @@ def main(args):
 
 
 if __name__ == "__main__":
-    import doctest
-    if doctest.testmod().failed > 0:
-        sys.exit(1)
     sys.exit(main(sys.argv))
@@ -0,0 +1,650 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+import sys
+
+import lspci
+import pciids
+import sysfs
+
+from lspci import BridgeRegion, Capability, CapabilityVendor, HexInt, Region
+
+# Decodes raw PCI configuration space (/sys/bus/pci/devices/*/config) into the
+# same `(device, details)` tuples parse_lspci_output() produces, without
+# running `lspci -vvv` and parsing its text.
+#
+# Only the registers the rest of the tools use are decoded: the header,
+# BARs, bridge windows and the power management, MSI, MSI-X and PCI Express
+# capabilities.  Other capabilities are listed by name with no properties.
+#
+# Unless run as root the kernel only exposes the first 64 bytes of config
+# space, which is just the header, so no capabilities are found.
+
+U8 = struct.Struct('<B')
+U16 = struct.Struct('<H')
+U32 = struct.Struct('<I')
+
+
+def _u8(cfg, offset):
+    return U8.unpack_from(cfg, offset)[0]
+
+
+def _u16(cfg, offset):
+    return U16.unpack_from(cfg, offset)[0]
+
+
+def _u32(cfg, offset):
+    return U32.unpack_from(cfg, offset)[0]
+
+
+def _flags(value, names):
+    """`{name: bool}` for each `(bit, name)` in `names`."""
+    return {name: bool(value & (1 << bit)) for bit, name in names}
+
+
+COMMAND = (
+    (0, 'I/O'), (1, 'Mem'), (2, 'BusMaster'), (3, 'SpecCycle'), (4, 'MemWINV'), (5, 'VGASnoop'),
+    (6, 'ParErr'), (7, 'Stepping'), (8, 'SERR'), (9, 'FastB2B'), (10, 'DisINTx'),
+)
+
+BRIDGE_CONTROL = (
+    (0, 'Parity'), (1, 'SERR'), (2, 'NoISA'), (3, 'VGA'), (4, 'VGA16'), (5, 'MAbort'), (6, '>Reset'),
+    (7, 'FastB2B'), (8, 'PriDiscTmr'), (9, 'SecDiscTmr'), (10, 'DiscTmrStat'), (11, 'DiscTmrSERREn'),
+)
+
+DEVSEL = ('fast', 'medium', 'slow', '??')
+
+
+def _status(value, secondary=False):
+    status = {}
+    if not secondary:
+        status['Cap'] = bool(value & (1 << 4))
+    status.update(_flags(value, ((5, '66MHz'),)))
+    if not secondary:
+        status.update(_flags(value, ((6, 'UDF'),)))
+    status.update(_flags(value, ((7, 'FastB2B'), (8, 'ParErr'))))
+    status['DEVSEL'] = DEVSEL[(value >> 9) & 3]
+    status.update(_flags(value, ((11, '>TAbort'), (12, '<TAbort'), (13, '<MAbort'))))
+    status.update(_flags(value, ((14, '<SERR' if secondary else '>SERR'), (15, '<PERR'))))
+    if not secondary:
+        status['INTx'] = bool(value & (1 << 3))
+    return status
+
+
+def _bar_regions(cfg, count, command, resources):
+    """The Regions for the first `count` BARs plus the expansion ROM."""
+    regions = []
+    i = 0
+    while i < count:
+        index = i
+        value = _u32(cfg, 0x10 + 4*i)
+        i += 1
+
+        if value & 1:
+            rtype = 'I/O ports'
+            address = value & ~0x3
+            props = []
+            enabled = command & 1
+        else:
+            rtype = 'Memory'
+            address = value & ~0xf
+            mtype = (value >> 1) & 3
+            if mtype == 2 and i < count:
+                address |= _u32(cfg, 0x10 + 4*i) << 32
+                i += 1
+            props = [{0: '32-bit', 1: 'low-1M', 2: '64-bit'}.get(mtype, '??'),
+                     'prefetchable' if value & 0x8 else 'non-prefetchable']
+            enabled = command & 2
+
+        region = _region(rtype, index, address, props, enabled, resources, index)
+        if region:
+            regions.append(region)
+
+    rom = _u32(cfg, 0x30 if count == 6 else 0x38)
+    region = _region('Expansion ROM', None, rom & ~0x7ff, [], rom & 1 and command & 2, resources, 6)
+    if region:
+        regions.append(region)
+    return regions
+
+
+def _region(rtype, index, address, props, enabled, resources, rindex):
+    """
+    Builds a Region from the BAR register value, using the kernel's view of
+    it from the `resource` file for the size (and the address, if the
+    register doesn't have one).
+    """
+    start = end = 0
+    if resources and rindex < len(resources):
+        start, end, _ = resources[rindex]
+
+    if not address and not start:
+        return None
+
+    flags = []
+    if not address:
+        address = start
+        flags.append('virtual')
+    if not enabled:
+        flags.append('disabled')
+
+    size = end - start + 1 if end else None
+    return Region(rtype, index, HexInt(address), size, flags=flags, props=props)
+
+
+def _windows(cfg):
+    """The `(name, BridgeRegion)` of each type 1 header bridge window."""
+    windows = []
+
+    base, limit = _u8(cfg, 0x1c), _u8(cfg, 0x1d)
+    start = (base & 0xf0) << 8
+    end = (limit & 0xf0) << 8 | 0xfff
+    bits = 16
+    if base & 0xf == 1:
+        start |= _u16(cfg, 0x30) << 16
+        end |= _u16(cfg, 0x32) << 16
+        bits = 32
+    windows.append(('I/O behind bridge', _window(True, 'i/o', start, end, bits)))
+
+    base, limit = _u16(cfg, 0x20), _u16(cfg, 0x22)
+    start = (base & 0xfff0) << 16
+    end = (limit & 0xfff0) << 16 | 0xfffff
+    windows.append(('Memory behind bridge', _window(True, 'memory', start, end, 32)))
+
+    base, limit = _u16(cfg, 0x24), _u16(cfg, 0x26)
+    start = (base & 0xfff0) << 16
+    end = (limit & 0xfff0) << 16 | 0xfffff
+    bits = 32
+    if base & 0xf == 1:
+        start |= _u32(cfg, 0x28) << 32
+        end |= _u32(cfg, 0x2c) << 32
+        bits = 64
+    # BridgeRegion.prefetchable is True for the non-prefetchable windows.
+    windows.append(('Prefetchable memory behind bridge', _window(False, 'memory', start, end, bits)))
+
+    return windows
+
+
+def _window(prefetchable, wtype, start, end, bits):
+    disabled = start > end
+    return BridgeRegion(
+        prefetchable=prefetchable, type=wtype,
+        start=HexInt(start), end=HexInt(end), size=None if disabled else end - start + 1,
+        disabled=disabled, bits=bits)
+
+
+# Standard capabilities which are only listed by name.
+CAP_NAMES = {
+    0x02: 'AGP',
+    0x03: 'Vital Product Data',
+    0x04: 'Slot ID',
+    0x06: 'CompactPCI hot-swap <?>',
+    0x07: 'PCI-X',
+    0x08: 'HyperTransport',
+    0x0a: 'Debug port',
+    0x0b: 'CompactPCI central resource control <?>',
+    0x0c: 'Hot-plug capable',
+    0x0e: 'AGP3',
+    0x0f: 'Secure device <?>',
+    0x12: 'SATA HBA v1.0',
+    0x13: 'PCI Advanced Features',
+    0x14: 'Enhanced Allocation (EA)',
+}
+
+EXT_CAP_NAMES = {
+    0x0001: 'Advanced Error Reporting',
+    0x0002: 'Virtual Channel',
+    0x0004: 'Power Budgeting <?>',
+    0x0005: 'Root Complex Link',
+    0x0006: 'Root Complex Internal Link <?>',
+    0x0007: 'Root Complex Event Collector <?>',
+    0x0008: 'Multi-Function Virtual Channel <?>',
+    0x0009: 'Virtual Channel',
+    0x000a: 'Root Complex Register Block <?>',
+    0x000c: 'Configuration Access Correlation <?>',
+    0x000d: 'Access Control Services',
+    0x000e: 'Alternative Routing-ID Interpretation (ARI)',
+    0x000f: 'Address Translation Service (ATS)',
+    0x0010: 'Single Root I/O Virtualization (SR-IOV)',
+    0x0011: 'Multi-Root I/O Virtualization <?>',
+    0x0012: 'Multicast',
+    0x0013: 'Page Request Interface (PRI)',
+    0x0015: 'Physical Resizable BAR',
+    0x0016: 'Dynamic Power Allocation <?>',
+    0x0017: 'Transaction Processing Hints',
+    0x0018: 'Latency Tolerance Reporting',
+    0x0019: 'Secondary PCI Express',
+    0x001b: 'Process Address Space ID (PASID)',
+    0x001c: 'LN Requester <?>',
+    0x001d: 'Downstream Port Containment',
+    0x001e: 'L1 PM Substates',
+    0x001f: 'Precision Time Measurement',
+    0x0022: 'Readiness Time Reporting <?>',
+    0x0024: 'Virtual Resizable BAR',
+    0x0025: 'Data Link Feature <?>',
+    0x0026: 'Physical Layer 16.0 GT/s <?>',
+    0x0027: 'Lane Margining at the Receiver <?>',
+    0x002a: 'Physical Layer 32.0 GT/s <?>',
+}
+
+LINK_SPEEDS = {1: '2.5GT/s', 2: '5GT/s', 3: '8GT/s', 4: '16GT/s', 5: '32GT/s', 6: '64GT/s'}
+
+EXPRESS_TYPES = {
+    0x0: 'Endpoint',
+    0x1: 'Legacy Endpoint',
+    0x4: 'Root Port',
+    0x5: 'Upstream Port',
+    0x6: 'Downstream Port',
+    0x7: 'PCI-Express to PCI/PCI-X Bridge',
+    0x8: 'PCI/PCI-X to PCI-Express Bridge',
+    0x9: 'Root Complex Integrated Endpoint',
+    0xa: 'Root Complex Event Collector',
+}
+
+
+def _onoff(b):
+    return '+' if b else '-'
+
+
+def _power_management(cfg, offset):
+    pmc = _u16(cfg, offset + 2)
+    if offset + 6 > len(cfg):
+        return Capability(offset, -1, 'Power Management version {}'.format(pmc & 7), {})
+    pmcsr = _u16(cfg, offset + 4)
+
+    flags = _flags(pmc, ((3, 'PMEClk'), (5, 'DSI'), (9, 'D1'), (10, 'D2')))
+    flags['AuxCurrent'] = ('0mA', '55mA', '100mA', '160mA', '220mA', '270mA', '320mA', '375mA')[(pmc >> 6) & 7]
+    flags['PME'] = _flags(pmc, ((11, 'D0'), (12, 'D1'), (13, 'D2'), (14, 'D3hot'), (15, 'D3cold')))
+
+    status = {'D{}'.format(pmcsr & 3): True}
+    status.update(_flags(pmcsr, ((3, 'NoSoftRst'), (8, 'PME-Enable'))))
+    status['DSel'] = str((pmcsr >> 9) & 0xf)
+    status['DScale'] = str((pmcsr >> 13) & 3)
+    status['PME'] = bool(pmcsr & (1 << 15))
+
+    return Capability(offset, -1, 'Power Management version {}'.format(pmc & 7), {'Flags': flags, 'Status': status})
+
+
+def _msi(cfg, offset):
+    ctl = _u16(cfg, offset + 2)
+    name = 'MSI: Enable{} Count={}/{} Maskable{} 64bit{}'.format(
+        _onoff(ctl & 1), 1 << ((ctl >> 4) & 7), 1 << ((ctl >> 1) & 7), _onoff(ctl & 0x100), _onoff(ctl & 0x80))
+    return Capability(offset, -1, name, {})
+
+
+def _msix(cfg, offset):
+    ctl = _u16(cfg, offset + 2)
+    name = 'MSI-X: Enable{} Count={} Masked{}'.format(_onoff(ctl & 0x8000), (ctl & 0x7ff) + 1, _onoff(ctl & 0x4000))
+    if offset + 12 > len(cfg):
+        return Capability(offset, -1, name, {})
+    table = _u32(cfg, offset + 4)
+    pba = _u32(cfg, offset + 8)
+    return Capability(offset, -1, name, {
+        'Vector table': {'BAR={} offset={:08x}'.format(table & 7, table & ~7): None},
+        'PBA': {'BAR={} offset={:08x}'.format(pba & 7, pba & ~7): None},
+    })
+
+
+def _express(cfg, offset):
+    flags = _u16(cfg, offset + 2)
+    ptype = (flags >> 4) & 0xf
+    slot = ptype in (0x4, 0x6) and flags & 0x100
+
+    desc = 'Express (v{}) {}'.format(flags & 0xf, EXPRESS_TYPES.get(ptype, 'Unknown type {}'.format(ptype)))
+    if ptype in (0x4, 0x6):
+        desc += ' (Slot{})'.format(_onoff(slot))
+    types = [desc, 'MSI {:02x}'.format((flags >> 9) & 0x1f)]
+
+    # A short read of the config space, lspci only shows the type then.
+    if offset + 0x14 > len(cfg):
+        return Capability(offset, -1, 'Unknown', {}, types=types)
+
+    devcap = _u32(cfg, offset + 0x04)
+    devctl = _u16(cfg, offset + 0x08)
+    devsta = _u16(cfg, offset + 0x0a)
+    lnkcap = _u32(cfg, offset + 0x0c)
+    lnkctl = _u16(cfg, offset + 0x10)
+    lnksta = _u16(cfg, offset + 0x12)
+
+    properties = {}
+    properties['DevCap'] = {
+        'MaxPayload': 128 << (devcap & 7),
+        'PhantFunc': str((devcap >> 3) & 3),
+    }
+    properties['DevCap'].update(_flags(devcap, ((5, 'ExtTag'), (15, 'RBE'), (28, 'FLReset'))))
+
+    properties['DevCtl'] = _flags(devctl, (
+        (0, 'CorrErr'), (1, 'NonFatalErr'), (2, 'FatalErr'), (3, 'UnsupReq'), (4, 'RlxdOrd'),
+        (8, 'ExtTag'), (9, 'PhantFunc'), (10, 'AuxPwr'), (11, 'NoSnoop')))
+    properties['DevCtl']['MaxPayload'] = 128 << ((devctl >> 5) & 7)
+    properties['DevCtl']['MaxReadReq'] = 128 << ((devctl >> 12) & 7)
+
+    properties['DevSta'] = _flags(devsta, (
+        (0, 'CorrErr'), (1, 'NonFatalErr'), (2, 'FatalErr'), (3, 'UnsupReq'), (4, 'AuxPwr'), (5, 'TransPend')))
+
+    cap_speed = lnkcap & 0xf
+    cap_width = (lnkcap >> 4) & 0x3f
+    properties['LnkCap'] = {
+        'Port #': lnkcap >> 24,
+        'Speed': LINK_SPEEDS.get(cap_speed, 'unknown'),
+        'Width': 'x{}'.format(cap_width),
+        'ASPM': ('not,supported', 'L0s', 'L1', 'L0s,L1')[(lnkcap >> 10) & 3],
+    }
+    properties['LnkCap'].update(_flags(lnkcap, (
+        (18, 'ClockPM'), (19, 'Surprise'), (20, 'LLActRep'), (21, 'BwNot'), (22, 'ASPMOptComp'))))
+
+    properties['LnkCtl'] = {
+        'ASPM': ('Disabled', 'L0s,Enabled', 'L1,Enabled', 'L0s,L1,Enabled')[lnkctl & 3],
+        'RCB': 128 if lnkctl & 0x8 else 64,
+    }
+    properties['LnkCtl'].update(_flags(lnkctl, (
+        (4, 'Disabled'), (6, 'CommClk'), (7, 'ExtSynch'), (8, 'ClockPM'), (9, 'AutWidDis'),
+        (10, 'BWInt'), (11, 'AutBWInt'))))
+
+    sta_speed = lnksta & 0xf
+    sta_width = (lnksta >> 4) & 0x3f
+    properties['LnkSta'] = {
+        'Speed': '{} ({})'.format(LINK_SPEEDS.get(sta_speed, 'unknown'), 'downgraded' if sta_speed < cap_speed else 'ok'),
+        'Width': 'x{} ({})'.format(sta_width, 'downgraded' if sta_width < cap_width else 'ok'),
+    }
+    properties['LnkSta'].update(_flags(lnksta, (
+        (10, 'TrErr'), (11, 'Train'), (12, 'SlotClk'), (13, 'DLActive'), (14, 'BWMgmt'), (15, 'ABWMgmt'))))
+
+    # The "2" registers only exist in version 2 capabilities.
+    if flags & 0xf >= 2 and offset + 0x34 <= len(cfg):
+        lnkcap2 = _u32(cfg, offset + 0x2c)
+        lnkctl2 = _u16(cfg, offset + 0x30)
+        speeds = [s for s in range(1, 8) if lnkcap2 & (1 << s)]
+        if speeds:
+            low = LINK_SPEEDS.get(speeds[0], '?')[:-len('GT/s')]
+            properties['LnkCap2'] = {'Supported Link Speeds': '{}-{}'.format(low, LINK_SPEEDS.get(speeds[-1], 'unknown'))}
+        properties['LnkCtl2'] = {'Target Link Speed': LINK_SPEEDS.get(lnkctl2 & 0xf, 'unknown')}
+
+    return Capability(offset, -1, 'Unknown', properties, types=types)
+
+
+def _subsystem(cfg, offset, ids):
+    if offset + 8 > len(cfg):
+        return Capability(offset, -1, 'Subsystem', {})
+    vendor, device = _u16(cfg, offset + 4), _u16(cfg, offset + 6)
+    return Capability(offset, -1, 'Subsystem: {}'.format(_vendor_device(ids, vendor, device)), {})
+
+
+def _capabilities(cfg, ids):
+    """Walks the standard capability list from the pointer at 0x34."""
+    caps = []
+    offset = _u8(cfg, 0x34) & ~3
+    seen = set()
+    # Every capability starts with its id, the next pointer and a 16 bit word.
+    while offset and offset not in seen and offset + 4 <= min(len(cfg), 0x100):
+        seen.add(offset)
+        cid = _u8(cfg, offset)
+        if cid == 0x01:
+            cap = _power_management(cfg, offset)
+        elif cid == 0x05:
+            cap = _msi(cfg, offset)
+        elif cid == 0x09:
+            cap = Capability(offset, -1, 'Unknown', {}, vendor=CapabilityVendor(id=-1, rev=-1, len=_u8(cfg, offset + 2)))
+        elif cid == 0x0d:
+            cap = _subsystem(cfg, offset, ids)
+        elif cid == 0x10:
+            cap = _express(cfg, offset)
+        elif cid == 0x11:
+            cap = _msix(cfg, offset)
+        else:
+            cap = Capability(offset, -1, CAP_NAMES.get(cid, '#{:02x} [{:04x}]'.format(cid, _u16(cfg, offset + 2))), {})
+        caps.append(cap)
+        offset = _u8(cfg, offset + 1) & ~3
+    return caps
+
+
+def _sriov_regions(cfg, offset):
+    """The VF BARs of an SR-IOV capability (lspci doesn't show their size)."""
+    regions = []
+    i = 0
+    while i < 6:
+        index = i
+        value = _u32(cfg, offset + 0x24 + 4*i)
+        i += 1
+        if value & 1:
+            continue
+        address = value & ~0xf
+        mtype = (value >> 1) & 3
+        if mtype == 2 and i < 6:
+            address |= _u32(cfg, offset + 0x24 + 4*i) << 32
+            i += 1
+        if not address:
+            continue
+        props = ['64-bit' if mtype == 2 else '32-bit', 'prefetchable' if value & 0x8 else 'non-prefetchable']
+        regions.append(Region('Memory', index, HexInt(address), None, flags=[], props=props))
+    return regions
+
+
+def _extended_capabilities(cfg):
+    """Walks the extended capability list from 0x100."""
+    caps = []
+    offset = 0x100
+    seen = set()
+    while offset and offset not in seen and offset + 4 <= len(cfg):
+        seen.add(offset)
+        header = _u32(cfg, offset)
+        if header in (0, 0xffffffff):
+            break
+        cid = header & 0xffff
+        version = (header >> 16) & 0xf
+
+        vendor = None
+        regions = []
+        if cid == 0x0003:
+            serial = (_u32(cfg, offset + 8) << 32) | _u32(cfg, offset + 4)
+            name = 'Device Serial Number ' + '-'.join('{:02x}'.format(b) for b in serial.to_bytes(8, 'big'))
+        elif cid == 0x000b:
+            vsec = _u32(cfg, offset + 4)
+            vendor = CapabilityVendor(id=vsec & 0xffff, rev=(vsec >> 16) & 0xf, len=vsec >> 20)
+            name = 'Unknown'
+        elif cid == 0x0023:
+            dvsec1, dvsec2 = _u32(cfg, offset + 4), _u16(cfg, offset + 8)
+            name = 'Designated Vendor-Specific: Vendor={:04x} ID={:04x} Rev={} Len={} <?>'.format(
+                dvsec1 & 0xffff, dvsec2, (dvsec1 >> 16) & 0xf, dvsec1 >> 20)
+        else:
+            name = EXT_CAP_NAMES.get(cid, 'Extended Capability ID {:#x}'.format(cid))
+            if cid == 0x0010:
+                regions = _sriov_regions(cfg, offset)
+
+        caps.append(Capability(offset, version, name, {}, vendor=vendor, regions=regions))
+        offset = (header >> 20) & 0xffc
+    return caps
+
+
+def _vendor_device(ids, vendor, device):
+    vname = ids.vendor(vendor)
+    if vname is None:
+        return 'Device {:04x}:{:04x}'.format(vendor, device)
+    return '{} {}'.format(vname, ids.device(vendor, device) or 'Device {:04x}'.format(device))
+
+
+def decode(config, name, resources=None, driver=None, ids=None):
+    """
+    Decodes the raw config space bytes of device `name` (a sysfs name such as
+    '0000:03:00.0').  `resources` are the rows of its sysfs `resource` file,
+    see sysfs.parse_resource(..., empty=True).
+
+    >>> ids = pciids.PciIds(pciids.build_index(
+    ...     '10de  NVIDIA Corporation\\n\\t1db1  GV100GL [Tesla V100 SXM2 16GB]\\n'
+    ...     'C 03  Display controller\\n\\t02  3D controller\\n'))
+    >>> cfg = bytearray(4096)
+    >>> struct.pack_into('<HHHH', cfg, 0x00, 0x10de, 0x1db1, 0x0406, 0x0010)
+    >>> struct.pack_into('<I', cfg, 0x08, 0x030200a1)
+    >>> struct.pack_into('<IIII', cfg, 0x10, 0xfd000000, 0x0000000c, 0x00000038, 0x00000000)
+    >>> cfg[0x34] = 0x60
+    >>> struct.pack_into('<BBHH', cfg, 0x60, 0x01, 0x68, 0x0003, 0x0008)               # PM
+    >>> struct.pack_into('<BBH', cfg, 0x68, 0x05, 0x78, 0x0080)                        # MSI
+    >>> struct.pack_into('<BBHIHHIHH', cfg, 0x78, 0x10, 0x00, 0x0002, 0x00008fe1,      # Express
+    ...                  0x2937, 0x0000, 0x00000903, 0x0040, 0x1081)
+    >>> struct.pack_into('<III', cfg, 0x100, 0x12810003, 0x00e04c00, 0x01000000)       # DSN
+    >>> struct.pack_into('<I', cfg, 0x128, 0x00010001)                                 # AER
+    >>> resources = sysfs.parse_resource(
+    ...     b'0x00000000fd000000 0x00000000fdffffff 0x0000000000040200\\n'
+    ...     b'0x0000038000000000 0x0000038003ffffff 0x000000000014220c\\n'
+    ...     b'0x0000000000000000 0x0000000000000000 0x0000000000000000\\n', empty=True)
+    >>> device, details = decode(cfg, '0000:03:00.0', resources, 'nvidia', ids)
+    >>> device
+    '03:00.0 3D controller: NVIDIA Corporation GV100GL [Tesla V100 SXM2 16GB] (rev a1)'
+    >>> details['Control']
+    {'I/O': False, 'Mem': True, 'BusMaster': True, 'SpecCycle': False, 'MemWINV': False, 'VGASnoop': False, 'ParErr': False, 'Stepping': False, 'SERR': False, 'FastB2B': False, 'DisINTx': True}
+    >>> for r in details['Regions']:
+    ...     print(r)
+    Region(rtype='Memory', region=0, address=0xfd000000, size=16777216, flags=[], props=['32-bit', 'non-prefetchable'])
+    Region(rtype='Memory', region=1, address=0x3800000000, size=67108864, flags=[], props=['64-bit', 'prefetchable'])
+    >>> for cap in details['Capabilities']:
+    ...     print(hex(cap.id), cap.version, cap.name, cap.types)
+    0x60 -1 Power Management version 3 None
+    0x68 -1 MSI: Enable- Count=1/1 Maskable- 64bit+ None
+    0x78 -1 Unknown ['Express (v2) Endpoint', 'MSI 00']
+    0x100 1 Device Serial Number 01-00-00-00-00-e0-4c-00 None
+    0x128 1 Advanced Error Reporting None
+    >>> express = details['Capabilities'][2].properties
+    >>> express['LnkCap']['Speed'], express['LnkCap']['Width'], express['LnkSta']['Speed'], express['LnkSta']['Width']
+    ('8GT/s', 'x16', '2.5GT/s (downgraded)', 'x8 (downgraded)')
+    >>> express['DevCtl']['MaxPayload'], express['DevCtl']['MaxReadReq']
+    (256, 512)
+    >>> details['Kernel driver in use']
+    'nvidia'
+
+    Type 1 headers (bridges) have bus numbers and windows instead.
+
+    >>> cfg = bytearray(256)
+    >>> struct.pack_into('<HHHH', cfg, 0x00, 0x8086, 0x6f02, 0x0007, 0x0010)
+    >>> struct.pack_into('<I', cfg, 0x08, 0x06040001)
+    >>> cfg[0x0e] = 0x01
+    >>> struct.pack_into('<BBBB', cfg, 0x18, 0x00, 0x01, 0x0a, 0x00)
+    >>> struct.pack_into('<BB', cfg, 0x1c, 0xf0, 0x00)
+    >>> struct.pack_into('<HHHHII', cfg, 0x20, 0xc720, 0xc790, 0x0001, 0x00f1, 0x200, 0x200)
+    >>> device, details = decode(cfg, '0000:00:01.0', ids=ids)
+    >>> device
+    '00:01.0 Class 0604: Device 8086:6f02 (rev 01) (prog-if 00)'
+    >>> details['Bus']
+    ['primary=00', 'secondary=01', 'subordinate=0a', 'sec-latency=0']
+    >>> lspci.bridge_buses(details)
+    (0, 1, 10)
+    >>> for r in details['BridgeRegions']:
+    ...     print(r)
+    BridgeRegion(prefetchable=True, type='i/o', start=0xf000, end=0xfff, size=None, disabled=True, bits=16)
+    BridgeRegion(prefetchable=True, type='memory', start=0xc7200000, end=0xc79fffff, size=8388608, disabled=False, bits=32)
+    BridgeRegion(prefetchable=False, type='memory', start=0x20000000000, end=0x20000ffffff, size=16777216, disabled=False, bits=64)
+
+    A capability cut short by the end of the config space only has the
+    fields which were read.
+
+    >>> cfg = bytearray(64)
+    >>> struct.pack_into('<HHHH', cfg, 0x00, 0x10de, 0x1db1, 0x0406, 0x0010)
+    >>> cfg[0x34] = 0x30
+    >>> struct.pack_into('<BBH', cfg, 0x30, 0x10, 0x00, 0x0002)                        # Express
+    >>> device, details = decode(cfg, '0000:03:00.0', ids=ids)
+    >>> [(cap.types, cap.properties) for cap in details['Capabilities']]
+    [(['Express (v2) Endpoint', 'MSI 00'], {})]
+    """
+    if ids is None:
+        ids = pciids.default()
+    cfg = memoryview(config)
+
+    vendor, device = _u16(cfg, 0x00), _u16(cfg, 0x02)
+    command, status = _u16(cfg, 0x04), _u16(cfg, 0x06)
+    revision, progif, subclass, pclass = cfg[0x08], cfg[0x09], cfg[0x0a], cfg[0x0b]
+    header = cfg[0x0e] & 0x7f
+
+    cnames = ids.pclass(pclass << 16 | subclass << 8 | progif)
+    desc = '{}: {}'.format(cnames[1] or cnames[0] or 'Class {:02x}{:02x}'.format(pclass, subclass), _vendor_device(ids, vendor, device))
+    if revision:
+        desc += ' (rev {:02x})'.format(revision)
+    if progif or header == 1:
+        desc += ' (prog-if {:02x}{})'.format(progif, ' [{}]'.format(cnames[2]) if cnames[2] else '')
+
+    slot = name[5:] if name.startswith('0000:') else name
+    details = {}
+    details['Control'] = _flags(command, COMMAND)
+    details['Status'] = _status(status)
+
+    latency, cacheline = cfg[0x0d], cfg[0x0c]
+    details['Latency'] = [str(latency), 'Cache Line Size: {} bytes'.format(cacheline * 4)] if cacheline else str(latency)
+
+    details['Regions'] = _bar_regions(cfg, 6 if header == 0 else 2 if header == 1 else 0, command, resources)
+
+    if header == 1:
+        primary, secondary, subordinate, seclat = cfg[0x18], cfg[0x19], cfg[0x1a], cfg[0x1b]
+        details['Bus'] = ['primary={:02x}'.format(primary), 'secondary={:02x}'.format(secondary),
+                          'subordinate={:02x}'.format(subordinate), 'sec-latency={}'.format(seclat)]
+        details['BridgeRegions'] = []
+        for wname, window in _windows(cfg):
+            details[wname] = window
+            details['BridgeRegions'].append(window)
+        details['Secondary status'] = _status(_u16(cfg, 0x1e), secondary=True)
+        details['BridgeCtl'] = _flags(_u16(cfg, 0x3e), BRIDGE_CONTROL)
+
+    if status & (1 << 4) and len(cfg) >= 0x40:
+        caps = _capabilities(cfg, ids)
+        if len(cfg) > 0x100:
+            caps.extend(_extended_capabilities(cfg))
+        if caps:
+            details['Capabilities'] = caps
+
+    if driver:
+        details['Kernel driver in use'] = driver
+
+    return slot + ' ' + desc, details
+
+
+def read_device(path, ids=None):
+    """
+    Decodes the device at sysfs directory `path`, or returns None if its
+    config space can't be read (it was removed during the scan...).
+    """
+    try:
+        dir_fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        return None
+    try:
+        config = sysfs.read_attr(dir_fd, 'config')
+        if config is None:
+            return None
+        resources = sysfs.parse_resource(sysfs.read_attr(dir_fd, 'resource'), empty=True)
+        try:
+            driver = os.path.basename(os.readlink('driver', dir_fd=dir_fd))
+        except OSError:
+            driver = None
+    finally:
+        os.close(dir_fd)
+    return decode(config, os.path.basename(path), resources, driver, ids)
+
+
+def read_sysfs(root=sysfs.SYSFS, ids=None):
+    """
+    Yields the decoded `(device, details)` of every device below `root`,
+    skipping (with a warning) those which can't be read.
+
+    >>> import contextlib, tempfile
+    >>> with tempfile.TemporaryDirectory() as root:
+    ...     os.mkdir(os.path.join(root, '0000:03:00.0'))
+    ...     with contextlib.redirect_stderr(sys.stdout):
+    ...         list(read_sysfs(root, ids=pciids.PciIds(pciids.build_index(''))))  # doctest: +ELLIPSIS
+    Skipping .../0000:03:00.0 (config space unreadable)
+    []
+    """
+    if ids is None:
+        ids = pciids.default()
+    for path in sorted(e.path for e in os.scandir(root)):
+        device = read_device(path, ids)
+        if device is None:
+            print('Skipping', path, '(config space unreadable)', file=sys.stderr)
+            continue
+        yield device
+
+
+if __name__ == "__main__":
+    import doctest
+    if doctest.testmod().failed > 0:
+        sys.exit(1)
+    for device, details in read_sysfs(*sys.argv[1:]):
+        print()
+        print(device)
+        lspci.pprint(details)
@@ -1,35 +1,16 @@
 #!/usr/bin/env python3
 
-import pathlib
-
-pci_ids = {}
-
-vid = None
-for l in open('/usr/share/misc/pci.ids'):
-    if not l.strip():
-        continue
-    l = l.rstrip()
-    if l.startswith('#'):
-        continue
-    if l.startswith('\t'):
-        did, ddsc = l.strip().split(' ', 1)
-        pci_ids[vid][-1][did] = ddsc.strip()
-    else:
-        vid, vdsc = l.split(' ', 1)
-        pci_ids[vid] = (vdsc.strip(), {})
+import argparse
+import os
+import pprint
+import select
+import socket
+import sys
 
+import pciids
+import sysfs
+import topology as topo
 
-def r(f, e='?'):
-    try:
-        d = open(f).read().strip()
-    except FileNotFoundError:
-        return e
-    if d.endswith(' GT/s PCIe'):
-        return d[:-10]
-    elif d in ('Unknown', '255'):
-        return e
-    else:
-        return d
 
 def h2(i):
     if type(i) == str:
@@ -44,17 +25,6 @@ def h2(i):
     return h
 
 
-class PCIDevice:
-    bus     = None
-    vendor  = None
-    device  = None
-
-    components = None
-
-
-class PCIBus:
-    pass
-
 # Primary Bus Number The bus number immediately upstream of the PCI-PCI Bridge,
 # Secondary Bus Number The bus number immediately downstream of the PCI-PCI Bridge,
 # Subordinate Bus Number The highest bus number of all of the busses that can be reached downstream of the bridge.
@@ -66,117 +36,241 @@ class PCIBus:
 # |           +-02.0-[1a]----00.0  Phison Electronics Corporation PS5013 E13 NVMe Controller
 # |           +-03.0-[1b]----00.0  Kingston Technology Company, Inc. Device 500f
 
-devices = {}
-for d in sorted(pathlib.Path('/sys/bus/pci/devices/').glob('*')):
-    dname = d.name[5:8]
-
-    child_bus_secondary = r(d / 'secondary_bus_number')
-    child_bus_subordinate = r(d / 'subordinate_bus_number')
-    if dname not in devices:
-        devices[dname] = {'devices':{}}
-
-    pclass = r(d / 'class')[2:]
-    pvendor = r(d / 'vendor')[2:]
-    pdevice = r(d / 'device')[2:]
-
-    if pvendor in pci_ids:
-        if pdevice in pci_ids[pvendor][-1]:
-            pdevice = (pdevice, pci_ids[pvendor][-1][pdevice])
-        else:
-            pdevice = (pdevice, '??? - Unknown device?')
-        pvendor = (pvendor, pci_ids[pvendor][0])
+
+def describe(rec, pci_ids):
+    """The `(class, vendor, device)` of a sysfs.SysfsDevice, named from pci.ids."""
+    pclass = '' if rec.pclass is None else '%06x' % rec.pclass
+    pvendor = '' if rec.vendor is None else '%04x' % rec.vendor
+    pdevice = '' if rec.device is None else '%04x' % rec.device
+
+    vname = None if rec.vendor is None else pci_ids.vendor(rec.vendor)
+    if vname is not None:
+        dname = None if rec.device is None else pci_ids.device(rec.vendor, rec.device)
+        pdevice = (pdevice, dname or '??? - Unknown device?')
+        pvendor = (pvendor, vname)
     else:
         pvendor = (pvendor, '??? - Unknown vendor?')
 
-    devices[dname]['devices'][d.name[5:]] = (pclass, pvendor, pdevice)
+    return (pclass, pvendor, pdevice)
+
+
+def scan(root=sysfs.SYSFS):
+    """Returns `{sysfs name: sysfs.SysfsDevice}` for every PCI device."""
+    return {d.name: d for d in sysfs.scan(root)}
+
+
+def topology(records, pci_ids):
+    """
+    Nests the buses behind the bridges which lead to them.  Only uses the
+    already read `records`, so is cheap to redo after every change.
+
+    >>> pci_ids = pciids.PciIds(pciids.build_index(
+    ...     '8086  Intel\\n\\t6f02  Root Port 1\\n\\t1533  I210\\n10b5  PLX\\n\\t9765  PEX 9765\\n'))
+    >>> print_topology(topology({d.name: d for d in [
+    ...     sysfs.SysfsDevice('0000:00:01.0', 0x060400, 0x8086, 0x6f02, secondary=1, subordinate=2),
+    ...     sysfs.SysfsDevice('0000:01:00.0', 0x060400, 0x10b5, 0x9765, secondary=2, subordinate=2),
+    ...     sysfs.SysfsDevice('0000:02:00.0', 0x020000, 0x8086, 0x1533),
+    ... ]}, pci_ids))
+    {'00:': {'01:': {'02:': {'devices': {'02:00.0': ('020000', ('8086', 'Intel'), ('1533', 'I210'))}},
+                     'devices': {'01:00.0': ('060400', ('10b5', 'PLX'), ('9765', 'PEX 9765'))}},
+             'devices': {'00:01.0': ('060400', ('8086', 'Intel'), ('6f02', 'Root Port 1'))}}}
+    <BLANKLINE>
+    """
+    t = topo.from_sysfs(records)
+
+    def forwarded(bus):
+        """Bus numbers forwarded by the bridges on `bus` (even empty ones)."""
+        keys = set()
+        for dev in bus.devices:
+            if isinstance(dev, topo.Bridge) and dev.subordinate is not None:
+                keys.update(h2(i) for i in range(bus.number+1, dev.subordinate+1))
+        return keys
+
+    def nest(bus):
+        # Each bus number shows up below the deepest bus forwarding it.
+        d = dict.fromkeys(forwarded(bus))
+        d['devices'] = {dev.slot: describe(dev.data, pci_ids) for dev in bus.devices}
+        for dev in bus.devices:
+            if isinstance(dev, topo.Bridge) and dev.child is not None:
+                for k in forwarded(dev.child):
+                    d.pop(k, None)
+                d[h2(dev.child.number)] = nest(dev.child)
+        return d
 
-    if child_bus_secondary != '?' and child_bus_subordinate != '?':
-        for i in range(int(dname[:-1], 16)+1, int(child_bus_subordinate)+1):
-            devices[dname][h2(i)] = None
+    return {h2(bus.number): nest(bus) for bus in t.roots}
 
-has_parent = set()
-for v in list(devices.values()):
-    for k in list(v.keys()):
-        if k == 'devices':
-            continue
-        if k not in v:
-            continue
-        if k not in devices:
-            continue
 
-        v[k] = devices[k]
-        for k2 in list(devices[k]):
-            if k2 == 'devices':
-                continue
-            if k2 in v:
-                del v[k2]
-        del devices[k]
+def q(v):
+    return '?' if v is None else v
 
 
-import pprint
-pprint.pprint(devices, width=150, compact=False)
-print()
-
-
-#for bus in sorted(pathlib.Path('/sys/devices/').glob('pci*')):
-#    bname = bus.name[3:]
-#    print(bname)
-#    for d in sorted(bus.glob('*')):
-#        if not d.name.startswith(bname):
-#            print('??', d)
-#            continue
-for d in sorted(pathlib.Path('/sys/bus/pci/devices/').glob('*')):
-        dname = d.name[5:]
-
-        link_speed = r(d / 'current_link_speed')
-        max_link_speed = r(d / 'max_link_speed')
-        link_width = 'x'+r(d / 'current_link_width')
-        max_link_width = 'x'+r(d / 'max_link_width')
-
-        child_bus_secondary = h2(r(d / 'secondary_bus_number'))
-        child_bus_subordinate = h2(r(d / 'subordinate_bus_number'))
+def speed(text):
+    """
+    A link speed as the kernel shows it, without the ' GT/s PCIe'.
+
+    >>> speed('8.0 GT/s PCIe'), speed('2.5 GT/s'), speed('Unknown'), speed(None)
+    ('8.0', '2.5 GT/s', '?', '?')
+    """
+    if text is None or text == 'Unknown':
+        return '?'
+    if text.endswith(' GT/s PCIe'):
+        return text[:-len(' GT/s PCIe')]
+    return text
+
+
+def print_topology(devices):
+    pprint.pprint(devices, width=150, compact=False)
+    print()
+
+
+def print_details(records, pci_ids):
+    #for bus in sorted(pathlib.Path('/sys/devices/').glob('pci*')):
+    #    bname = bus.name[3:]
+    #    print(bname)
+    #    for d in sorted(bus.glob('*')):
+    #        if not d.name.startswith(bname):
+    #            print('??', d)
+    #            continue
+    for name in sorted(records):
+        rec = records[name]
+        ids = describe(rec, pci_ids)
+
+        child_bus_secondary = h2('?' if rec.secondary is None else rec.secondary)
+        child_bus_subordinate = h2('?' if rec.subordinate is None else rec.subordinate)
         child_bus = (child_bus_secondary, child_bus_subordinate)
-        if child_bus_secondary != child_bus_subordinate:
-            pass
         if child_bus_secondary == '?' and child_bus_subordinate == '?':
             child_bus = None
 
-        pclass = r(d / 'class')[2:]
-        pvendor = r(d / 'vendor')[2:]
-        pdevice = r(d / 'device')[2:]
-
-        if pvendor in pci_ids:
-            if pdevice in pci_ids[pvendor][-1]:
-                pdevice = (pdevice, pci_ids[pvendor][-1][pdevice])
-            else:
-                pdevice = (pdevice, '??? - Unknown device?')
-            pvendor = (pvendor, pci_ids[pvendor][0])
-        else:
-            pvendor = (pvendor, '??? - Unknown vendor?')
-
-        res = []
-        try:
-            N = '0x0000000000000000'
-            for l in open(d / 'resource'):
-                a, b, c = l.strip().split(' ')
-                if a == N and b == N and c == N:
-                    continue
-                res.append((a, b, c))
-        except FileNotFoundError:
-            pass
-        res.sort()
-
-        if 'Root Port' in pdevice[-1]:
+        if 'Root Port' in ids[-1][-1]:
             print()
             print('-----')
             print()
 
-        print('  ', dname, (pclass, pvendor, pdevice), '%s/%s' % (link_speed, max_link_speed), '%s/%s' % (link_width, max_link_width))
+        link_speed = '%s/%s' % (speed(rec.link_speed_text), speed(rec.max_link_speed_text))
+        link_width = 'x%s/x%s' % (q(rec.link_width), q(rec.max_link_width))
+
+        print('  ', rec.slot, ids, link_speed, link_width)
         if child_bus:
             print('    -> ', child_bus)
-        for start, end, size in res:
-            print('    ', start, end, size)
+        for start, end, flags in sorted(rec.resources):
+            print('    ', '0x%016x' % start, '0x%016x' % end, '0x%016x' % flags)
+
+    #    pbus = bus / 'pci_bus' / bname
+    #    print() #list(sorted(pbus.glob('*'))))
+
+
+# Kernel uevents are broadcast on netlink multicast group 1 of this protocol
+# (udev rebroadcasts its own processed version on group 2).
+NETLINK_KOBJECT_UEVENT = 15
+
+
+def uevent_socket():
+    s = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    s.bind((0, 1))
+    return s
+
+
+def parse_uevent(data):
+    """
+    >>> pprint.pprint(parse_uevent(
+    ...     b'remove@/devices/pci0000:00/0000:00:1c.0/0000:02:00.0\\0ACTION=remove\\0'
+    ...     b'DEVPATH=/devices/pci0000:00/0000:00:1c.0/0000:02:00.0\\0SUBSYSTEM=pci\\0'
+    ...     b'PCI_SLOT_NAME=0000:02:00.0\\0SEQNUM=4242\\0'), sort_dicts=False)
+    {'ACTION': 'remove',
+     'DEVPATH': '/devices/pci0000:00/0000:00:1c.0/0000:02:00.0',
+     'SUBSYSTEM': 'pci',
+     'PCI_SLOT_NAME': '0000:02:00.0',
+     'SEQNUM': '4242'}
+    >>> parse_uevent(b'libudev\\0\\xfe\\xed\\xca\\xfe') is None
+    True
+    """
+    header, *fields = data.decode('utf-8', 'replace').split('\0')
+    if '@' not in header:
+        return None
+    event = {}
+    for f in fields:
+        if '=' in f:
+            k, v = f.split('=', 1)
+            event[k] = v
+    return event
+
+
+def watch(sock, records, pci_ids, root=sysfs.SYSFS, settle=0.5):
+    """
+    Waits for PCI uevents on `sock` and re-reads only the devices they name,
+    updating `records` in place.  Events arriving within `settle` seconds of
+    each other (a hotplugged switch brings a burst of them) are handled
+    together.
+
+    Yields `(changes, topology)` after each burst, where `changes` is
+    `{sysfs name: last action}`.
+    """
+    while True:
+        changes = {}
+        timeout = None
+        while True:
+            ready, _, _ = select.select([sock], [], [], timeout)
+            if not ready:
+                break
+            event = parse_uevent(sock.recv(1 << 16))
+            timeout = settle
+            if not event or event.get('SUBSYSTEM') != 'pci':
+                continue
+            name = event.get('PCI_SLOT_NAME', None)
+            if name:
+                changes[name] = event.get('ACTION', '?')
 
-#    pbus = bus / 'pci_bus' / bname
-#    print() #list(sorted(pbus.glob('*'))))
+        if not changes:
+            continue
+
+        for name, action in changes.items():
+            d = os.path.join(root, name)
+            if action == 'remove' or not os.path.exists(d):
+                records.pop(name, None)
+            else:
+                records[name] = sysfs.read_device(d)
 
+        yield changes, topology(records, pci_ids)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Show the PCI bus topology from sysfs.')
+    parser.add_argument('--pci-ids', default=pciids.PCI_IDS, help='pci.ids file to name devices from')
+    parser.add_argument('--watch', action='store_true', help='keep running and reprint the topology when devices come and go')
+    parser.add_argument('--settle', type=float, default=0.5, help='seconds to wait for more events before reprinting')
+    opts = parser.parse_args(args[1:])
+
+    pci_ids = pciids.load(opts.pci_ids)
+
+    # Subscribe before the initial scan so nothing added during it is missed.
+    sock = uevent_socket() if opts.watch else None
+
+    records = scan()
+    print_topology(topology(records, pci_ids))
+    print_details(records, pci_ids)
+
+    if not sock:
+        return 0
+
+    try:
+        for changes, devices in watch(sock, records, pci_ids, settle=opts.settle):
+            print()
+            print('=====')
+            for name, action in sorted(changes.items()):
+                print('  ', action, name)
+            print()
+            print_topology(devices)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+    return 0
+
+
+if __name__ == "__main__":
+    import doctest
+    if doctest.testmod().failed > 0:
+        sys.exit(1)
+    sys.exit(main(sys.argv))
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+import sys
+
+# Name lookups from the pci.ids database.
+#
+# Parsing the whole text file takes longer than most of the tools take to run,
+# so it is parsed once into a compact binary index which is cached on disk and
+# memory mapped on later runs.  The index has one section per level of the
+# file, each a sorted array of integer keys plus the offsets of the names in a
+# shared utf-8 blob, so every lookup is a bisect over the mapped file.
+#
+# It is used wherever the tools read raw IDs: pcie-scan.py and pciconfig.py
+# (so `lspci.py --sysfs`).  lspci.py and pcie-explore.py otherwise read lspci's
+# own output, where lspci has already resolved the names from the same file.
+#
+#   magic      8s   b'PCIIDIDX'
+#   version    I
+#   sections   I
+#   directory  sections x (count Q, keys offset Q, names offset Q)
+#   keys       count x Q  (sorted)
+#   names      (count + 1) x I  offsets into the blob
+#   blob       utf-8 names, back to back
+
+PCI_IDS = '/usr/share/misc/pci.ids'
+
+MAGIC = b'PCIIDIDX'
+VERSION = 1
+
+HEADER = struct.Struct('<8sII')
+ENTRY = struct.Struct('<QQQ')
+
+# Sections and how their keys are made.
+VENDOR = 0      # vendor
+DEVICE = 1      # vendor << 16 | device
+SUBSYSTEM = 2   # vendor << 48 | device << 32 | subvendor << 16 | subdevice
+CLASS = 3       # class
+SUBCLASS = 4    # class << 8 | subclass
+PROG_IF = 5     # class << 16 | subclass << 8 | prog-if
+SECTIONS = 6
+
+
+def parse_pci_ids(text):
+    """
+    Returns a `{(section, key): name}` dict for the contents of a pci.ids file.
+
+    >>> ids = parse_pci_ids('''\\
+    ... # comment
+    ... 10de  NVIDIA Corporation
+    ... \\t1db1  GV100GL [Tesla V100 SXM2 16GB]
+    ... \\t\\t10de 1212  Tesla V100-SXM2-16GB
+    ... C 03  Display controller
+    ... \\t02  3D controller
+    ... \\t00  VGA compatible controller
+    ... \\t\\t00  VGA controller
+    ... ''')
+    >>> for (section, key), name in sorted(ids.items()):
+    ...     print(section, hex(key), name)
+    0 0x10de NVIDIA Corporation
+    1 0x10de1db1 GV100GL [Tesla V100 SXM2 16GB]
+    2 0x10de1db110de1212 Tesla V100-SXM2-16GB
+    3 0x3 Display controller
+    4 0x300 VGA compatible controller
+    4 0x302 3D controller
+    5 0x30000 VGA controller
+    """
+    ids = {}
+    classes = False
+    top = sub = None
+    for line in text.splitlines():
+        if not line.strip() or line.startswith('#'):
+            continue
+        depth = len(line) - len(line.lstrip('\t'))
+        fields, _, name = line.strip().partition('  ')
+        name = name.strip()
+
+        if depth == 0:
+            if line.startswith('C '):
+                classes = True
+                top = int(fields[2:], 16)
+                ids[(CLASS, top)] = name
+            else:
+                classes = False
+                top = int(fields, 16)
+                ids[(VENDOR, top)] = name
+        elif depth == 1:
+            sub = int(fields, 16)
+            if classes:
+                ids[(SUBCLASS, top << 8 | sub)] = name
+            else:
+                ids[(DEVICE, top << 16 | sub)] = name
+        else:
+            if classes:
+                ids[(PROG_IF, top << 16 | sub << 8 | int(fields, 16))] = name
+            else:
+                subvendor, subdevice = (int(x, 16) for x in fields.split())
+                ids[(SUBSYSTEM, top << 48 | sub << 32 | subvendor << 16 | subdevice)] = name
+    return ids
+
+
+def build_index(text):
+    """Returns the binary index for the contents of a pci.ids file."""
+    sections = [[] for _ in range(SECTIONS)]
+    for (section, key), name in parse_pci_ids(text).items():
+        sections[section].append((key, name))
+
+    directory = []
+    data = []
+    offset = HEADER.size + ENTRY.size * SECTIONS
+    for entries in sections:
+        entries.sort()
+        keys = struct.pack('<{}Q'.format(len(entries)), *(k for k, _ in entries))
+        blob = [n.encode('utf-8') for _, n in entries]
+        starts = [0]
+        for b in blob:
+            starts.append(starts[-1] + len(b))
+        names = struct.pack('<{}I'.format(len(starts)), *starts)
+        blob = b''.join(blob)
+        pad = b'\0' * (-len(blob) % 8)
+
+        directory.append(ENTRY.pack(len(entries), offset, offset + len(keys)))
+        data.extend((keys, names, blob, pad))
+        offset += len(keys) + len(names) + len(blob) + len(pad)
+
+    return HEADER.pack(MAGIC, VERSION, SECTIONS) + b''.join(directory) + b''.join(data)
+
+
+class PciIds:
+    """
+    >>> ids = PciIds(build_index('''\\
+    ... 10b5  PLX Technology, Inc.
+    ... \\t9765  PEX 9765 65-lane, 17-port PCIe Gen3 ExpressFabric Switch
+    ... 10de  NVIDIA Corporation
+    ... \\t1db1  GV100GL [Tesla V100 SXM2 16GB]
+    ... \\t\\t10de 1212  Tesla V100-SXM2-16GB
+    ... C 03  Display controller
+    ... \\t02  3D controller
+    ... '''))
+    >>> ids.vendor(0x10de), ids.device(0x10de, 0x1db1)
+    ('NVIDIA Corporation', 'GV100GL [Tesla V100 SXM2 16GB]')
+    >>> ids.subsystem(0x10de, 0x1db1, 0x10de, 0x1212)
+    'Tesla V100-SXM2-16GB'
+    >>> ids.device(0x10de, 0x1db0) is None
+    True
+    >>> ids.pclass(0x030200)
+    ('Display controller', '3D controller', None)
+    >>> ids.resolve_many([(0x10de, 0x1db1), (0x10b5, 0x9765), (0x8086, 0x1533)])
+    [('NVIDIA Corporation', 'GV100GL [Tesla V100 SXM2 16GB]'), ('PLX Technology, Inc.', 'PEX 9765 65-lane, 17-port PCIe Gen3 ExpressFabric Switch'), (None, None)]
+    """
+
+    def __init__(self, buf):
+        self._buf = memoryview(buf)
+        magic, version, count = HEADER.unpack_from(self._buf, 0)
+        assert magic == MAGIC, magic
+        assert version == VERSION, version
+        assert count == SECTIONS, count
+
+        self._sections = []
+        for i in range(count):
+            n, keys, names = ENTRY.unpack_from(self._buf, HEADER.size + ENTRY.size * i)
+            self._sections.append((
+                self._buf[keys:keys + 8*n].cast('Q'),
+                self._buf[names:names + 4*(n+1)].cast('I'),
+                names + 4*(n+1),
+            ))
+
+    def __len__(self):
+        return sum(len(keys) for keys, _, _ in self._sections)
+
+    def _name(self, section, i):
+        keys, names, blob = self._sections[section]
+        return bytes(self._buf[blob + names[i]:blob + names[i+1]]).decode('utf-8')
+
+    def _find(self, section, key, lo=0):
+        keys = self._sections[section][0]
+        i = bisect.bisect_left(keys, key, lo)
+        return i, i < len(keys) and keys[i] == key
+
+    def lookup(self, section, key):
+        i, found = self._find(section, key)
+        return self._name(section, i) if found else None
+
+    def vendor(self, vendor):
+        return self.lookup(VENDOR, vendor)
+
+    def device(self, vendor, device):
+        return self.lookup(DEVICE, vendor << 16 | device)
+
+    def subsystem(self, vendor, device, subvendor, subdevice):
+        return self.lookup(SUBSYSTEM, vendor << 48 | device << 32 | subvendor << 16 | subdevice)
+
+    def pclass(self, pclass):
+        """The class, subclass and prog-if names of a 24 bit class code."""
+        c, s, p = pclass >> 16, (pclass >> 8) & 0xff, pclass & 0xff
+        return (self.lookup(CLASS, c), self.lookup(SUBCLASS, c << 8 | s), self.lookup(PROG_IF, c << 16 | s << 8 | p))
+
+    def lookup_many(self, section, keys):
+        """
+        Looks up all of `keys` at once.  They are resolved in sorted order so
+        each bisect only searches above the previous hit.
+        """
+        found = {}
+        lo = 0
+        for key in sorted(set(keys)):
+            lo, hit = self._find(section, key, lo)
+            if hit:
+                found[key] = self._name(section, lo)
+        return [found.get(k, None) for k in keys]
+
+    def resolve_many(self, ids):
+        """`[(vendor name, device name)]` for each `(vendor, device)` in `ids`."""
+        ids = list(ids)
+        vendors = self.lookup_many(VENDOR, [v for v, d in ids])
+        devices = self.lookup_many(DEVICE, [v << 16 | d for v, d in ids])
+        return list(zip(vendors, devices))
+
+
+def cache_path(source, cache_dir=None):
+    """The cached index for `source`, keyed on its path, size and mtime."""
+    if cache_dir is None:
+        import lspci
+        cache_dir = lspci.CACHE_DIR
+    st = os.stat(source)
+    h = hashlib.sha256('{}\0{}\0{}\0{}'.format(VERSION, os.path.abspath(source), st.st_size, st.st_mtime_ns).encode('utf-8'))
+    return os.path.join(cache_dir, 'pci.ids.{}.idx'.format(h.hexdigest()[:32]))
+
+
+def load(source=PCI_IDS, cache_dir=None):
+    """
+    Returns a PciIds for the pci.ids file `source`, building and caching the
+    index if needed.  A missing `source` gives an empty database.
+    """
+    try:
+        path = cache_path(source, cache_dir)
+    except FileNotFoundError:
+        return PciIds(build_index(''))
+
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        with open(source, encoding='utf-8', errors='replace') as s:
+            data = build_index(s.read())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp, 'wb') as t:
+                t.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+        return PciIds(data)
+
+    with f:
+        return PciIds(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+_default = []
+
+
+def default():
+    """The system pci.ids, loaded on first use."""
+    if not _default:
+        _default.append(load())
+    return _default[0]
+
+
+def main(args):
+    import argparse
+    parser = argparse.ArgumentParser(description='Look up PCI ids (VENDOR[:DEVICE[:SUBVENDOR:SUBDEVICE]] in hex).')
+    parser.add_argument('ids', nargs='+', metavar='ID')
+    parser.add_argument('--pci-ids', default=PCI_IDS, help='pci.ids file')
+    opts = parser.parse_args(args[1:])
+
+    ids = load(opts.pci_ids)
+    for arg in opts.ids:
+        parts = [int(x, 16) for x in arg.split(':')]
+        names = [ids.vendor(parts[0])]
+        if len(parts) > 1:
+            names.append(ids.device(*parts[:2]))
+        if len(parts) > 3:
+            names.append(ids.subsystem(*parts[:4]))
+        print(arg, ' / '.join(n or '?' for n in names))
+    return 0
+
+
+if __name__ == "__main__":
+    import doctest
+    if doctest.testmod().failed > 0:
+        sys.exit(1)
+    sys.exit(main(sys.argv))
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+
+import argparse
+import re
+import shlex
+import sys
+
+import lspci
+
+# Picks devices out of parsed lspci output instead of printing everything.
+#
+# An Index is built once over the devices, mapping the class, vendor/device,
+# driver and capability names to the devices which have them and each
+# register name (LnkSta, Control, ...) to the devices and capabilities it is
+# found in.  A query only looks at the devices the index gives for the
+# registers and values it names, and only those capabilities get their
+# properties decoded (see lspci.parse_device(lazy=True)).
+#
+# A condition is `FIELD`, true when the field is there and set, or
+# `FIELD OP VALUE` where OP is one of == != < <= > >= or ~ (regex search) and
+# VALUE is a literal or another field.  Conditions are joined with `and`.
+#
+#   BDF Name Class Description Driver  from the device line
+#   Vendor Device                       the ids, with `lspci -nn` output
+#   Cap                                 names of the capabilities
+#   REGISTER[.FIELD...]                 e.g. LnkSta.Width, Control.BusMaster
+#
+# Registers are looked up in the device first, then in its capabilities in
+# order.  Values are compared as numbers when both start with one ('8GT/s
+# (ok)' < '16GT/s', 'x8' < 'x16'), as strings otherwise; `+` and `-` are True
+# and False.
+
+COLUMNS = ('BDF', 'Name', 'Class', 'Description', 'Vendor', 'Device', 'Driver', 'Cap')
+
+# Columns with few distinct values, which are indexed by value.
+INDEXED = ('Class', 'Vendor', 'Device', 'Driver', 'Cap')
+
+RE_IDS = re.compile(r' \[([\da-f]{4}):([\da-f]{4})\]')
+RE_CLASS_ID = re.compile(r' \[[\da-f]{4}\]$')
+RE_NUMBER = re.compile(r'^[x#]?(\d+(?:\.\d+)?)')
+
+class QueryError(ValueError):
+    """A --where condition or --select field which can't be used."""
+
+
+OPS = {
+    '==': lambda a, b: a == b,
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+
+def cap_name(cap):
+    """
+    >>> cap_name(lspci.parse_caps('Capabilities: [40] Express (v2) Root Port (Slot-), MSI 00'))
+    'Express'
+    >>> cap_name(lspci.parse_caps('Capabilities: [50] MSI: Enable+ Count=1/1 Maskable- 64bit+'))
+    'MSI'
+    >>> cap_name(lspci.parse_caps('Capabilities: [100 v1] Advanced Error Reporting'))
+    'Advanced Error Reporting'
+    """
+    if cap.vendor is not None:
+        return 'Vendor Specific Information'
+    name = cap.types[0] if cap.types else cap.name
+    return name.split(':', 1)[0].split(' (', 1)[0].replace(' <?>', '')
+
+
+def columns(name, details):
+    """The COLUMNS of a device."""
+    slot, _, rest = name.partition(' ')
+    kind, _, description = rest.partition(': ')
+    m = RE_IDS.search(description)
+    return {
+        'BDF': slot,
+        'Name': name,
+        'Class': RE_CLASS_ID.sub('', kind),
+        'Description': description,
+        'Vendor': m.group(1) if m else None,
+        'Device': m.group(2) if m else None,
+        'Driver': details.get('Kernel driver in use', None),
+        'Cap': [cap_name(c) for c in details.get('Capabilities', [])],
+    }
+
+
+class Index:
+    """
+    >>> index = Index(lspci.parse_lspci_output(
+    ...     "00:02.0 PCI bridge [0604]: Intel Corporation Root Port 2 [8086:6f04]\\n"
+    ...     "\\tControl: I/O+ Mem+ BusMaster+ SpecCycle- MemWINV- VGASnoop- ParErr- Stepping- SERR- FastB2B- DisINTx-\\n"
+    ...     "\\tCapabilities: [90] Express (v2) Root Port (Slot-), MSI 00\\n"
+    ...     "\\t\\tLnkCap:\\tPort #3, Speed 8GT/s, Width x16, ASPM not supported\\n"
+    ...     "\\t\\tLnkSta:\\tSpeed 8GT/s (ok), Width x16 (ok)\\n"
+    ...     "\\tKernel driver in use: pcieport\\n"
+    ...     "\\n"
+    ...     "04:00.0 3D controller [0302]: NVIDIA Corporation GV100GL [10de:1db1] (rev a1)\\n"
+    ...     "\\tControl: I/O- Mem+ BusMaster+ SpecCycle- MemWINV- VGASnoop- ParErr- Stepping- SERR+ FastB2B- DisINTx+\\n"
+    ...     "\\tCapabilities: [68] Express (v2) Endpoint, MSI 00\\n"
+    ...     "\\t\\tLnkCap:\\tPort #0, Speed 8GT/s, Width x16, ASPM L0s L1\\n"
+    ...     "\\t\\tLnkSta:\\tSpeed 2.5GT/s (downgraded), Width x8 (downgraded)\\n"
+    ...     "\\tKernel driver in use: nvidia\\n"
+    ...     "\\n", lazy=True))
+    >>> index.by['Vendor']
+    {'8086': [0], '10de': [1]}
+    >>> for row in index.select(['LnkSta.Speed < LnkCap.Speed'], ['BDF', 'Vendor', 'LnkSta']):
+    ...     print(*row)
+    04:00.0 10de Speed 2.5GT/s (downgraded), Width x8 (downgraded)
+    >>> for row in index.select(['Control.I/O == +', 'Cap ~ ^Express$'], ['Name']):
+    ...     print(*row)
+    00:02.0 PCI bridge [0604]: Intel Corporation Root Port 2 [8086:6f04]
+    >>> list(index.select(['LnkSta.Width >= x16 and Driver == nvidia']))
+    []
+    >>> list(index.select(['Class == "3D controller"'], ['Driver', 'LnkCap.Port #']))
+    [('nvidia', '0')]
+    >>> for where in ['LnkSta.Speed <> 8GT/s', 'LnkSpeed < 8GT/s', 'Name ~ (', "Name == 'x"]:
+    ...     try:
+    ...         list(index.select([where]))
+    ...     except QueryError as e:
+    ...         print(e)
+    unknown operator '<>'
+    unknown field 'LnkSpeed'
+    (: missing ), unterminated subpattern at position 0
+    Name == 'x: No closing quotation
+    """
+
+    def __init__(self, devices):
+        self.devices = list(devices)
+        self.columns = []
+        self.by = {c: {} for c in INDEXED}
+        # {register: [device index]}
+        self.registers = {}
+        # Per device {register: the capability it is in, or None}, the first
+        # place the device has it.
+        self.places = []
+        for i, (name, details) in enumerate(self.devices):
+            cols = columns(name, details)
+            self.columns.append(cols)
+            for c in INDEXED:
+                values = cols[c] if isinstance(cols[c], list) else [cols[c]]
+                for v in dict.fromkeys(values):
+                    if v is not None:
+                        self.by[c].setdefault(v, []).append(i)
+
+            places = {}
+            for key in details:
+                if key != 'Capabilities':
+                    places[key] = None
+            for cap in details.get('Capabilities', []):
+                for key in cap.registers():
+                    places.setdefault(key, cap)
+            self.places.append(places)
+            for key in places:
+                self.registers.setdefault(key, []).append(i)
+
+    def __len__(self):
+        return len(self.devices)
+
+    def is_field(self, s):
+        return s in COLUMNS or s.split('.', 1)[0] in self.registers
+
+    def lookup(self, field):
+        """The indexes of the devices which could have `field`, or None for all."""
+        if field in COLUMNS:
+            return None
+        return self.registers.get(field.split('.', 1)[0], [])
+
+    def value(self, i, field):
+        """The value of `field` for device `i`, or None if it doesn't have it."""
+        if field in COLUMNS:
+            return self.columns[i][field]
+        register, *path = field.split('.')
+        places = self.places[i]
+        if register not in places:
+            return None
+        cap = places[register]
+        if cap is None:
+            v = self.devices[i][1][register]
+        else:
+            v = cap.properties[register]
+        for p in path:
+            if not isinstance(v, dict) or p not in v:
+                return None
+            v = v[p]
+        return v
+
+    def parse(self, where):
+        """
+        The conditions of the `where` strings, as `(field, op, value)` where
+        `value` is a literal or `(field,)`.
+        """
+        conditions = []
+        for w in where:
+            try:
+                tokens = shlex.split(w)
+            except ValueError as e:
+                raise QueryError('{}: {}'.format(w, e)) from None
+            while tokens:
+                if 'and' in tokens:
+                    cond, tokens = tokens[:tokens.index('and')], tokens[tokens.index('and')+1:]
+                else:
+                    cond, tokens = tokens, []
+                if len(cond) == 1:
+                    cond = [cond[0], None, None]
+                if len(cond) != 3:
+                    raise QueryError('{}: expected FIELD [OP VALUE]'.format(w))
+                field, op, value = cond
+                if not self.is_field(field):
+                    raise QueryError('unknown field {!r}'.format(field))
+                if op is not None and op != '~' and op not in OPS:
+                    raise QueryError('unknown operator {!r}'.format(op))
+                if op is not None and self.is_field(value):
+                    value = (value,)
+                elif op == '~':
+                    try:
+                        value = re.compile(value)
+                    except re.error as e:
+                        raise QueryError('{}: {}'.format(value, e)) from None
+                conditions.append((field, op, value))
+        return conditions
+
+    def candidates(self, conditions):
+        """The indexes of the devices which the index can't rule out."""
+        found = None
+        for field, op, value in conditions:
+            sets = []
+            if op in ('==', '=') and field in self.by and isinstance(value, str):
+                sets.append(self.by[field].get(value, []))
+            for f in [field] + ([value[0]] if isinstance(value, tuple) else []):
+                s = self.lookup(f)
+                if s is not None:
+                    sets.append(s)
+            for s in sets:
+                found = set(s) if found is None else found & set(s)
+        if found is None:
+            return range(len(self.devices))
+        return sorted(found)
+
+    def match(self, i, conditions):
+        for field, op, value in conditions:
+            v = self.value(i, field)
+            if op is None:
+                if not v:
+                    return False
+                continue
+            if v is None:
+                return False
+            if isinstance(value, tuple):
+                value = self.value(i, value[0])
+                if value is None:
+                    return False
+            values = v if isinstance(v, list) else [v]
+            if op == '~':
+                if not any(value.search(format_value(x)) for x in values):
+                    return False
+            elif not any(compare(x, op, value) for x in values):
+                return False
+        return True
+
+    def select(self, where=(), select=None):
+        """
+        Yields a tuple of the formatted `select` fields (by default the device
+        line and the fields in `where`) of each device matching all the
+        `where` conditions.
+        """
+        conditions = self.parse(where)
+        if not select:
+            select = ['Name'] + [c[0] for c in conditions if c[0] != 'Name']
+        for f in select:
+            if not self.is_field(f):
+                raise QueryError('unknown field {!r}'.format(f))
+        for i in self.candidates(conditions):
+            if self.match(i, conditions):
+                yield tuple(format_value(self.value(i, f)) for f in select)
+
+
+def _key(v):
+    """
+    >>> _key('8GT/s (ok)'), _key('x16'), _key(True), _key('fast')
+    (8.0, 16.0, True, 'fast')
+    """
+    if isinstance(v, (bool, int, float)):
+        return v
+    if v in ('+', '-'):
+        return v == '+'
+    s = str(v)
+    m = RE_NUMBER.match(s)
+    if m:
+        return float(m.group(1))
+    return s
+
+
+def compare(a, op, b):
+    a, b = _key(a), _key(b)
+    if isinstance(a, str) != isinstance(b, str):
+        a, b = str(a), str(b)
+    return OPS[op](a, b)
+
+
+def format_value(v):
+    """
+    >>> format_value({'Speed': '8GT/s (ok)', 'Width': 'x16 (ok)', 'BusMaster': True, 'Latency L0s': None})
+    'Speed 8GT/s (ok), Width x16 (ok), BusMaster+, Latency L0s'
+    >>> format_value(['nvidiafb', 'nouveau']), format_value(None), format_value(2)
+    ('nvidiafb nouveau', '-', '2')
+    """
+    if v is None:
+        return '-'
+    if isinstance(v, bool):
+        return '+' if v else '-'
+    if isinstance(v, dict):
+        parts = []
+        for k, x in v.items():
+            if x is None:
+                parts.append(k)
+            elif isinstance(x, bool):
+                parts.append(k + ('+' if x else '-'))
+            else:
+                parts.append('{} {}'.format(k, format_value(x)))
+        return ', '.join(parts)
+    if isinstance(v, (list, tuple)):
+        return ' '.join(format_value(x) for x in v)
+    return str(v)
+
+
+def run(devices, where=(), select=None):
+    """Prints the rows of `select` for the matching `devices`, tab separated."""
+    index = Index(devices)
+    rows = 0
+    for row in index.select(where or (), select):
+        print(*row, sep='\t')
+        rows += 1
+    return 0 if rows else 1
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Print selected fields of the PCI devices matching some conditions.')
+    parser.add_argument('snapshots', nargs='*', metavar='LSPCI_VVV', help='lspci -vvv output (default: ./lspci.vvv or the running system)')
+    parser.add_argument('--where', action='append', metavar='EXPR', help="e.g. 'LnkSta.Speed < LnkCap.Speed', can be repeated")
+    parser.add_argument('--select', metavar='FIELDS', help='comma separated fields to print, e.g. BDF,LnkSta')
+    opts = parser.parse_args(args[1:])
+    select = opts.select.split(',') if opts.select else None
+
+    try:
+        if not opts.snapshots:
+            return run(lspci.lspci_devices(lazy=True), opts.where, select)
+
+        ret = 1
+        for path in opts.snapshots:
+            with open(path, 'rb') as f:
+                devices = lspci.cached_parse(f.read(), lazy=True)
+            if len(opts.snapshots) > 1:
+                print('==>', path, '<==')
+            if run(devices, opts.where, select) == 0:
+                ret = 0
+        return ret
+    except QueryError as e:
+        parser.error(str(e))
+
+
+if __name__ == "__main__":
+    import doctest
+    if doctest.testmod().failed > 0:
+        sys.exit(1)
+    sys.exit(main(sys.argv))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+# Text reports built up in memory and written out in one go.
+#
+# The memory map of a big host runs to thousands of rows, and calling print()
+# with a handful of arguments for each (and asking the terminal for its width
+# on every row) costs more than working the rows out.  A Renderer keeps the
+# lines in a list, looks the width up once and writes everything with a
+# single write(), to stdout or straight to a file.
+
+
+def twidth():
+    w = os.environ.get('WIDTH', None)
+    if w:
+        return int(w)
+    t = os.get_terminal_size(0)
+    return t.columns
+
+
+def hexpad(n, width, fill='0'):
+    """
+    >>> hexpad(0xc0000, 12), hexpad(0x4000, 12, ' ')
+    ('0000000c0000', '        4000')
+    """
+    return format(n, 'x').rjust(width, fill)
+
+
+class Renderer:
+    """
+    Collects lines of output.  Subtrees deeper than `max_depth` are collapsed
+    by the tree renderers (pmem) using it.
+
+    >>> r = Renderer(width=12)
+    >>> r.line('|', '', 'a', 1)
+    >>> r.line()
+    >>> r.rule('-')
+    >>> r.write()
+    |  a 1
+    <BLANKLINE>
+    ------------
+    >>> len(r)
+    0
+    """
+
+    def __init__(self, width=None, max_depth=None):
+        self._width = width
+        self.max_depth = max_depth
+        self.lines = []
+
+    @property
+    def width(self):
+        """The terminal width (or $WIDTH), found the first time it is needed."""
+        if self._width is None:
+            self._width = twidth()
+        return self._width
+
+    def collapsed(self, depth):
+        """True if the children of a row at `depth` aren't to be shown."""
+        return self.max_depth is not None and depth + 1 >= self.max_depth
+
+    def __len__(self):
+        return len(self.lines)
+
+    def line(self, *parts):
+        """Adds a line of `parts` separated by spaces, as print() would."""
+        self.lines.append(' '.join([p if isinstance(p, str) else str(p) for p in parts]))
+
+    def rule(self, c='-'):
+        self.lines.append(c * self.width)
+
+    def getvalue(self):
+        if not self.lines:
+            return ''
+        return '\n'.join(self.lines) + '\n'
+
+    def write(self, out=None):
+        """
+        Writes the lines to `out` (a file object or a path, stdout by default)
+        and empties the buffer.
+        """
+        data = self.getvalue()
+        self.lines = []
+        if out is None:
+            out = sys.stdout
+        if isinstance(out, str):
+            with open(out, 'w', encoding='utf-8') as f:
+                f.write(data)
+        else:
+            out.write(data)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import sys
+
+import lspci
+
+# Diffs lspci snapshots of the same machine (see 4028GR-TVRT/pcie/scan*.lspci).
+#
+# Each device block is hashed and only the blocks whose hash changed get
+# parsed.  Parsed blocks are memoized by hash, so diffing a chain of snapshots
+# (scan1 -> scan2 -> ...) parses each distinct block once.
+
+
+def split_blocks(text):
+    """
+    Returns `{slot: block}` for every device in the lspci output `text`.  A
+    device is a non-indented line plus the indented lines after it; repeated
+    lines for the same slot (as `lspci -PP` output has) are merged.
+
+    >>> split_blocks('00:01.0 PCI bridge: Root Port\\n\\tControl: I/O+\\n\\n00:01.0/01:00.0 RAID\\n00:01.0/01:00.0\\n')
+    {'00:01.0': '00:01.0 PCI bridge: Root Port\\n\\tControl: I/O+', '00:01.0/01:00.0': '00:01.0/01:00.0 RAID\\n00:01.0/01:00.0'}
+    """
+    blocks = {}
+    current = None
+    for line in text.splitlines():
+        if not line.strip():
+            current = None
+            continue
+        if line[0] == '\t':
+            assert current is not None, line
+            current.append(line)
+            continue
+        current = blocks.setdefault(line.split(' ', 1)[0], [])
+        current.append(line)
+    return {slot: '\n'.join(lines) for slot, lines in blocks.items()}
+
+
+def block_hash(block):
+    return hashlib.blake2b(block.encode('utf-8'), digest_size=16).digest()
+
+
+class Differ:
+    """
+    >>> old = '''\\
+    ... 00:02.0 PCI bridge: Intel Corporation Root Port 2
+    ... \\tMemory behind bridge: 90000000-92ffffff [size=48M] [32-bit]
+    ... \\tCapabilities: [90] Express (v2) Root Port (Slot-), MSI 00
+    ... \\t\\tLnkSta:\\tSpeed 8GT/s, Width x16
+    ... \\t\\t\\tTrErr- Train- SlotClk+ DLActive+ BWMgmt- ABWMgmt-
+    ...
+    ... 03:00.0 3D controller: NVIDIA Corporation GV100GL
+    ... \\tRegion 0: Memory at 90000000 (32-bit, non-prefetchable) [size=16M]
+    ...
+    ... 04:00.0 Ethernet controller: Intel Corporation I350
+    ... '''
+    >>> new = old.replace('8GT/s, Width x16', '2.5GT/s (downgraded), Width x8 (downgraded)')
+    >>> new = new.replace('92ffffff [size=48M]', '93ffffff [size=64M]')
+    >>> new = new.replace('04:00.0 Ethernet', '05:00.0 Ethernet')
+    >>> d = Differ()
+    >>> for change in d.diff(old, new):
+    ...     print(*change)
+    removed 04:00.0 04:00.0 Ethernet controller: Intel Corporation I350
+    added 05:00.0 05:00.0 Ethernet controller: Intel Corporation I350
+    changed 00:02.0 LnkSta.Speed 8GT/s 2.5GT/s (downgraded)
+    changed 00:02.0 LnkSta.Width x16 x8 (downgraded)
+    changed 00:02.0 memory window 0x90000000-0x92ffffff 0x90000000-0x93ffffff
+    >>> d.parsed
+    2
+    """
+
+    def __init__(self):
+        self._blocks = {}
+        self.parsed = 0
+
+    def parse(self, block):
+        h = block_hash(block)
+        if h not in self._blocks:
+            self.parsed += 1
+            if '\n\t' in block:
+                self._blocks[h] = lspci.parse_lspci_output(block + '\n\n')[0]
+            else:
+                self._blocks[h] = (block.split('\n', 1)[0], {})
+        return self._blocks[h]
+
+    def diff(self, old_text, new_text):
+        """
+        Yields `('added', slot, name)`, `('removed', slot, name)` and
+        `('changed', slot, register, old, new)` tuples.
+        """
+        old = {slot: (block_hash(b), b) for slot, b in split_blocks(old_text).items()}
+        new = {slot: (block_hash(b), b) for slot, b in split_blocks(new_text).items()}
+
+        for slot in sorted(old.keys() - new.keys()):
+            yield ('removed', slot, old[slot][1].split('\n', 1)[0])
+        for slot in sorted(new.keys() - old.keys()):
+            yield ('added', slot, new[slot][1].split('\n', 1)[0])
+
+        for slot in sorted(old.keys() & new.keys()):
+            if old[slot][0] == new[slot][0]:
+                continue
+            a = self.parse(old[slot][1])
+            b = self.parse(new[slot][1])
+            for register, x, y in compare(a, b):
+                yield ('changed', slot, register, x, y)
+
+
+def _lnk(details, register):
+    for cap in details.get('Capabilities', []):
+        value = cap.properties.get(register, None)
+        if isinstance(value, dict):
+            return value
+    return {}
+
+
+def _bars(details):
+    bars = {}
+    for r in details.get('Regions', []):
+        name = 'ROM' if r.region is None else 'BAR{}'.format(r.region)
+        if r.size is None:
+            bars[name] = '{:#x}'.format(r.address)
+        else:
+            bars[name] = '{:#x} [size={}]{}'.format(r.address, r.size, ' [disabled]' if r.disabled else '')
+    return bars
+
+
+def _windows(details):
+    windows = {}
+    for r in details.get('BridgeRegions', []):
+        # BridgeRegion.prefetchable is True for the non-prefetchable window.
+        name = '{}{} window'.format('' if r.prefetchable else 'prefetchable ', r.type)
+        windows[name] = '{:#x}-{:#x}{}'.format(r.start, r.end, ' [disabled]' if r.disabled else '')
+    return windows
+
+
+def _compare_dicts(prefix, a, b):
+    for k in sorted(a.keys() | b.keys(), key=str):
+        x = a.get(k, None)
+        y = b.get(k, None)
+        if x != y:
+            yield (prefix + str(k), x, y)
+
+
+def compare(a, b):
+    """The `(register, old, new)` differences between two parsed devices."""
+    (aname, adetails), (bname, bdetails) = a, b
+    changes = []
+    if aname != bname:
+        changes.append(('name', aname, bname))
+    for register in ('LnkCap', 'LnkSta'):
+        changes.extend(_compare_dicts(register + '.', _lnk(adetails, register), _lnk(bdetails, register)))
+    changes.extend(_compare_dicts('', _bars(adetails), _bars(bdetails)))
+    changes.extend(_compare_dicts('', _windows(adetails), _windows(bdetails)))
+
+    if not changes:
+        # Something else in the block changed (status bits, error counters...)
+        for k in sorted(adetails.keys() | bdetails.keys()):
+            if adetails.get(k, None) != bdetails.get(k, None):
+                changes.append((k, '...', '...'))
+    return changes
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Diff successive lspci snapshots of the same machine.')
+    parser.add_argument('snapshots', nargs='+', metavar='SNAPSHOT')
+    opts = parser.parse_args(args[1:])
+
+    if len(opts.snapshots) < 2:
+        parser.error('need at least two snapshots')
+
+    differ = Differ()
+    texts = [open(p).read() for p in opts.snapshots]
+    for (a, old), (b, new) in zip(zip(opts.snapshots, texts), zip(opts.snapshots[1:], texts[1:])):
+        print('---', a)
+        print('+++', b)
+        for change in differ.diff(old, new):
+            if change[0] == 'changed':
+                print('  ~', change[1], '{}: {} -> {}'.format(*change[2:]))
+            else:
+                print('  {}'.format('+' if change[0] == 'added' else '-'), change[2])
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    import doctest
+    if doctest.testmod().failed > 0:
+        sys.exit(1)
+    sys.exit(main(sys.argv))
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+
+import array
+import json
+import mmap
+import struct
+import sys
+
+import lspci
+
+# Columnar binary snapshot of parsed lspci output.
+#
+# The file is a header, a directory of named columns and then the column data.
+# Each column is a plain array of one of the `array` module types, aligned to 8
+# bytes, so on load every column is just a `memoryview.cast()` of the mapped
+# file and nothing is parsed or copied until it is used.
+#
+#   magic      8s   b'PCIESNAP'
+#   version    I
+#   byteorder  4s   b'le  ' or b'be  '
+#   columns    I
+#   reserved   I
+#   directory  columns x (name 24s, typecode 1s, pad 7x, offset Q, count Q)
+#
+# Strings are stored once in the `strings.data` blob (utf-8), with
+# `strings.offsets` giving the start of each one; other columns refer to them
+# by index.  Column names are prefixed with their table:
+#
+#   dev.*   one row per device
+#   reg.*   one row per BAR / bridge window / capability BAR
+#   cap.*   one row per capability
+#   prop.*  one row per capability register field
+#
+# A field which is itself a set of flags (e.g. the PME states of a Power
+# Management capability's Flags) is stored as a JSON object.
+
+MAGIC = b'PCIESNAP'
+VERSION = 2
+
+# Versions which can still be read (1 has no V_JSON values).
+VERSIONS = (1, 2)
+
+HEADER = struct.Struct('<8sI4sII')
+ENTRY = struct.Struct('<24s1s7xQQ')
+
+# reg.kind
+BAR = 0
+WINDOW = 1
+CAP_BAR = 2
+
+# reg.flags, the low bits of lspci.RegionFlags
+DISABLED = lspci.RegionFlags.DISABLED
+VIRTUAL = lspci.RegionFlags.VIRTUAL
+PREFETCHABLE = lspci.RegionFlags.PREFETCHABLE
+NON_PREFETCHABLE = lspci.RegionFlags.NON_PREFETCHABLE
+BITS32 = lspci.RegionFlags.BITS32
+BITS64 = lspci.RegionFlags.BITS64
+UNASSIGNED = lspci.RegionFlags.UNASSIGNED
+NO_SIZE = lspci.RegionFlags.NO_SIZE
+
+REG_FLAGS = DISABLED | VIRTUAL | PREFETCHABLE | NON_PREFETCHABLE | BITS32 | BITS64
+
+# prop.vtype
+V_NONE = 0
+V_FALSE = 1
+V_TRUE = 2
+V_INT = 3
+V_STR = 4
+V_JSON = 5
+
+COLUMNS = {
+    'dev.slot':        'I',
+    'dev.desc':        'I',
+    'dev.domain':      'H',
+    'dev.bus':         'B',
+    'dev.dev':         'B',
+    'dev.fn':          'B',
+    'dev.driver':      'I',
+    'dev.numa':        'h',
+    'dev.secondary':   'h',
+    'dev.subordinate': 'h',
+
+    'reg.device':      'I',
+    'reg.kind':        'B',
+    'reg.index':       'b',
+    'reg.type':        'I',
+    'reg.start':       'Q',
+    'reg.size':        'Q',
+    'reg.flags':       'H',
+
+    'cap.device':      'I',
+    'cap.offset':      'H',
+    'cap.version':     'b',
+    'cap.name':        'I',
+
+    'prop.cap':        'I',
+    'prop.register':   'I',
+    'prop.field':      'I',
+    'prop.value':      'I',
+    'prop.vtype':      'B',
+
+    'strings.offsets': 'Q',
+    'strings.data':    'B',
+}
+
+
+class _Strings:
+    def __init__(self):
+        self.ids = {'': 0}
+        self.values = ['']
+
+    def __call__(self, s):
+        i = self.ids.get(s)
+        if i is None:
+            i = self.ids[s] = len(self.values)
+            self.values.append(s)
+        return i
+
+
+def _value(v, strings):
+    if v is None:
+        return V_NONE, 0
+    if v is True:
+        return V_TRUE, 0
+    if v is False:
+        return V_FALSE, 0
+    if isinstance(v, int):
+        return V_INT, strings(str(int(v)))
+    if isinstance(v, dict):
+        return V_JSON, strings(json.dumps(v))
+    return V_STR, strings(str(v))
+
+
+def _region_flags(r):
+    flags = r.mask & REG_FLAGS
+    if r.address < 0:
+        flags |= UNASSIGNED
+    if r.size is None:
+        flags |= NO_SIZE
+    return int(flags)
+
+
+def _window_flags(r):
+    return int(r.mask & REG_FLAGS)
+
+
+def write_snapshot(path, devices):
+    """Writes the parsed `devices` (from lspci.parse_lspci_output) to `path`."""
+    strings = _Strings()
+    cols = {name: array.array(code) for name, code in COLUMNS.items()}
+
+    def row(table, **values):
+        for k, v in values.items():
+            cols[table + '.' + k].append(v)
+
+    for d, (name, details) in enumerate(devices):
+        slot, _, desc = name.partition(' ')
+        domain, bus, dev, fn = lspci.parse_bdf(slot)
+        buses = lspci.bridge_buses(details) or (-1, -1, -1)
+        numa = details.get('NUMA node', None)
+        row('dev',
+            slot=strings(slot), desc=strings(desc),
+            domain=domain, bus=bus, dev=dev, fn=fn,
+            driver=strings(details.get('Kernel driver in use', '')),
+            numa=int(numa) if numa is not None else -1,
+            secondary=buses[1], subordinate=buses[2])
+
+        for r in details.get('Regions', []):
+            row('reg',
+                device=d, kind=BAR, index=-1 if r.region is None else r.region,
+                type=strings(r.rtype), start=max(r.address, 0), size=r.size or 0,
+                flags=_region_flags(r))
+        for r in details.get('BridgeRegions', []):
+            row('reg',
+                device=d, kind=WINDOW, index=-1,
+                type=strings(r.type), start=r.start, size=max(r.end - r.start + 1, 0),
+                flags=_window_flags(r))
+
+        for cap in details.get('Capabilities', []):
+            c = len(cols['cap.device'])
+            cname = cap.name
+            if cap.types:
+                cname = ', '.join(cap.types)
+            elif cap.vendor:
+                cname = 'Vendor Specific Information: ID={:04x} Rev={} Len={:03x}'.format(
+                    cap.vendor.id & 0xffff, cap.vendor.rev, cap.vendor.len)
+            row('cap', device=d, offset=cap.id, version=cap.version, name=strings(cname))
+
+            for r in cap.regions:
+                row('reg',
+                    device=d, kind=CAP_BAR, index=-1 if r.region is None else r.region,
+                    type=strings(r.rtype), start=max(r.address, 0), size=r.size or 0,
+                    flags=_region_flags(r))
+
+            for register, value in cap.properties.items():
+                if not isinstance(value, dict):
+                    value = {'': value}
+                for field, v in value.items():
+                    vtype, vid = _value(v, strings)
+                    row('prop', cap=c, register=strings(register), field=strings(field),
+                        value=vid, vtype=vtype)
+
+    offsets = cols['strings.offsets']
+    data = bytearray()
+    for s in strings.values:
+        offsets.append(len(data))
+        data += s.encode('utf-8')
+    offsets.append(len(data))
+    cols['strings.data'] = array.array('B', data)
+
+    _write_columns(path, cols)
+
+
+def _write_columns(path, cols):
+    names = list(cols)
+    offset = HEADER.size + ENTRY.size * len(names)
+    directory = []
+    for name in names:
+        offset = (offset + 7) & ~7
+        a = cols[name]
+        directory.append((name, a.typecode, offset, len(a)))
+        offset += len(a) * a.itemsize
+
+    with open(path, 'wb') as f:
+        order = b'le  ' if sys.byteorder == 'little' else b'be  '
+        f.write(HEADER.pack(MAGIC, VERSION, order, len(names), 0))
+        for name, code, offset, count in directory:
+            f.write(ENTRY.pack(name.encode(), code.encode(), offset, count))
+        for name, code, offset, count in directory:
+            f.write(b'\0' * (offset - f.tell()))
+            cols[name].tofile(f)
+
+
+class Snapshot:
+    """
+    A memory mapped snapshot file.  Columns are exposed as memoryviews of the
+    mapping, e.g. `snap['reg.start'][i]`.
+
+    >>> import os, tempfile
+    >>> devices = lspci.parse_lspci_output(
+    ...     "00:01.0 PCI bridge: Intel Corporation Root Port 1\\n"
+    ...     "\\tBus: primary=00, secondary=01, subordinate=01, sec-latency=0\\n"
+    ...     "\\tMemory behind bridge: 90000000-900fffff [size=1M] [32-bit]\\n"
+    ...     "\\tCapabilities: [40] Express (v2) Root Port (Slot+), MSI 00\\n"
+    ...     "\\t\\tLnkSta:\\tSpeed 8GT/s, Width x4\\n"
+    ...     "\\t\\t\\tTrErr- Train-\\n"
+    ...     "\\tCapabilities: [c8] Power Management version 3\\n"
+    ...     "\\t\\tFlags: PMEClk- PME(D0+,D1-,D2-,D3hot+,D3cold+)\\n"
+    ...     "\\tKernel driver in use: pcieport\\n"
+    ...     "\\n"
+    ...     "01:00.0 Non-Volatile memory controller: Intel Corporation NVMe\\n"
+    ...     "\\tRegion 0: Memory at 90010000 (64-bit, non-prefetchable) [size=16K]\\n"
+    ...     "\\tKernel driver in use: nvme\\n"
+    ...     "\\n")
+    >>> path = os.path.join(tempfile.mkdtemp(), 'host.snap')
+    >>> write_snapshot(path, devices)
+    >>> snap = Snapshot(path)
+    >>> len(snap)
+    2
+    >>> [snap.string(i) for i in snap['dev.driver']]
+    ['pcieport', 'nvme']
+    >>> list(snap['dev.secondary'])
+    [1, -1]
+    >>> for r in snap.regions():
+    ...     print(r['device'], r['kind'], r['type'], hex(r['start']), r['size'], r['flags'] & NON_PREFETCHABLE != 0)
+    0 1 memory 0x90000000 1048576 True
+    1 0 Memory 0x90010000 16384 True
+    >>> for p in snap.properties():
+    ...     print(p['device'], p['offset'], p['register'], p['field'], repr(p['value']))
+    0 64 LnkSta Speed '8GT/s'
+    0 64 LnkSta Width 'x4'
+    0 64 LnkSta TrErr False
+    0 64 LnkSta Train False
+    0 200 Flags PMEClk False
+    0 200 Flags PME {'D0': True, 'D1': False, 'D2': False, 'D3hot': True, 'D3cold': True}
+    >>> snap.close()
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buf = memoryview(self._mmap)
+
+        magic, version, order, ncolumns, _ = HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC or version not in VERSIONS:
+            raise ValueError('{}: not a version {} snapshot'.format(path, ' or '.join(map(str, VERSIONS))))
+        if order.strip() != (b'le' if sys.byteorder == 'little' else b'be'):
+            raise ValueError('{}: snapshot byte order is {}'.format(path, order.strip().decode()))
+
+        self._columns = {}
+        for i in range(ncolumns):
+            name, code, offset, count = ENTRY.unpack_from(self._buf, HEADER.size + i*ENTRY.size)
+            name = name.rstrip(b'\0').decode()
+            itemsize = array.array(code.decode()).itemsize
+            self._columns[name] = self._buf[offset:offset + count*itemsize].cast(code.decode())
+
+        self._strings = {}
+
+    def close(self):
+        self._columns = {}
+        self._buf.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self._columns['dev.slot'])
+
+    def __getitem__(self, column):
+        return self._columns[column]
+
+    def string(self, i):
+        s = self._strings.get(i)
+        if s is None:
+            offsets = self._columns['strings.offsets']
+            s = self._strings[i] = bytes(self._columns['strings.data'][offsets[i]:offsets[i+1]]).decode('utf-8')
+        return s
+
+    def _rows(self, table, strings=()):
+        names = [n for n in self._columns if n.startswith(table + '.')]
+        cols = [(n[len(table)+1:], self._columns[n], n in strings) for n in names]
+        for i in range(len(cols[0][1])):
+            yield {k: self.string(c[i]) if s else c[i] for k, c, s in cols}
+
+    def devices(self):
+        return self._rows('dev', ('dev.slot', 'dev.desc', 'dev.driver'))
+
+    def regions(self):
+        return self._rows('reg', ('reg.type',))
+
+    def capabilities(self):
+        return self._rows('cap', ('cap.name',))
+
+    def properties(self):
+        """Capability register fields, with their device and capability offset."""
+        cap_device = self._columns['cap.device']
+        cap_offset = self._columns['cap.offset']
+        for p in self._rows('prop', ('prop.register', 'prop.field')):
+            c = p.pop('cap')
+            vtype = p.pop('vtype')
+            value = p['value']
+            if vtype == V_NONE:
+                value = None
+            elif vtype == V_FALSE:
+                value = False
+            elif vtype == V_TRUE:
+                value = True
+            elif vtype == V_INT:
+                value = int(self.string(value))
+            elif vtype == V_JSON:
+                value = json.loads(self.string(value))
+            else:
+                value = self.string(value)
+            p['value'] = value
+            p['device'] = cap_device[c]
+            p['offset'] = cap_offset[c]
+            yield p
+
+
+if __name__ == "__main__":
+    import doctest
+    if doctest.testmod().failed > 0:
+        sys.exit(1)
+
+    for path in sys.argv[1:]:
+        with Snapshot(path) as snap:
+            print(path, len(snap), 'devices,', len(snap['reg.start']), 'regions,',
+                  len(snap['cap.device']), 'capabilities,', len(snap['prop.cap']), 'register fields')
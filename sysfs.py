@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import os
+import threading
+
+from dataclasses import dataclass, field
+from typing import Optional
+
+# Reads the attributes of every PCI function from sysfs.
+#
+# Each attribute is opened relative to an O_DIRECTORY fd of the device (so
+# the kernel doesn't have to walk the whole path again) and read with a single
+# pread into a buffer reused by the thread.  Devices are spread over a thread
+# pool as the reads are dominated by syscall latency, not CPU.
+
+SYSFS = '/sys/bus/pci/devices'
+
+
+@dataclass
+class SysfsDevice:
+    name: str
+    pclass: Optional[int] = None
+    vendor: Optional[int] = None
+    device: Optional[int] = None
+    subsystem_vendor: Optional[int] = None
+    subsystem_device: Optional[int] = None
+    revision: Optional[int] = None
+    link_speed: Optional[float] = None
+    max_link_speed: Optional[float] = None
+    # The speeds as the kernel shows them, e.g. '8.0 GT/s PCIe'.
+    link_speed_text: Optional[str] = None
+    max_link_speed_text: Optional[str] = None
+    link_width: Optional[int] = None
+    max_link_width: Optional[int] = None
+    secondary: Optional[int] = None
+    subordinate: Optional[int] = None
+    driver: Optional[str] = None
+    # (start, end, flags) of each non-empty line of `resource`.
+    resources: list = field(default_factory=list)
+
+    @property
+    def slot(self):
+        """The name without the domain, as lspci shows it."""
+        return self.name[5:]
+
+
+_local = threading.local()
+BUFFER_SIZE = 16 * 1024
+
+
+def read_attr(dir_fd, name):
+    """Returns the contents of attribute `name` of the device, or None."""
+    buf = getattr(_local, 'buf', None)
+    if buf is None:
+        buf = _local.buf = bytearray(BUFFER_SIZE)
+    try:
+        fd = os.open(name, os.O_RDONLY, dir_fd=dir_fd)
+    except OSError:
+        return None
+    try:
+        n = os.preadv(fd, [buf], 0)
+        if n < len(buf):
+            return bytes(buf[:n])
+        # Didn't fit, fall back to reading the rest.
+        data = [bytes(buf)]
+        while True:
+            chunk = os.pread(fd, BUFFER_SIZE, n)
+            if not chunk:
+                return b''.join(data)
+            data.append(chunk)
+            n += len(chunk)
+    except OSError:
+        # Some attributes (max_link_speed of a non-PCIe device...) exist but
+        # fail to read.
+        return None
+    finally:
+        os.close(fd)
+
+
+def _int(data, base=16):
+    if data is None:
+        return None
+    try:
+        return int(data, base)
+    except ValueError:
+        return None
+
+
+def _width(data):
+    """
+    >>> _width(b'16\\n'), _width(b'255\\n'), _width(None)
+    (16, None, None)
+    """
+    # The kernel shows 255 when the link is down or its width unknown.
+    width = _int(data, 10)
+    return None if width == 255 else width
+
+
+def _text(data):
+    if data is None:
+        return None
+    return data.decode('utf-8', 'replace').strip()
+
+
+def _speed(data):
+    """
+    >>> _speed(b'8.0 GT/s PCIe\\n'), _speed(b'2.5 GT/s\\n'), _speed(b'Unknown\\n')
+    (8.0, 2.5, None)
+    """
+    if data is None:
+        return None
+    try:
+        return float(data.split()[0])
+    except (ValueError, IndexError):
+        return None
+
+
+def parse_resource(data, empty=False):
+    """
+    Returns the `(start, end, flags)` of each row of a `resource` file.  The
+    all zero rows of unused BARs are skipped unless `empty` is set, in which
+    case the row number is the resource index (0-5 BARs, 6 ROM, ...).
+
+    >>> data = (b'0x0000000000000000 0x0000000000000000 0x0000000000000000\\n'
+    ...         b'0x00000000fb000000 0x00000000fbffffff 0x0000000000040200\\n')
+    >>> parse_resource(data)
+    [(4211081216, 4227858431, 262656)]
+    >>> parse_resource(data, empty=True)
+    [(0, 0, 0), (4211081216, 4227858431, 262656)]
+    """
+    resources = []
+    if data is None:
+        return resources
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        start, end, flags = (int(x, 16) for x in line.split())
+        if start == end == flags == 0 and not empty:
+            continue
+        resources.append((start, end, flags))
+    return resources
+
+
+def read_device(path):
+    """Reads the device at sysfs directory `path`."""
+    dir_fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        def a(name):
+            return read_attr(dir_fd, name)
+
+        try:
+            driver = os.path.basename(os.readlink('driver', dir_fd=dir_fd))
+        except OSError:
+            driver = None
+        link_speed = a('current_link_speed')
+        max_link_speed = a('max_link_speed')
+        return SysfsDevice(
+            name=os.path.basename(path),
+            pclass=_int(a('class')),
+            vendor=_int(a('vendor')),
+            device=_int(a('device')),
+            subsystem_vendor=_int(a('subsystem_vendor')),
+            subsystem_device=_int(a('subsystem_device')),
+            revision=_int(a('revision')),
+            link_speed=_speed(link_speed),
+            max_link_speed=_speed(max_link_speed),
+            link_speed_text=_text(link_speed),
+            max_link_speed_text=_text(max_link_speed),
+            link_width=_width(a('current_link_width')),
+            max_link_width=_width(a('max_link_width')),
+            secondary=_int(a('secondary_bus_number'), 10),
+            subordinate=_int(a('subordinate_bus_number'), 10),
+            driver=driver,
+            resources=parse_resource(a('resource')),
+        )
+    finally:
+        os.close(dir_fd)
+
+
+def scan(root=SYSFS, jobs=8):
+    """
+    Returns a SysfsDevice for every device below `root`, sorted by name.
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as root:
+    ...     for name, attrs in {
+    ...         '0000:00:01.0': {'class': '0x060400', 'vendor': '0x8086', 'device': '0x6f02',
+    ...                          'current_link_speed': '8.0 GT/s PCIe', 'current_link_width': '16',
+    ...                          'secondary_bus_number': '2', 'subordinate_bus_number': '3'},
+    ...         '0000:02:00.0': {'class': '0x030200', 'vendor': '0x10de', 'device': '0x1db1',
+    ...                          'current_link_speed': '2.5 GT/s PCIe', 'current_link_width': '8',
+    ...                          'resource': '0x00000000fa000000 0x00000000faffffff 0x0000000000040200\\n'},
+    ...     }.items():
+    ...         os.mkdir(os.path.join(root, name))
+    ...         for attr, value in attrs.items():
+    ...             with open(os.path.join(root, name, attr), 'w') as f:
+    ...                 _ = f.write(value + '\\n')
+    ...     for d in scan(root):
+    ...         print(d.slot, hex(d.pclass), d.link_speed, repr(d.link_speed_text), d.link_width, d.secondary, d.subordinate, d.resources)
+    00:01.0 0x60400 8.0 '8.0 GT/s PCIe' 16 2 3 []
+    02:00.0 0x30200 2.5 '2.5 GT/s PCIe' 8 None None [(4194304000, 4211081215, 262656)]
+    """
+    paths = sorted(e.path for e in os.scandir(root))
+    # Starting the threads costs more than reading a small host serially.
+    if jobs == 1 or len(paths) < 32:
+        return [read_device(p) for p in paths]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(read_device, paths))
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
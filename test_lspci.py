@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+import dataclasses
+import glob
+import os
+import pickle
+import re
+import subprocess
+import sys
+import tempfile
+import timeit
+import unittest
+
+import lspci
+
+# The checks which are too slow to be doctests: they run over every snapshot
+# in the repository, or time the parsers on many copies of one.
+#
+#   python3 -m unittest test_lspci      (or python3 -m pytest)
+
+TOP = os.path.dirname(os.path.abspath(__file__))
+
+
+def corpora(*patterns):
+    """Paths of the lspci outputs checked into the repository."""
+    paths = []
+    for pattern in patterns or ('*/lspci', '*/lspci.vvv', '*/lspci.full', '*/pcie/*.lspci'):
+        paths.extend(glob.glob(os.path.join(TOP, pattern)))
+    return sorted(paths)
+
+
+def _read(path):
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def _seconds(fn, repeat=3):
+    """The best of `repeat` calls of `fn` (timeit turns the GC off)."""
+    return min(timeit.Timer(fn).repeat(repeat, 1))
+
+
+def fixup_chained(s):
+    """lspci._fixup() as it was, a full pass over `s` for each rewrite."""
+    # Convert the following into "colon-tab" setup.
+    s = s.replace('Capabilities: ', 'Capabilities:\t')
+    s = s.replace('BridgeCtl: ', 'BridgeCtl:\t')
+    s = s.replace('Read-only fields:', 'Read only fields:\t')
+
+    # Convert 'Expansion ROM at d0800000 [disabled] [size=256K]`
+    # to      'Region E: Expansion ROM at d0800000 [disabled] [size=256K]`
+    s = s.replace('Expansion ROM at ', 'Region E: Expansion ROM at ')
+
+    # Convert 'Region 0: Memory at 90330000 (32-bit, non-prefetchable) [disabled] [size=16K]'
+    # to      'Region 0: Memory at 90330000 (32-bit non-prefetchable) [disabled] [size=16K]'
+    s = s.replace('bit, ', 'bit ')
+    # Convert 'FRS- LN System CLS Not Supported, TPHComp+ ExtTPHComp- ARIFwd+'
+    # to      'FRS- LN System CLS Not Supported, TPHComp+ ExtTPHComp- ARIFwd+'
+    s = s.replace('LN System CLS', 'LN-System-CLS')
+	# Convert `LnkCtl: ASPM Disabled; RCB 64 bytes, Disabled- CommClk+`
+	# to      `LnkCtl: ASPM Disabled, RCB 64 bytes, Disabled- CommClk+`
+    s = s.replace('; ', ', ')
+    # Convert 'Exit Latency L0s <1us, L1 <4us'
+    # to      'Exit Latency L0s <1us L1 <4us'
+    s = s.replace(', L1', ' L1')
+
+    # Convert: `Flags: PMEClk- DSI- D1- D2- AuxCurrent=0mA PME(D0+,D1-,D2-,D3hot+,D3cold+)`
+    # to       `Flags: PMEClk- DSI- D1- D2- AuxCurrent=0mA, PME: D0+ D1- D2- D3hot+ D3cold+,`
+    def _fix_pme(match_obj):
+        f = match_obj.group(1).replace(",", " ")
+        return f', PME: {f}, '
+    s = re.sub(r' *PME\(([^\)]+)\) *', _fix_pme, s)
+
+    # Convert `Compliance Preset/De-emphasis: -6dB de-emphasis, 0dB preshoot`
+    # to      `Compliance Preset/De-emphasis: -6dB de-emphasis 0dB preshoot`
+    s = s.replace('dB de-emphasis, ', 'dB de-emphasis ')
+
+    # Convert ` CrosslinkRes: unsupported`
+    # to      ` CrosslinkRes=unsupported`
+    s = s.replace(' CrosslinkRes: unsupported', ' CrosslinkRes=unsupported')
+
+    # Convert ' Interrupt Message Number: '
+    # to      ' Interrupt-Message-Number='
+    s = s.replace(' Interrupt Message Number: ', ' Interrupt-Message-Number=')
+
+    # Convert 'L1SubCtl2:\n'
+    # to      'L1SubCtl2: Unsupported\n'
+    s = s.replace('L1SubCtl2:\n', 'L1SubCtl2: \n')
+
+    return s
+
+
+def parse_flags_chained(l):
+    """lspci.parse_flags() as it was, a str.replace() for each rewrite."""
+    if isinstance(l, list):
+        l = ' '.join(l)
+
+    assert ', ' not in l, l
+    assert ': ' not in l, l
+
+	# `LnkCap:	Port #9, Speed 8GT/s, Width x1, ASPM L0s L1, Exit Latency L0s <1us, L1 <4us`
+    if 'ASPM ' in l:
+        b = l.split(' ')
+        assert b[0] == 'ASPM', (b, l)
+        l = 'ASPM='+','.join(b[1:])
+
+	# `10BitTagComp- 10BitTagReq- OBFF Not Supported, ExtFmt- EETLPPrefix-`
+	# `EmergencyPowerReduction Not Supported, EmergencyPowerReductionInit-`
+    l = l.replace(' Not Supported','=Unsupported')
+	# `LnkCap:	Port #1, Speed 8GT/s, Width x8, ASPM not supported`
+    l = l.replace(' not supported','=Unsupported')
+	# `DevCtl2: Completion Timeout: 50us to 50ms, TimeoutDis- LTR- 10BitTagReq- OBFF Disabled,`
+	# `LnkCtl:	ASPM Disabled; RCB 64 bytes, Disabled- CommClk+`
+    l = l.replace(' Disabled', '=Disabled')
+    # `10BitTagComp- 10BitTagReq- OBFF Via message, ExtFmt- EETLPPrefix-`
+    l = l.replace(' Via ','=Via-')
+	# `RootSta: PME ReqID 0000, PMEStatus- PMEPending-`
+    l = l.replace('PME ReqID ','PME-ReqID=')
+	# `ExtTag- AttnBtn- AttnInd- PwrInd- RBE+ FLReset+ SlotPowerLimit 0W`
+    l = l.replace('SlotPowerLimit ', 'SlotPowerLimit=')
+    # `Status: D0 NoSoftRst+ PME-Enable- DSel=0 DScale=0 PME-`
+    l = l.replace('D0 ', 'D0+ ')
+	# `Status: D3 NoSoftRst- PME-Enable+ DSel=0 DScale=0 PME-`
+    l = l.replace('D3 ', 'D3+ ')
+    # `FirstFatal- NonFatalMsg- FatalMsg- IntMsg 0`
+    l = l.replace('IntMsg ', 'IntMsg=')
+    l = l.replace('INT Msg #', 'IntMsg=')
+    l = l.replace('RP PIO Log ', 'RP-PIO-Log=')
+    l = l.replace('RP PIO ErrPtr:', 'RP-PIO-ErrPtr=')
+    l = l.replace('Trigger:', 'Trigger=')
+    l = l.replace('TriggerExt:', 'TriggerExt=')
+    l = l.replace('Reason:', 'Reason=')
+    # ``
+    l = l.replace('Slot #', 'Slot=#')
+    l = l.replace('PowerLimit ', 'PowerLimit=')
+
+    flags = {}
+    for f in l.split():
+        if '=' in f:
+            name, value = f.split('=')
+            flags[name] = value
+            continue
+
+        assert f[-1] in '-+', (f, l)
+        name = f[:-1]
+        value = {'-': False, '+': True}[f[-1]]
+        assert name not in flags, (name, flags, l)
+
+        if name.endswith(':'):
+            name = name[:-1]
+
+        flags[name] = value
+    return flags
+
+
+class TestFixup(unittest.TestCase):
+    def test_corpora(self):
+        for path in corpora():
+            with self.subTest(path=os.path.relpath(path, TOP)):
+                s = _read(path)
+                self.assertEqual(lspci._fixup(s), fixup_chained(s))
+
+
+class TestFlags(unittest.TestCase):
+    def test_corpora(self):
+        for path in corpora('*/lspci.vvv', '*/lspci.full'):
+            with self.subTest(path=os.path.relpath(path, TOP)):
+                for l in lspci._flag_inputs([path]):
+                    self.assertEqual(lspci.parse_flags(l), parse_flags_chained(l), l)
+
+
+class TestLazy(unittest.TestCase):
+    def test_corpora(self):
+        # Decoding on demand gives the same devices as decoding up front.
+        for path in corpora('*/lspci.vvv', '*/lspci.full'):
+            with self.subTest(path=os.path.relpath(path, TOP)):
+                s = _read(path)
+                self.assertEqual(lspci.parse_lspci_output(s, lazy=True), lspci.parse_lspci_output(s))
+
+    def test_fields(self):
+        # `properties` is still an ordinary dataclass field.
+        cap = lspci.parse_lspci_output(
+            "00:01.0 PCI bridge: Intel Corporation Root Port 1\n"
+            "\tCapabilities: [90] Express (v2) Root Port (Slot-), MSI 00\n"
+            "\t\tLnkSta:\tSpeed 8GT/s (ok), Width x16 (ok)\n"
+            "\n", lazy=True)[0][1]['Capabilities'][0]
+        self.assertIn('properties', [f.name for f in dataclasses.fields(cap)])
+        copy = dataclasses.replace(cap)
+        self.assertEqual(copy.properties, {'LnkSta': {'Speed': '8GT/s (ok)', 'Width': 'x16 (ok)'}})
+        self.assertEqual(copy, cap)
+        self.assertEqual(pickle.loads(pickle.dumps(cap)), cap)
+
+
+class TestReport(unittest.TestCase):
+    def test_corpus(self):
+        # lspci.py's report on 4028GR-TVRT (with WIDTH=120), as printed before
+        # Region and BridgeRegion got their RegionFlags, plus the conflicts.
+        with tempfile.TemporaryDirectory() as cache:
+            out = subprocess.run(
+                [sys.executable, os.path.join(TOP, 'lspci.py')],
+                cwd=os.path.join(TOP, '4028GR-TVRT'), env=dict(os.environ, WIDTH='120', PCIEE_CACHE_DIR=cache),
+                stdout=subprocess.PIPE, check=True, encoding='utf-8').stdout
+        expected = _read(os.path.join(TOP, '4028GR-TVRT', 'lspci.vvv.report'))
+        # Rather than assertEqual, whose diff of 40000 lines takes forever.
+        for i, (got, want) in enumerate(zip(out.splitlines(), expected.splitlines())):
+            self.assertEqual(got, want, 'line {}'.format(i + 1))
+        self.assertEqual(len(out), len(expected))
+
+
+class TestScaling(unittest.TestCase):
+    # Generous, as only a quadratic parser would be this far off linear.
+    BOUND = 3
+
+    def assertLinear(self, make, fn, sizes=(1, 10, 100)):
+        """Checks the time per unit of `fn(make(n))` doesn't grow with `n`."""
+        # Only fn is timed, each size the same way.
+        times = {}
+        for n in sizes:
+            data = make(n)
+            times[n] = _seconds(lambda: fn(data)) / n
+        base = times[sizes[0]]
+        for n in sizes[1:]:
+            self.assertLess(
+                times[n], base * self.BOUND,
+                '{}x the input took {:.1f}x as long per copy'.format(n, times[n] / base))
+
+    def test_corpus(self):
+        # From 1 to 100 copies of the 4028GR-TVRT output.
+        text = lspci._fixup(_read(os.path.join(TOP, '4028GR-TVRT', 'lspci.vvv')))
+        lines = text.splitlines() + ['']
+        self.assertLinear(lambda n: lines * n, lspci.group_device_lines)
+
+    def test_block(self):
+        # One capability with 100 to 10000 registers, each wrapped over two lines.
+        register = ['\tDevCap:\tMaxPayload 128 bytes, PhantFunc 0', '\t\tExtTag- RBE+']
+        self.assertLinear(
+            lambda n: ['Capabilities: [90] Express (v2) Endpoint, MSI 00'] + register * n,
+            lspci.undo_multiline, sizes=(100, 1000, 10000))
+
+
+if __name__ == "__main__":
+    sys.exit(unittest.main())
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+import re
+import sys
+
+# The PCI hierarchy as linked objects.
+#
+# Every function is a Device (or a Bridge, which also owns the Bus behind
+# it), indexed by its `(domain, bus, device, function)`.  When the topology
+# is built each device gets its chain of ancestor bridges and its position in
+# a depth first ordering of the tree, so the path to a device is a tuple
+# lookup and its subtree is a slice of `Topology.order`.
+#
+# It can be built from sysfs (sysfs.SysfsDevice), `lspci -vvv` output parsed by
+# lspci.py or the `lspci -PP` device list.
+
+RE_SLOT = re.compile(r'^(?:([\da-fA-F]{4,}):)?([\da-fA-F]{2}):([\da-fA-F]{2})\.([0-7])$')
+
+
+def parse_slot(slot):
+    """
+    Returns the `(domain, bus, device, function)` of `slot` (plain, with a
+    domain or a `lspci -P` path), or None if it isn't one.
+
+    >>> parse_slot('00:1f.3'), parse_slot('0001:17:00.0'), parse_slot('00:02.0/0b:00.0')
+    ((0, 0, 31, 3), (1, 23, 0, 0), (0, 11, 0, 0))
+    >>> parse_slot('PCI Bus 0000:00') is None
+    True
+    """
+    m = RE_SLOT.match(slot.rsplit('/', 1)[-1])
+    if not m:
+        return None
+    domain, bus, dev, fn = m.groups()
+    return int(domain or '0', 16), int(bus, 16), int(dev, 16), int(fn, 16)
+
+
+class Device:
+    __slots__ = (
+        'domain', 'bus', 'dev', 'fn',
+        # The class ('PCI bridge', ...) and the rest of the lspci line.
+        'kind', 'description',
+        # Whatever the device was built from.
+        'data',
+        # Bridges from the root down to the parent, and the parent itself.
+        'ancestors', 'parent',
+        # Position in Topology.order, the subtree ends just before `end`.
+        'index', 'end',
+    )
+
+    def __init__(self, bdf, kind='', description='', data=None):
+        self.domain, self.bus, self.dev, self.fn = bdf
+        self.kind = kind
+        self.description = description
+        self.data = data
+        self.ancestors = ()
+        self.parent = None
+        self.index = self.end = None
+
+    @property
+    def bdf(self):
+        return (self.domain, self.bus, self.dev, self.fn)
+
+    @property
+    def slot(self):
+        return '{:02x}:{:02x}.{:x}'.format(self.bus, self.dev, self.fn)
+
+    @property
+    def address(self):
+        return '{:04x}:{}'.format(self.domain, self.slot)
+
+    @property
+    def path(self):
+        """The `lspci -PP` style name."""
+        return '/'.join(d.slot for d in self.ancestors + (self,))
+
+    @property
+    def depth(self):
+        return len(self.ancestors)
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, self.address)
+
+
+class Bridge(Device):
+    __slots__ = ('secondary', 'subordinate', 'child')
+
+    def __init__(self, bdf, secondary, subordinate, kind='', description='', data=None):
+        super().__init__(bdf, kind, description, data)
+        self.secondary = secondary
+        self.subordinate = subordinate
+        # The Bus behind the bridge, if anything is on it.
+        self.child = None
+
+
+class Bus:
+    __slots__ = ('domain', 'number', 'bridge', 'devices')
+
+    def __init__(self, domain, number):
+        self.domain = domain
+        self.number = number
+        self.bridge = None
+        self.devices = []
+
+    def __repr__(self):
+        return 'Bus({:04x}:{:02x})'.format(self.domain, self.number)
+
+
+class Topology:
+    """
+    >>> t = from_paths(
+    ...     "00:00.0 Host bridge: Intel Corporation DMI2\\n"
+    ...     "00:02.0 PCI bridge: Intel Corporation Root Port 2\\n"
+    ...     "00:02.0/02:00.0 PCI bridge: PLX Technology, Inc. PEX 9765\\n"
+    ...     "00:02.0/02:00.0/03:08.0 PCI bridge: PLX Technology, Inc. PEX 9765\\n"
+    ...     "00:02.0/02:00.0/03:08.0/04:00.0 3D controller: NVIDIA Corporation GV100GL\\n"
+    ...     "00:02.0/02:00.0/03:10.0 PCI bridge: PLX Technology, Inc. PEX 9765\\n"
+    ...     "00:02.0/02:00.0/03:10.0/05:00.0 3D controller: NVIDIA Corporation GV100GL\\n"
+    ...     "00:03.0 PCI bridge: Intel Corporation Root Port 3\\n")
+    >>> t['04:00.0'].ancestors
+    (Bridge(0000:00:02.0), Bridge(0000:02:00.0), Bridge(0000:03:08.0))
+    >>> t['04:00.0'].path, t['04:00.0'].parent.child
+    ('00:02.0/02:00.0/03:08.0/04:00.0', Bus(0000:04))
+    >>> t.subtree(t['0000:02:00.0'])
+    [Bridge(0000:02:00.0), Bridge(0000:03:08.0), Device(0000:04:00.0), Bridge(0000:03:10.0), Device(0000:05:00.0)]
+    >>> t['00:02.0'].secondary, t['00:02.0'].subordinate, t['00:03.0'].child
+    (2, 5, None)
+    >>> [d.slot for d in t.endpoints()], t.get('PCI Bus 0000:00')
+    (['00:00.0', '04:00.0', '05:00.0'], None)
+    """
+
+    def __init__(self, devices):
+        self.index = {}
+        for d in devices:
+            self.index[d.bdf] = d
+
+        self.buses = {}
+        for bdf in sorted(self.index):
+            d = self.index[bdf]
+            key = (d.domain, d.bus)
+            if key not in self.buses:
+                self.buses[key] = Bus(*key)
+            self.buses[key].devices.append(d)
+
+        for d in self.index.values():
+            if isinstance(d, Bridge) and d.secondary is not None:
+                bus = self.buses.get((d.domain, d.secondary), None)
+                if bus is not None:
+                    bus.bridge = d
+                    d.child = bus
+
+        self.roots = [b for _, b in sorted(self.buses.items()) if b.bridge is None]
+
+        # Depth first from the root buses, handing each device its ancestors.
+        self.order = []
+        stack = [(d, ()) for b in reversed(self.roots) for d in reversed(b.devices)]
+        while stack:
+            d, ancestors = stack.pop()
+            if d is None:
+                ancestors.end = len(self.order)
+                continue
+            d.ancestors = ancestors
+            d.parent = ancestors[-1] if ancestors else None
+            d.index = len(self.order)
+            self.order.append(d)
+            stack.append((None, d))
+            if isinstance(d, Bridge) and d.child is not None:
+                below = ancestors + (d,)
+                stack.extend((c, below) for c in reversed(d.child.devices))
+
+        # Anything not reached sits below a loop of bridges (broken bus
+        # numbers), just keep it findable.
+        for bdf in sorted(self.index):
+            d = self.index[bdf]
+            if d.index is None:
+                d.index = len(self.order)
+                self.order.append(d)
+                d.end = d.index + 1
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def get(self, key, default=None):
+        """The Device for a `(domain, bus, device, function)` or slot string."""
+        if isinstance(key, str):
+            key = parse_slot(key)
+        return self.index.get(key, default)
+
+    def __getitem__(self, key):
+        d = self.get(key)
+        if d is None:
+            raise KeyError(key)
+        return d
+
+    def path(self, device):
+        """The devices from the root down to `device`."""
+        return device.ancestors + (device,)
+
+    def subtree(self, device):
+        """`device` and everything below it, depth first."""
+        return self.order[device.index:device.end]
+
+    def endpoints(self):
+        return [d for d in self.order if not isinstance(d, Bridge)]
+
+
+def _split(line):
+    slot, _, rest = line.partition(' ')
+    kind, _, description = rest.partition(': ')
+    return slot, kind, description
+
+
+def from_sysfs(records):
+    """A Topology of sysfs.SysfsDevice `records` (a list or `{name: record}`)."""
+    if isinstance(records, dict):
+        records = records.values()
+    devices = []
+    for r in records:
+        bdf = parse_slot(r.name)
+        if r.secondary is not None and r.subordinate is not None:
+            devices.append(Bridge(bdf, r.secondary, r.subordinate, data=r))
+        else:
+            devices.append(Device(bdf, data=r))
+    return Topology(devices)
+
+
+def from_lspci(devices):
+    """A Topology of `(name, details)` from lspci.parse_lspci_output."""
+    import lspci
+    objs = []
+    for name, details in devices:
+        slot, kind, description = _split(name)
+        bdf = lspci.parse_bdf(slot)
+        buses = lspci.bridge_buses(details)
+        if buses:
+            objs.append(Bridge(bdf, buses[1], buses[2], kind, description, (name, details)))
+        else:
+            objs.append(Device(bdf, kind, description, (name, details)))
+    return Topology(objs)
+
+
+def from_paths(text):
+    """
+    A Topology of a `lspci -PP` device list, where the bus numbers behind
+    each bridge are taken from the paths of the devices below it.
+    """
+    lines = []
+    below = {}
+    for line in text.splitlines():
+        line = line.rstrip()
+        if not line:
+            continue
+        slot, kind, description = _split(line)
+        path = [parse_slot(s) for s in slot.split('/')]
+        lines.append((path[-1], kind, description, line))
+        for i, bdf in enumerate(path[:-1]):
+            buses = below.setdefault(bdf, [path[i+1][1], path[i+1][1]])
+            buses[1] = max(buses[1], path[-1][1])
+
+    devices = []
+    for bdf, kind, description, line in lines:
+        if bdf in below:
+            devices.append(Bridge(bdf, *below[bdf], kind, description, line))
+        elif kind in ('PCI bridge', 'CardBus bridge'):
+            devices.append(Bridge(bdf, None, None, kind, description, line))
+        else:
+            devices.append(Device(bdf, kind, description, line))
+    return Topology(devices)
+
+
+def main(args):
+    import lspci
+    for path in args[1:] or ['lspci.vvv']:
+        with open(path, 'rb') as f:
+            t = from_lspci(lspci.cached_parse(f.read(), lazy=True))
+        print('==>', path, '<==')
+        for d in t:
+            print('    ' * d.depth + d.slot, d.kind + ':', d.description)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    import doctest
+    if doctest.testmod().failed > 0:
+        sys.exit(1)
+    sys.exit(main(sys.argv))